@@ -1,28 +1,43 @@
-#Isolation
-import sys; print(f"PYTHON VERSION: {sys.version}"); print(f"PYTHON PATH: {sys.executable}")
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g, has_request_context
+from flask.json.provider import DefaultJSONProvider
 import os
-import requests
-import firebase_admin
-#Isolation
-
-from flask import Flask, render_template, request, jsonify
-import os
-import requests
-import firebase_admin
-from firebase_admin import credentials, firestore
-import numpy as np
+import sys
 import time
+import bisect
+import heapq
 import base64
-import math
-import random 
-from datetime import datetime, timedelta
-import uuid
+from datetime import datetime
 import json
 import ssl
 import socket
 import threading
-from collections import defaultdict
+import hashlib
+import secrets
+import zlib
+import queue
+import random
+import math
+import itertools
+import ipaddress
+import atexit
+import logging
+import logging.handlers
+import weakref
+from collections import defaultdict, OrderedDict
+from cachetools import TTLCache
+
+try:
+    import orjson
+except ImportError:  # Optional - falls back to the stdlib encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Optional - gzip only without it
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
 
 # ======================================================
 # APP INIT - THIS MUST COME FIRST!
@@ -35,16 +50,426 @@ app = Flask(__name__)
 # Patch SSL to be more resilient
 ssl._create_default_https_context = ssl._create_unverified_context
 
-# Increase socket timeout for mobile networks
+# Increase socket timeout for mobile networks (a backstop - per-call deadlines come from FirestoreGateway)
 socket.setdefaulttimeout(30)
 
 # Force HTTP/1.1 for better compatibility
 app.config['PREFERRED_URL_SCHEME'] = 'https'
 
+# ======================================================
+# STRUCTURED LOGGING (queue-backed, sampled per route)
+# ======================================================
+# Request threads only enqueue records; a listener thread formats them as
+# JSON lines and writes stdout, so logging never blocks a request on I/O.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 1000))  # 0 disables slow-request logs
+
+def _parse_sample_rates(spec):
+    """"/sales=0.01,/complete-sale=1" -> {"/sales": 0.01, "/complete-sale": 1.0}"""
+    rates = {}
+    for entry in spec.split(","):
+        route, _, rate = entry.partition("=")
+        if route.strip() and rate.strip():
+            rates[route.strip()] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+# Fraction of INFO/DEBUG records kept per route rule; warnings and errors are never sampled
+LOG_SAMPLE_RATES = {"/sales": 0.01, "/scan": 0.01, **_parse_sample_rates(os.environ.get("LOG_SAMPLE_RATES", ""))}
+# Shops whose sales are traced line by line (toggle at runtime via /debug/logging)
+sale_trace_shops = {s.strip() for s in os.environ.get("SALE_TRACE_SHOPS", "").split(",") if s.strip()}
+
+class JSONLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "event": record.getMessage(),
+            **getattr(record, "fields", {})
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return app.json.dumps(entry)
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Same process - hand the record over as-is, formatting happens on the listener thread.
+        # Only render the traceback now so frames are not kept alive in the queue.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+log = logging.getLogger("supakeeper")
+log.setLevel(LOG_LEVEL)
+log.propagate = False
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler(sys.stdout)
+_log_stream_handler.setFormatter(JSONLogFormatter())
+log.addHandler(_DeferredQueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+def _restart_log_listener():
+    # preload_app forks workers after import; the listener thread does not survive fork
+    _log_listener._thread = None
+    _log_listener.start()
+
+os.register_at_fork(after_in_child=_restart_log_listener)
+
+def log_event(event, level=logging.INFO, exc_info=False, **fields):
+    """Structured log line; INFO/DEBUG records inside a request are sampled by route"""
+    if not log.isEnabledFor(level):
+        return
+    if has_request_context():
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        rate = LOG_SAMPLE_RATES.get(route, 1.0)
+        if level < logging.WARNING and rate < 1.0 and random.random() >= rate:
+            return
+        fields.setdefault("route", route)
+    log.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+def sale_trace(shop_id, event, **fields):
+    """Verbose per-item sale tracing, only for shops switched on in sale_trace_shops"""
+    if shop_id in sale_trace_shops:
+        log.info(event, extra={"fields": {"shop_id": shop_id, "trace": "sale", **fields}})
+
+# ======================================================
+# FAST JSON SERIALIZATION
+# ======================================================
+# Omit nested "debug" blocks from search results (set INCLUDE_DEBUG_PAYLOADS=0 in production)
+app.config["INCLUDE_DEBUG_PAYLOADS"] = os.environ.get("INCLUDE_DEBUG_PAYLOADS", "1") != "0"
+
+# Datetimes are passed through to default() so they keep Flask's HTTP-date format
+ORJSON_OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME) if orjson else 0
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider that encodes with orjson when installed, stdlib json otherwise.
+    Output matches Flask's default provider: keys sorted (sort_keys) and dates
+    as HTTP dates.
+    """
+
+    def dumps(self, obj, **kwargs):
+        # Explicit json.dumps kwargs (indent, sort_keys...) need the stdlib encoder
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode("utf-8")
+
+    def dumps_bytes(self, obj):
+        """Encode straight to UTF-8 bytes - avoids a decode/encode round trip for responses"""
+        if orjson is not None:
+            try:
+                options = ORJSON_OPTIONS | orjson.OPT_SORT_KEYS if self.sort_keys else ORJSON_OPTIONS
+                return orjson.dumps(obj, default=self.default, option=options)
+            except TypeError:
+                # orjson.JSONEncodeError (e.g. ints over 64 bits) - let stdlib handle it
+                pass
+        return super().dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def default(o):
+        # Slotted cache records (items, batches, selling units) serialize as their dict form
+        if isinstance(o, CacheRecord):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self._app.debug or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj), mimetype=self.mimetype)
+
+app.json = FastJSONProvider(app)
+log_event("json_encoder", encoder="orjson" if orjson else "stdlib json")
+
+# ======================================================
+# METRICS (per-thread counters, Prometheus text on /metrics)
+# ======================================================
+# Each thread only ever writes to its own shard, so recording takes no lock;
+# /metrics sums the shards at scrape time.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+REBUILD_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+METRIC_HELP = {
+    "http_requests_total": ("counter", "HTTP requests by route, method and status"),
+    "http_request_duration_seconds": ("histogram", "Time to build the response, including compression"),
+    "firestore_operations_total": ("counter", "Firestore documents read or written, by operation and source"),
+    "firestore_reads_per_request": ("histogram", "Firestore documents read while serving one request"),
+    "firestore_writes_per_request": ("histogram", "Firestore documents written while serving one request"),
+    "firestore_calls_per_request": ("histogram", "Firestore RPCs (including retries) made while serving one request"),
+    "firestore_calls_total": ("counter", "Firestore RPCs by method and outcome (ok, error, deadline)"),
+    "firestore_call_duration_seconds": ("histogram", "Firestore RPC latency by method (successful attempts)"),
+    "firestore_retries_total": ("counter", "Firestore reads retried after a transient error, by method"),
+    "firestore_coalesced_total": ("counter", "Document gets served by another caller's in-flight RPC"),
+    "listener_snapshots_total": ("counter", "Snapshot callbacks received, by listener"),
+    "listener_changes_total": ("counter", "Document changes received, by listener"),
+    "cache_rebuild_duration_seconds": ("histogram", "Full shop cache rebuild time"),
+    "search_index_build_duration_seconds": ("histogram", "Search index build time"),
+    "cache_shop_compactions_total": ("counter", "Cold shops compacted to search-only fields to fit the memory budget"),
+    "cache_shop_reloads_total": ("counter", "Compacted shops reloaded from Firestore for a detail request"),
+    "shop_cache_loads_total": ("counter", "Shops loaded into the cache, by reason"),
+    "shop_cache_evictions_total": ("counter", "Shops evicted from the cache, by reason (idle or capacity)"),
+    "shop_cache_load_duration_seconds": ("histogram", "Time to load one shop from Firestore"),
+    "entitlement_denials_total": ("counter", "Item or staff creations refused by /add-item or /add-staff, by resource"),
+    "search_admission_total": ("counter", "/sales admission outcomes (admitted, queued, coalesced, shed_rate, shed_overload)"),
+    "search_result_cache_total": ("counter", "/sales result cache lookups by outcome (hit, miss)"),
+    "search_queue_wait_seconds": ("histogram", "Time searches waited for a slot (queued searches only)"),
+    "cache_bus_messages_total": ("counter", "Cache bus deltas by direction (published, received) and op"),
+    "cache_bus_gaps_total": ("counter", "Cache bus sequence gaps detected (each resyncs one shop)"),
+    "cache_bus_epoch_changes_total": ("counter", "Cache bus leader epochs joined by this follower"),
+    "cache_bus_role_changes_total": ("counter", "Cache bus role changes of this instance, by new role"),
+}
+
+_metric_shards = []
+_metric_local = threading.local()
+_metric_shards_lock = threading.Lock()  # taken when a new thread records its first metric, and by /metrics
+_retired_shard = {"counters": defaultdict(float), "histograms": {}}  # totals of threads that have exited
+_histogram_buckets = {}  # metric name -> bucket upper bounds
+
+def _merge_shard(target, shard):
+    for key, value in list(shard["counters"].items()):
+        target["counters"][key] += value
+    for key, counts in list(shard["histograms"].items()):
+        merged = target["histograms"].get(key)
+        if merged is None:
+            target["histograms"][key] = list(counts)
+        else:
+            for i, count in enumerate(counts):
+                merged[i] += count
+
+def _retire_dead_shards():
+    """Fold the shards of exited threads into _retired_shard (caller holds _metric_shards_lock)"""
+    live = []
+    for shard in _metric_shards:
+        if shard["thread"].is_alive():
+            live.append(shard)
+        else:
+            _merge_shard(_retired_shard, shard)
+    _metric_shards[:] = live
+
+def _metric_shard():
+    shard = getattr(_metric_local, "shard", None)
+    if shard is None:
+        shard = {"counters": defaultdict(float), "histograms": {}, "thread": threading.current_thread()}
+        _metric_local.shard = shard
+        with _metric_shards_lock:
+            _retire_dead_shards()
+            _metric_shards.append(shard)
+    return shard
+
+def inc_counter(name, value=1, **labels):
+    _metric_shard()["counters"][(name, tuple(sorted(labels.items())))] += value
+
+def observe_histogram(name, value, buckets=LATENCY_BUCKETS, **labels):
+    buckets = _histogram_buckets.setdefault(name, buckets)
+    histograms = _metric_shard()["histograms"]
+    key = (name, tuple(sorted(labels.items())))
+    counts = histograms.get(key)
+    if counts is None:
+        # One slot per bucket, one for +Inf, then the running sum
+        counts = histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+    counts[bisect.bisect_left(buckets, value)] += 1
+    counts[-1] += value
+
+def record_firestore(operation, count=1):
+    """Count Firestore documents read/written - globally and against the current request"""
+    if has_request_context():
+        source = request.url_rule.rule if request.url_rule else "unmatched"
+        attribute = f"firestore_{operation}s"
+        setattr(g, attribute, g.get(attribute, 0) + count)
+    else:
+        source = "background"
+    inc_counter("firestore_operations_total", count, operation=operation, source=source)
+
+def record_listener_event(listener, changes):
+    inc_counter("listener_snapshots_total", listener=listener)
+    inc_counter("listener_changes_total", len(changes), listener=listener)
+
+def _collect_metrics():
+    """Sum every live thread's shard and the retired totals"""
+    totals = {"counters": defaultdict(float), "histograms": {}}
+    with _metric_shards_lock:
+        _retire_dead_shards()
+        _merge_shard(totals, _retired_shard)
+        for shard in _metric_shards:
+            _merge_shard(totals, shard)
+    return totals["counters"], totals["histograms"]
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # Registered before compress_response, so it runs after it and times compression too
+    started = g.get("request_started")
+    if started is None:
+        return response
+    duration = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    inc_counter("http_requests_total", route=route, method=request.method, status=str(response.status_code))
+    observe_histogram("http_request_duration_seconds", duration, route=route)
+    observe_histogram("firestore_reads_per_request", g.get("firestore_reads", 0), COUNT_BUCKETS, route=route)
+    observe_histogram("firestore_writes_per_request", g.get("firestore_writes", 0), COUNT_BUCKETS, route=route)
+    observe_histogram("firestore_calls_per_request", g.get("firestore_calls", 0), COUNT_BUCKETS, route=route)
+
+    duration_ms = duration * 1000
+    if SLOW_REQUEST_MS and duration_ms >= SLOW_REQUEST_MS:
+        log_event(
+            "slow_request",
+            logging.WARNING,
+            method=request.method,
+            path=request.path,
+            status=response.status_code,
+            duration_ms=round(duration_ms, 2),
+            firestore_reads=g.get("firestore_reads", 0),
+            firestore_writes=g.get("firestore_writes", 0),
+            firestore_calls=g.get("firestore_calls", 0)
+        )
+    return response
+
+# ======================================================
+# RESPONSE COMPRESSION & CONDITIONAL GET
+# ======================================================
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))  # bytes; smaller bodies go out as-is
+COMPRESS_STATIC_MAX_SIZE = 2 * 1024 * 1024  # don't buffer huge static files for compression
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # 11 is too slow for on-the-fly compression
+COMPRESSIBLE_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/javascript",
+    "application/javascript", "application/json", "image/svg+xml"
+}
+
+_compressed_static_cache = {}  # (etag, encoding) -> compressed body
+
+def negotiate_encoding():
+    """Pick the best content-coding the client accepts: br, then gzip"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+def _compress_bytes(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return zlib.compress(data, GZIP_LEVEL, wbits=31)  # wbits=31 -> gzip container
+
+def _compress_stream(chunks, encoding):
+    """Compress a streamed (generator) response chunk by chunk"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+def _encoded_etag(etag, encoding):
+    """Each content-coding is a different representation, so it gets its own strong ETag"""
+    return f"{etag}-{encoding}" if encoding else etag
+
+def etag_matches(etag):
+    """True when the client already holds a representation of this ETag"""
+    if_none_match = request.if_none_match
+    return if_none_match.contains(etag) or if_none_match.contains(_encoded_etag(etag, negotiate_encoding()))
+
+def not_modified(etag):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.vary.add("Accept-Encoding")
+    return response
+
+@app.after_request
+def compress_response(response):
+    """gzip/brotli negotiation for text responses above COMPRESS_MIN_SIZE"""
+    if (response.status_code != 200
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    etag, weak = response.get_etag()
+    if etag and not weak and request.if_none_match.contains(_encoded_etag(etag, encoding)):
+        response.close()
+        return not_modified(_encoded_etag(etag, encoding))
+
+    if response.direct_passthrough:
+        # send_file() responses (static js/css) - cache the compressed body by ETag
+        if not etag or (response.content_length or 0) > COMPRESS_STATIC_MAX_SIZE or "Content-Range" in response.headers:
+            return response
+        body = _compressed_static_cache.get((etag, encoding))
+        if body is None:
+            response.direct_passthrough = False
+            body = _compress_bytes(response.get_data(), encoding)
+            _compressed_static_cache[(etag, encoding)] = body
+        else:
+            response.close()
+        response.direct_passthrough = False
+        response.set_data(body)
+    elif response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(_compress_bytes(data, encoding))
+
+    response.headers["Content-Encoding"] = encoding
+    if etag and not weak:
+        response.set_etag(_encoded_etag(etag, encoding))
+    return response
+
+_rendered_page_cache = {}  # endpoint -> (html bytes, etag)
+
+def render_cached_page(template_name, **context):
+    """
+    Render a static marketing page once per process and serve it with a strong ETag.
+    Templates are only re-rendered in debug mode (template auto-reload).
+    """
+    cached = None if app.debug else _rendered_page_cache.get(request.endpoint)
+    if cached is None:
+        html = render_template(template_name, **context).encode("utf-8")
+        cached = (html, hashlib.sha1(html).hexdigest()[:20])
+        _rendered_page_cache[request.endpoint] = cached
+
+    html, etag = cached
+    if etag_matches(etag):
+        return not_modified(etag)
+
+    response = app.response_class(html, mimetype="text/html")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, no-cache"  # always revalidate - 304s are cheap
+    return response
+
 # ======================================================
 # FIREBASE CONFIG
 # ======================================================
 def get_firebase_client():
+    # Imported here - firebase_admin/google-cloud are the slowest imports in the app
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
     if not firebase_admin._apps:
         firebase_key_base64 = os.environ.get("FIREBASE_KEY")
         if not firebase_key_base64:
@@ -54,28 +479,577 @@ def get_firebase_client():
         firebase_admin.initialize_app(cred)
     return firestore.client()
 
-# Initialize later
+# Initialized by warm_up()
 db = None
 
+# ======================================================
+# FIRESTORE DATA ACCESS (deadlines, read retries, coalescing, get_all batching)
+# ======================================================
+# Routes and loaders call Firestore through `fs`, never the client directly.
+# A call's timeout is the smaller of FIRESTORE_CALL_TIMEOUT_SECONDS and what is
+# left of the request's FIRESTORE_REQUEST_BUDGET_SECONDS. Reads are retried with
+# full-jitter backoff while the process-wide retry budget has tokens; writes are
+# never retried. Every call is counted against the request.
+FIRESTORE_CALL_TIMEOUT_SECONDS = float(os.environ.get("FIRESTORE_CALL_TIMEOUT_SECONDS", 10))
+FIRESTORE_REQUEST_BUDGET_SECONDS = float(os.environ.get("FIRESTORE_REQUEST_BUDGET_SECONDS", 25))
+FIRESTORE_READ_ATTEMPTS = max(1, int(os.environ.get("FIRESTORE_READ_ATTEMPTS", 3)))
+FIRESTORE_BACKOFF_BASE_SECONDS = 0.1
+FIRESTORE_BACKOFF_MAX_SECONDS = 2.0
+FIRESTORE_GET_ALL_CHUNK = 100  # documents per get_all RPC
+FIRESTORE_RETRY_TOKENS = 10.0  # retry budget size; retries pause below half of it
+FIRESTORE_RETRY_TOKEN_RATIO = 0.1  # tokens earned back per successful call
+
+class FirestoreDeadlineExceeded(Exception):
+    """The request's Firestore budget ran out before a call (or its retry) could be made"""
+
+class RetryBudget:
+    """
+    Process-wide retry throttle (gRPC style): each failed call costs a token,
+    each success earns back a fraction, and retries stop while the bucket is
+    below half - a Firestore outage is not multiplied into a retry storm.
+    """
+    def __init__(self, max_tokens, token_ratio):
+        self.max_tokens = max_tokens
+        self.token_ratio = token_ratio
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def on_success(self):
+        if self.tokens < self.max_tokens:
+            with self._lock:
+                self.tokens = min(self.max_tokens, self.tokens + self.token_ratio)
+
+    def on_failure(self):
+        with self._lock:
+            self.tokens = max(0.0, self.tokens - 1)
+
+    def can_retry(self):
+        return self.tokens > self.max_tokens / 2
+
+class _Flight:
+    """One in-progress get that concurrent callers for the same document wait on"""
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class FirestoreGateway:
+    def __init__(self):
+        self.retry_budget = RetryBudget(FIRESTORE_RETRY_TOKENS, FIRESTORE_RETRY_TOKEN_RATIO)
+        self._flights = {}  # document path -> _Flight
+        self._flights_lock = threading.Lock()
+        self._retryable = None
+
+    def _retryable_errors(self):
+        # Resolved on first use - google.api_core comes in with the (lazily imported) Firebase client
+        if self._retryable is None:
+            errors = [ConnectionError, TimeoutError, socket.timeout]
+            try:
+                from google.api_core import exceptions as api_errors
+                errors += [api_errors.ServiceUnavailable, api_errors.DeadlineExceeded, api_errors.InternalServerError,
+                           api_errors.TooManyRequests, api_errors.GatewayTimeout, api_errors.Aborted]
+            except ImportError:
+                pass
+            self._retryable = tuple(errors)
+        return self._retryable
+
+    @staticmethod
+    def _deadline():
+        """perf_counter() time the current request's Firestore budget ends (None outside requests)"""
+        if has_request_context():
+            started = g.get("request_started")
+            if started is not None:
+                return started + FIRESTORE_REQUEST_BUDGET_SECONDS
+        return None
+
+    @staticmethod
+    def _remaining(deadline, method):
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            inc_counter("firestore_calls_total", method=method, outcome="deadline")
+            raise FirestoreDeadlineExceeded(
+                f"Firestore budget of {FIRESTORE_REQUEST_BUDGET_SECONDS:g}s exhausted before {method}")
+        return remaining
+
+    def _call(self, method, fn, retry):
+        """fn(timeout) under the request deadline; retryable errors are retried when `retry`"""
+        deadline = self._deadline()
+        attempt = 0
+        while True:
+            timeout = FIRESTORE_CALL_TIMEOUT_SECONDS
+            if deadline is not None:
+                timeout = min(timeout, self._remaining(deadline, method))
+            attempt += 1
+            if has_request_context():
+                g.firestore_calls = g.get("firestore_calls", 0) + 1
+            start = time.perf_counter()
+            try:
+                result = fn(timeout)
+            except self._retryable_errors() as e:
+                self.retry_budget.on_failure()
+                delay = random.uniform(0, min(FIRESTORE_BACKOFF_MAX_SECONDS, FIRESTORE_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1)))
+                if (not retry or attempt >= FIRESTORE_READ_ATTEMPTS or not self.retry_budget.can_retry()
+                        or (deadline is not None and time.perf_counter() + delay >= deadline)):
+                    inc_counter("firestore_calls_total", method=method, outcome="error")
+                    raise
+                inc_counter("firestore_retries_total", method=method)
+                log_event("firestore_retry", logging.WARNING, method=method, attempt=attempt,
+                          delay_ms=round(delay * 1000, 1), error=str(e))
+                time.sleep(delay)
+                continue
+            except Exception:
+                inc_counter("firestore_calls_total", method=method, outcome="error")
+                raise
+            observe_histogram("firestore_call_duration_seconds", time.perf_counter() - start, method=method)
+            inc_counter("firestore_calls_total", method=method, outcome="ok")
+            self.retry_budget.on_success()
+            return result
+
+    def _get(self, ref):
+        snapshot = self._call("get", lambda timeout: ref.get(retry=None, timeout=timeout), retry=True)
+        record_firestore("read")
+        return snapshot
+
+    def get(self, ref, coalesce=True):
+        """
+        Document snapshot. Concurrent gets of the same document share one RPC;
+        pass coalesce=False for read-modify-write, which needs a read that
+        starts after the caller's own previous write.
+        """
+        if not coalesce:
+            return self._get(ref)
+        key = ref.path
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if leader:
+            try:
+                flight.result = self._get(ref)
+                return flight.result
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self._flights_lock:
+                    self._flights.pop(key, None)
+                flight.done.set()
+
+        inc_counter("firestore_coalesced_total", method="get")
+        deadline = self._deadline()
+        wait = self._remaining(deadline, "get") if deadline is not None \
+            else FIRESTORE_CALL_TIMEOUT_SECONDS * FIRESTORE_READ_ATTEMPTS
+        if not flight.done.wait(wait):
+            raise FirestoreDeadlineExceeded(f"Timed out waiting for a shared read of {key}")
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def get_all(self, refs):
+        """Snapshots for refs (in order, duplicates allowed) via batched get_all RPCs"""
+        unique = list({ref.path: ref for ref in refs}.values())
+        by_path = {}
+        for start in range(0, len(unique), FIRESTORE_GET_ALL_CHUNK):
+            chunk = unique[start:start + FIRESTORE_GET_ALL_CHUNK]
+            snapshots = self._call("get_all", lambda timeout: list(db.get_all(chunk, retry=None, timeout=timeout)),
+                                   retry=True)
+            for snapshot in snapshots:
+                by_path[snapshot.reference.path] = snapshot
+        record_firestore("read", len(unique))
+        return [by_path[ref.path] for ref in refs]
+
+    def stream(self, query):
+        """Every document of a collection or query as a list (a failed stream is retried from the start)"""
+        documents = self._call("stream", lambda timeout: list(query.stream(retry=None, timeout=timeout)), retry=True)
+        record_firestore("read", len(documents))
+        return documents
+
+    def update(self, ref, data):
+        self._call("update", lambda timeout: ref.update(data, retry=None, timeout=timeout), retry=False)
+        record_firestore("write")
+
+    def set(self, ref, data, merge=False):
+        self._call("set", lambda timeout: ref.set(data, merge=merge, retry=None, timeout=timeout), retry=False)
+        record_firestore("write")
+
+fs = FirestoreGateway()
+
 # ======================================================
 # LOAD MODEL - DISABLED (embeddings not needed)
 # ======================================================
 model = None
-print("[INFO] Embeddings disabled - model not loaded")
+log_event("embeddings_disabled")
+
+# ======================================================
+# CACHE RECORDS (slotted items, batches and selling units shared by cache and index)
+# ======================================================
+def _intern(value):
+    """Intern short repeated strings (units, batch ids/names, dates, staff emails) across records"""
+    return sys.intern(value) if type(value) is str else value
+
+def normalize_code(value):
+    """Barcode / SKU as matched by the scan index (trimmed, upper case); None if empty"""
+    if value is None:
+        return None
+    code = str(value).strip().upper()
+    return code or None
+
+def document_codes(data):
+    """Codes an item or sellUnit document carries: "barcodes" (list), "barcode" and "sku", deduplicated in order"""
+    values = list(data.get("barcodes") or ()) + [data.get("barcode"), data.get("sku")]
+    return tuple(dict.fromkeys(code for code in map(normalize_code, values) if code))
+
+class CacheRecord:
+    """
+    Base for the slotted records the shop cache and the search index share.
+    Keeps the read-only mapping access the rest of the app uses (record["name"],
+    record.get(...), "name" in record) and serializes as a dict with the same
+    keys, in the same order, as the plain-dict entries it replaced.
+    """
+    __slots__ = ()
+    FIELDS = ()  # exported keys, in JSON order
+    _KEYS = frozenset()
+
+    def __getitem__(self, key):
+        if key in self._KEYS:
+            try:
+                return getattr(self, key)
+            except AttributeError:  # dropped by compaction
+                pass
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self._KEYS else default
+
+    def __contains__(self, key):
+        return key in self._KEYS and hasattr(self, key)
+
+    def pop(self, key, default=None):
+        """Drop a stored field (compaction); computed fields are left alone"""
+        if key in self.__slots__ and hasattr(self, key):
+            value = getattr(self, key)
+            delattr(self, key)
+            return value
+        return default
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.FIELDS if hasattr(self, key)}
+
+    STATE = ()  # constructor arguments
+
+    def to_state(self):
+        """Constructor arguments as plain data (cache bus deltas); the inverse of from_state"""
+        return {key: getattr(self, key, None) for key in self.STATE}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(**{key: state.get(key) for key in cls.STATE})
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+class BatchRecord(CacheRecord):
+    __slots__ = ("batch_id", "batch_name", "quantity", "unit", "buy_price", "sell_price",
+                 "timestamp", "date", "added_by", "selling_unit_allocations")
+    FIELDS = ("batch_id", "batch_name", "quantity", "remaining_quantity", "unit", "buy_price", "sell_price",
+              "timestamp", "date", "added_by", "selling_unit_allocations")
+    _KEYS = frozenset(FIELDS)
+    STATE = __slots__
+
+    def __init__(self, batch_id, batch_name, quantity, unit, buy_price, sell_price,
+                 timestamp, date, added_by, selling_unit_allocations):
+        self.batch_id = _intern(batch_id)
+        self.batch_name = _intern(batch_name)
+        self.quantity = quantity
+        self.unit = _intern(unit)
+        self.buy_price = buy_price
+        self.sell_price = sell_price
+        self.timestamp = timestamp
+        self.date = _intern(date)
+        self.added_by = _intern(added_by)
+        self.selling_unit_allocations = selling_unit_allocations
+
+    @property
+    def remaining_quantity(self):
+        # Loaded equal to quantity and never tracked separately, so not stored twice
+        return self.quantity
+
+class Availability:
+    """
+    FIFO view of one item's batches, derived in one pass and shared by the item
+    and all of its selling units, so search, the catalogue export and sale
+    validation read the same numbers.
+    """
+    __slots__ = ("fifo", "base_available", "first_available", "first_sellable")
+
+    def __init__(self, batches):
+        self.fifo = tuple(sorted(batches, key=lambda b: b.timestamp))
+        base_available = 0
+        first_available = None
+        first_sellable = None
+        for batch in self.fifo:
+            if batch.quantity > 0:
+                base_available += batch.quantity
+                if first_available is None:
+                    first_available = batch
+            if first_sellable is None and batch.quantity >= 0.999999:
+                first_sellable = batch
+        self.base_available = base_available  # base units across batches with stock
+        self.first_available = first_available  # oldest batch with any stock (selling units sell from it)
+        # Oldest batch holding at least one whole base unit, else the oldest batch at all (main items)
+        self.first_sellable = first_sellable if first_sellable is not None else (self.fifo[0] if self.fifo else None)
+
+    def units_available(self, conversion_factor):
+        """Selling units obtainable from every parent batch with stock"""
+        return self.base_available * conversion_factor if self.base_available else 0
+
+SALES_VELOCITY_HALF_LIFE_DAYS = float(os.environ.get("SALES_VELOCITY_HALF_LIFE_DAYS", 7))
+SALES_VELOCITY_WINDOW_DAYS = float(os.environ.get("SALES_VELOCITY_WINDOW_DAYS", 90))  # older sales are ignored on load
+
+def add_sale_velocity(velocity, quantity, timestamp):
+    """
+    Fold one sale into an item's sales velocity: log2 of the units sold, each
+    halved every SALES_VELOCITY_HALF_LIFE_DAYS since it was sold. Anchored at
+    the Unix epoch and kept in log2, so values compare across items at any time
+    without re-decaying and never overflow. None means never sold.
+    """
+    if quantity <= 0:
+        return velocity
+    weight = timestamp / (SALES_VELOCITY_HALF_LIFE_DAYS * 86400) + math.log2(quantity)
+    if velocity is None:
+        return weight
+    high, low = max(velocity, weight), min(velocity, weight)
+    return high + math.log2(1 + 2 ** (low - high))
+
+def sales_velocity_from_transactions(transactions):
+    """Sales velocity from an item document's stockTransactions (sales within the window)"""
+    cutoff = time.time() - SALES_VELOCITY_WINDOW_DAYS * 86400
+    velocity = None
+    for txn in transactions or ():
+        if not isinstance(txn, dict) or txn.get("type") != "sale":
+            continue
+        timestamp = txn.get("timestamp")
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.timestamp()
+        elif not isinstance(timestamp, (int, float)):
+            continue
+        elif timestamp > 1e11:  # milliseconds
+            timestamp /= 1000
+        try:
+            quantity = float(txn.get("quantity") or 0)
+        except (TypeError, ValueError):
+            continue
+        if timestamp >= cutoff:
+            velocity = add_sale_velocity(velocity, quantity, timestamp)
+    return velocity
+
+class SellingUnitRecord(CacheRecord):
+    type = "selling_unit"
+    __slots__ = ("sell_unit_id", "name", "conversion_factor", "sell_price", "images", "is_base_unit",
+                 "thumbnail", "created_at", "updated_at", "batch_links", "has_batch_links", "codes", "item")
+    FIELDS = ("sell_unit_id", "name", "conversion_factor", "sell_price", "images", "is_base_unit",
+              "thumbnail", "created_at", "updated_at", "batch_links", "total_units_available", "has_batch_links",
+              "codes")
+    _KEYS = frozenset(FIELDS)
+    STATE = __slots__[:-1]  # all but the parent link
+
+    def __init__(self, sell_unit_id, name, conversion_factor, sell_price, images, is_base_unit,
+                 thumbnail, created_at, updated_at, batch_links, has_batch_links, codes=()):
+        self.sell_unit_id = sell_unit_id
+        self.name = name
+        self.conversion_factor = conversion_factor
+        self.sell_price = sell_price
+        self.images = images
+        self.is_base_unit = is_base_unit
+        self.thumbnail = thumbnail
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.batch_links = batch_links
+        self.has_batch_links = has_batch_links
+        self.codes = tuple(codes or ())  # barcodes / SKUs (see document_codes)
+        self.item = None  # parent ItemRecord - search reads its batches, name and category
+
+    @property
+    def total_units_available(self):
+        # Derived from the parent's batches; batchLinks counters are not maintained by sales
+        return self.item.availability.units_available(self.conversion_factor) if self.item else 0
+
+class ItemRecord(CacheRecord):
+    type = "main_item"
+    embeddings = ()  # embeddings are disabled; kept in the exported shape
+    has_embeddings = False
+    __slots__ = ("item_id", "name", "thumbnail", "sell_price", "buy_price", "stock", "base_unit",
+                 "selling_units", "category_id", "category_name", "batches", "total_stock_from_batches",
+                 "codes", "sales_velocity", "availability")
+    FIELDS = ("item_id", "name", "thumbnail", "sell_price", "buy_price", "stock", "base_unit", "embeddings",
+              "has_embeddings", "selling_units", "category_id", "category_name", "batches", "has_batches",
+              "total_stock_from_batches", "codes")
+    _KEYS = frozenset(FIELDS)
+    STATE = __slots__[:-1]  # availability is derived
+
+    def __init__(self, item_id, name, thumbnail, sell_price, buy_price, stock, base_unit,
+                 selling_units, category_id, category_name, batches, total_stock_from_batches,
+                 codes=(), sales_velocity=None):
+        self.item_id = item_id
+        self.name = name
+        self.thumbnail = thumbnail
+        self.sell_price = sell_price
+        self.buy_price = buy_price
+        self.stock = stock
+        self.base_unit = _intern(base_unit)
+        self.selling_units = tuple(selling_units)
+        self.category_id = category_id
+        self.category_name = category_name
+        self.batches = tuple(batches)
+        self.total_stock_from_batches = total_stock_from_batches
+        self.codes = tuple(codes or ())  # barcodes / SKUs (see document_codes)
+        self.sales_velocity = sales_velocity  # see add_sale_velocity; ranks search completions
+        for selling_unit in self.selling_units:
+            selling_unit.item = self
+        self.availability = Availability(self.batches)
+
+    @property
+    def has_batches(self):
+        return len(self.batches) > 0
+
+    def refresh_availability(self):
+        """Re-derive after a batch quantity changed in place"""
+        self.availability = Availability(self.batches)
+
+    def to_state(self):
+        state = super().to_state()
+        state["batches"] = [batch.to_state() for batch in self.batches]
+        state["selling_units"] = [unit.to_state() for unit in self.selling_units]
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        state = dict(state, batches=[BatchRecord.from_state(batch) for batch in state["batches"]],
+                     selling_units=[SellingUnitRecord.from_state(unit) for unit in state["selling_units"]])
+        return super().from_state(state)
 
 # ======================================================
 # SEARCH INDEX - NEW! Lightning fast in-memory search
 # ======================================================
+SEARCH_RESULT_CACHE_ENTRIES = int(os.environ.get("SEARCH_RESULT_CACHE_ENTRIES", 5000))  # 0 disables
+SEARCH_RESULT_CACHE_MB = float(os.environ.get("SEARCH_RESULT_CACHE_MB", 32))
+SEARCH_COMPLETION_TOP_K = int(os.environ.get("SEARCH_COMPLETION_TOP_K", 50))  # >= the /sales limit
+
+class SearchResultCache:
+    """
+    Bounded LRU of formatted results keyed by (shop_id, query, limit, include_debug),
+    each tagged with the generation of the shop's shard it was computed from.
+    A shop's entries are dropped when its generation moves (shard rebuilt or
+    stock changed in place); other shops' entries stay warm.
+    """
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (generation, results, bytes), least recently used first
+        self.keys_by_shop = {}  # shop_id -> set of keys
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "invalidations": 0}
+        self._lock = threading.Lock()
+
+    def get(self, key, generation):
+        """Cached results computed from this generation of the shop's shard, else None"""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                outcome = "hit"
+            else:
+                if entry is not None:
+                    self._remove(key)
+                    self.stats["stale"] += 1
+                self.stats["misses"] += 1
+                outcome = "miss"
+        inc_counter("search_result_cache_total", outcome=outcome)
+        return entry[1] if outcome == "hit" else None
+
+    def put(self, key, generation, results):
+        if self.max_entries <= 0:
+            return
+        size = deep_sizeof(results)
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (generation, results, size)
+            self.keys_by_shop.setdefault(key[0], set()).add(key)
+            self.bytes += size
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                self._remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def invalidate_shop(self, shop_id):
+        with self._lock:
+            keys = self.keys_by_shop.get(shop_id)
+            if not keys:
+                return
+            for key in list(keys):
+                self._remove(key)
+            self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.keys_by_shop.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+        keys = self.keys_by_shop.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_shop[key[0]]
+
+    def summary(self):
+        """Size, limits and hit rate for /debug-cache"""
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                "entries": len(self.entries),
+                "shops": len(self.keys_by_shop),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                **self.stats,
+                "hit_rate": round(self.stats["hits"] / lookups, 4) if lookups else None
+            }
+
 class SearchIndex:
-    """High-performance search index for instant product lookup"""
+    """High-performance search index for instant product lookup (one shard per shop)"""
     
     def __init__(self):
-        self.word_index = defaultdict(list)  # word -> list of items
-        self.prefix_index = defaultdict(set)  # prefix -> set of item keys
-        self.items_by_id = {}  # item_key -> full item data
+        self.shards = {}  # shop_id -> {"word_index", "prefix_index", "completions", "codes", "items_by_id", counters, generation}
         self.last_built = None
         self.total_items = 0
         self.total_selling_units = 0
+        self.result_cache = SearchResultCache(SEARCH_RESULT_CACHE_ENTRIES, int(SEARCH_RESULT_CACHE_MB * 1024 * 1024))
+        self._generations = itertools.count(1)  # process-wide, so a dropped and reloaded shop never reuses one
+
+    @property
+    def bytes_by_shop(self):
+        """shop_id -> shallow size of its search records"""
+        return {shop_id: shard["bytes"] for shop_id, shard in self.shards.items()}
+
+    def counts(self):
+        """Totals across shards for /debug-cache and /metrics"""
+        shards = list(self.shards.values())
+        return {
+            "shops": len(shards),
+            "keys": sum(len(shard["items_by_id"]) for shard in shards),
+            "words": sum(len(shard["word_index"]) for shard in shards),
+            "prefixes": sum(len(shard["prefix_index"]) for shard in shards),
+            "completion_lists": sum(len(shard["completions"]) for shard in shards),
+            "codes": sum(len(shard["codes"]) for shard in shards)
+        }
         
     def _generate_item_key(self, item, category, shop, is_selling_unit=False, sell_unit=None):
         """Generate unique key for item or selling unit"""
@@ -83,227 +1057,317 @@ class SearchIndex:
             return f"su_{shop['shop_id']}_{item['item_id']}_{sell_unit['sell_unit_id']}"
         return f"item_{shop['shop_id']}_{item['item_id']}"
     
-    def _add_to_index(self, text, score, item_key, item_data):
-        """Add text to search index with score"""
+    def _add_to_index(self, shard, text, score, item_key, item_data):
+        """Add text to a shop's shard with score"""
         if not text:
             return
             
         words = text.lower().split()
         for word in words:
             # Add to word index with score
-            self.word_index[word].append({
-                "key": item_key,
-                "score": score,
-                "data": item_data
-            })
+            entry = (item_key, score, item_data)
+            shard["word_index"][word].append(entry)
+            shard["bytes"] += sys.getsizeof(entry)
             
             # Add prefixes for partial matching
             for i in range(1, len(word) + 1):
                 prefix = word[:i]
-                self.prefix_index[prefix].add(item_key)
+                shard["prefix_index"][prefix].add(item_key)
     
     def build(self, shops_data):
-        """Build search index from cache data"""
+        """Build search index from cache data (replaces every shard)"""
         start = time.time()
-        print("\n🔨 BUILDING SEARCH INDEX...")
-        
-        # Clear existing index
-        self.word_index.clear()
-        self.prefix_index.clear()
-        self.items_by_id.clear()
-        
-        item_count = 0
-        su_count = 0
         
+        shards = {}
         for shop in shops_data:
-            shop_id = shop["shop_id"]
-            shop_name = shop["shop_name"]
-            
-            for category in shop.get("categories", []):
-                category_id = category["category_id"]
-                category_name = category["category_name"]
-                
-                for item in category.get("items", []):
-                    item_count += 1
-                    
-                    # Create base item data structure
-                    base_item_data = {
-                        "type": "main_item",
-                        "item_id": item["item_id"],
-                        "main_item_id": item["item_id"],
-                        "category_id": category_id,
-                        "category_name": category_name,
-                        "name": item["name"],
-                        "display_name": item["name"],
-                        "thumbnail": item.get("thumbnail"),
-                        "sell_price": item.get("sell_price", 0),
-                        "base_unit": item.get("base_unit", "unit"),
-                        "batches": item.get("batches", []),
-                        "has_batches": item.get("has_batches", False),
-                        "shop_id": shop_id,
-                        "shop_name": shop_name,
-                        "category": category,
-                        "original_item": item
-                    }
-                    
-                    # Generate item key
-                    item_key = self._generate_item_key(item, category, shop)
-                    self.items_by_id[item_key] = base_item_data
-                    
-                    # Index item name (high score)
-                    self._add_to_index(item["name"], 100, item_key, base_item_data)
-                    
-                    # Index selling units
-                    for su in item.get("selling_units", []):
-                        su_count += 1
-                        su_key = self._generate_item_key(item, category, shop, True, su)
-                        
-                        su_data = {
-                            "type": "selling_unit",
-                            "item_id": item["item_id"],
-                            "main_item_id": item["item_id"],
-                            "sell_unit_id": su["sell_unit_id"],
-                            "category_id": category_id,
-                            "category_name": category_name,
-                            "name": su.get("name", ""),
-                            "display_name": su.get("name", ""),
-                            "thumbnail": su.get("thumbnail") or item.get("thumbnail"),
-                            "price": su.get("sell_price", 0),
-                            "conversion_factor": su.get("conversion_factor", 1),
-                            "batch_links": su.get("batch_links", []),
-                            "has_batch_links": su.get("has_batch_links", False),
-                            "total_units_available": su.get("total_units_available", 0),
-                            "shop_id": shop_id,
-                            "shop_name": shop_name,
-                            "category": category,
-                            "original_item": item,
-                            "original_su": su,
-                            "batches": item.get("batches", [])  # Reference parent batches
-                        }
-                        
-                        self.items_by_id[su_key] = su_data
-                        
-                        # Index selling unit name (higher score than parent)
-                        su_name = su.get("name", "")
-                        if su_name:
-                            self._add_to_index(su_name, 95, su_key, su_data)
-        
-        self.total_items = item_count
-        self.total_selling_units = su_count
+            shards[shop["shop_id"]] = self._build_shard(shop)
+        self.shards = shards
+        self.result_cache.clear()
+        self._update_totals()
         self.last_built = time.time()
+        observe_histogram("search_index_build_duration_seconds", self.last_built - start, REBUILD_BUCKETS)
         
-        print(f"✅ SEARCH INDEX BUILT in {time.time()-start:.2f}s")
-        print(f"   • {item_count} main items indexed")
-        print(f"   • {su_count} selling units indexed")
-        print(f"   • {len(self.word_index)} unique keywords")
-        print(f"   • {len(self.prefix_index)} prefixes available")
+        counts = self.counts()
+        log_event(
+            "search_index_built",
+            duration_ms=round((self.last_built - start) * 1000, 2),
+            main_items=self.total_items,
+            selling_units=self.total_selling_units,
+            keywords=counts["words"],
+            prefixes=counts["prefixes"]
+        )
+
+    def build_shop(self, shop):
+        """Rebuild one shop's shard; searches keep using the old shard until it is swapped in"""
+        self.shards[shop["shop_id"]] = self._build_shard(shop)
+        self.result_cache.invalidate_shop(shop["shop_id"])
+        self._update_totals()
+        self.last_built = time.time()
+
+    def shop_generation(self, shop_id):
+        """Changes whenever the shop's searchable data does (None if the shop has no shard)"""
+        shard = self.shards.get(shop_id)
+        return shard["generation"] if shard is not None else None
+
+    def bump_generation(self, shop_id):
+        """Records were changed in place (a sale) - retire the shop's cached results"""
+        shard = self.shards.get(shop_id)
+        if shard is not None:
+            shard["generation"] = next(self._generations)
+            self.result_cache.invalidate_shop(shop_id)
+
+    def search_cached(self, query, shop_id, limit=50, include_debug=True, compute=None):
+        """
+        search() through the result cache; returns (results, cached). compute, if
+        given, replaces the direct search() call on a miss (e.g. single-flight).
+        """
+        query = (query or "").lower().strip()
+        generation = self.shop_generation(shop_id)
+        if generation is None:
+            return self.search(query, shop_id, limit, include_debug), False
+        key = (shop_id, query, limit, include_debug)
+        results = self.result_cache.get(key, generation)
+        if results is not None:
+            return results, True
+        results = compute(generation) if compute else self.search(query, shop_id, limit, include_debug)
+        self.result_cache.put(key, generation, results)
+        return results, False
+
+    @staticmethod
+    def _completion_rank(record):
+        """Prefix match order: the item's sales velocity, then name score (item names above selling units)"""
+        if record.type == "main_item":
+            velocity, name_score = record.sales_velocity, 100
+        else:
+            velocity, name_score = record.item.sales_velocity, 95
+        return (velocity if velocity is not None else -math.inf, name_score)
+
+    def _completions(self, shard, query):
+        """Prefix match keys for query, best first: the precomputed top-k, then the rest ranked on demand"""
+        items_by_id = shard["items_by_id"]
+        rank = lambda key: self._completion_rank(items_by_id[key])
+        keys = shard["prefix_index"].get(query, ())
+        top = shard["completions"].get(query)
+        if top is None:
+            # Narrow prefix - at most SEARCH_COMPLETION_TOP_K keys
+            yield from sorted(keys, key=rank, reverse=True)
+            return
+        yield from top
+        # Only reached when deduplication or a limit above the top-k needs more
+        listed = set(top)
+        yield from sorted((key for key in keys if key not in listed), key=rank, reverse=True)
+
+    def record_sale(self, shop_id, item):
+        """
+        The item's sales velocity went up: move it and its selling units up the
+        top-k lists of their prefixes. Velocities only rise between rebuilds, so
+        a record that is not in a list can only enter it by selling.
+        """
+        shard = self.shards.get(shop_id)
+        if shard is None:
+            return
+        items_by_id = shard["items_by_id"]
+        completions = shard["completions"]
+        rank = lambda key: self._completion_rank(items_by_id[key])
+
+        records = [(f"item_{shop_id}_{item.item_id}", item)]
+        records += [(f"su_{shop_id}_{item.item_id}_{unit.sell_unit_id}", unit) for unit in item.selling_units]
+        for key, record in records:
+            if items_by_id.get(key) is not record or not record.name:
+                continue
+            record_rank = rank(key)
+            prefixes = {word[:i] for word in record.name.lower().split() for i in range(1, len(word) + 1)}
+            for prefix in prefixes:
+                top = completions.get(prefix)
+                if top is None or (key not in top and record_rank <= rank(top[-1])):
+                    continue
+                # Lists are replaced, never mutated, so searches iterating the old one are unaffected
+                completions[prefix] = sorted([other for other in top if other != key] + [key],
+                                             key=rank, reverse=True)[:SEARCH_COMPLETION_TOP_K]
+
+    def lookup_code(self, shop_id, code):
+        """ItemRecord or SellingUnitRecord carrying this barcode / SKU in the shop - O(1) via the shard's code index"""
+        shard = self.shards.get(shop_id)
+        item_key = shard["codes"].get(normalize_code(code)) if shard is not None else None
+        return shard["items_by_id"].get(item_key) if item_key else None
+
+    def get_record(self, shop_id, item_id, sell_unit_id=None):
+        """Cached ItemRecord (or SellingUnitRecord) by id - O(1) via the shop's shard"""
+        shard = self.shards.get(shop_id)
+        if shard is None:
+            return None
+        key = f"su_{shop_id}_{item_id}_{sell_unit_id}" if sell_unit_id else f"item_{shop_id}_{item_id}"
+        return shard["items_by_id"].get(key)
+
+    def drop_shop(self, shop_id):
+        if self.shards.pop(shop_id, None) is not None:
+            self.result_cache.invalidate_shop(shop_id)
+            self._update_totals()
+
+    def _update_totals(self):
+        shards = list(self.shards.values())
+        self.total_items = sum(shard["items"] for shard in shards)
+        self.total_selling_units = sum(shard["selling_units"] for shard in shards)
+
+    def _build_shard(self, shop):
+        shard = {
+            "word_index": defaultdict(list),  # word -> [(item key, score, record)], best score first
+            "prefix_index": defaultdict(set),  # prefix -> set of item keys
+            "completions": {},  # prefix -> top-k item keys, for prefixes with more keys than that
+            "codes": {},  # barcode / SKU -> item key (first record wins if a code is reused)
+            "items_by_id": {},  # item_key -> ItemRecord / SellingUnitRecord (shared with the cache)
+            "bytes": 0,  # shallow size of the word-index entries; records are counted with the cache
+            "items": 0,
+            "selling_units": 0,
+            "generation": next(self._generations)
+        }
+        item_count = 0
+        su_count = 0
+
+        for category in shop.get("categories", []):
+            for item in category.get("items", []):
+                item_count += 1
+
+                # Generate item key
+                item_key = self._generate_item_key(item, category, shop)
+                shard["items_by_id"][item_key] = item
+                for code in item.codes:
+                    shard["codes"].setdefault(code, item_key)
+
+                # Index item name (high score)
+                self._add_to_index(shard, item.name, 100, item_key, item)
+
+                # Index selling units
+                for su in item.selling_units:
+                    su_count += 1
+                    su_key = self._generate_item_key(item, category, shop, True, su)
+                    shard["items_by_id"][su_key] = su
+                    for code in su.codes:
+                        shard["codes"].setdefault(code, su_key)
+
+                    # Index selling unit name (higher score than parent)
+                    if su.name:
+                        self._add_to_index(shard, su.name, 95, su_key, su)
+
+        # Exact word matches are read best score first
+        for entries in shard["word_index"].values():
+            entries.sort(key=lambda entry: entry[1], reverse=True)
+
+        # Broad prefixes (short ones, common words) get a precomputed top-k by sales
+        # velocity, so ranking them costs O(k) per keystroke whatever the catalogue size
+        ranks = {key: self._completion_rank(record) for key, record in shard["items_by_id"].items()}
+        for prefix, keys in shard["prefix_index"].items():
+            if len(keys) > SEARCH_COMPLETION_TOP_K:
+                shard["completions"][prefix] = heapq.nlargest(SEARCH_COMPLETION_TOP_K, keys, key=ranks.__getitem__)
+
+        shard["items"] = item_count
+        shard["selling_units"] = su_count
+        return shard
     
-    def search(self, query, shop_id=None, limit=50):
+    def search(self, query, shop_id=None, limit=50, include_debug=True):
         """Fast search using index - O(1) lookup!"""
         if not query or len(query) < 2:
             return []
         
         query = query.lower().strip()
-        start_time = time.time()
         
-        # Direct word matches (highest relevance)
-        direct_matches = []
-        if query in self.word_index:
-            for match in self.word_index[query]:
-                item_data = match["data"]
-                # Filter by shop if needed
-                if shop_id and item_data.get("shop_id") != shop_id:
-                    continue
-                direct_matches.append({
-                    "score": match["score"],
-                    "data": item_data,
-                    "match_type": "exact_word"
-                })
+        # Every record in a shard belongs to that shop, so no per-record shop filter is needed
+        if shop_id:
+            shard = self.shards.get(shop_id)
+            shards = [shard] if shard else []
+        else:
+            shards = list(self.shards.values())
         
-        # Prefix matches (for partial typing)
-        prefix_matches = []
-        if query in self.prefix_index:
-            for item_key in self.prefix_index[query]:
-                if item_key in self.items_by_id:
-                    item_data = self.items_by_id[item_key]
-                    if shop_id and item_data.get("shop_id") != shop_id:
-                        continue
-                    # Lower score for prefix matches
-                    prefix_matches.append({
-                        "score": 70,
-                        "data": item_data,
-                        "match_type": "prefix"
-                    })
-        
-        # Combine and deduplicate
+        # Matches are only materialised while they can still make the first `limit`
+        # results: a short prefix or a common word can hit thousands of keys, and
+        # scoring, deduplicating and sorting all of them dominated each keystroke.
         seen_keys = set()
         combined = []
         
-        for match in direct_matches + prefix_matches:
-            key = match["data"].get("sell_unit_id") or match["data"].get("item_id")
-            if key not in seen_keys:
-                seen_keys.add(key)
-                combined.append(match)
+        # Direct word matches (highest relevance); each word's entries are stored
+        # best score first, so a shard contributes at most `limit` of them.
+        # Deduplicated by index key - a record matches once even if a word repeats
+        for shard in shards:
+            shard_matches = 0
+            for item_key, score, item_data in shard["word_index"].get(query, ()):
+                if shard_matches >= limit:
+                    break
+                if item_key not in seen_keys:
+                    seen_keys.add(item_key)
+                    combined.append({
+                        "score": score,
+                        "data": item_data,
+                        "match_type": "exact_word"
+                    })
+                    shard_matches += 1
         
         # Sort by score descending
         combined.sort(key=lambda x: x["score"], reverse=True)
         
+        # Prefix matches (for partial typing) all rank below direct ones; best sellers first
+        for shard in shards:
+            if len(combined) >= limit:
+                break
+            items_by_id = shard["items_by_id"]
+            for item_key in self._completions(shard, query):
+                item_data = items_by_id.get(item_key)
+                if item_data is None:
+                    continue
+                if item_key not in seen_keys:
+                    seen_keys.add(item_key)
+                    # Lower score for prefix matches
+                    combined.append({
+                        "score": 70,
+                        "data": item_data,
+                        "match_type": "prefix"
+                    })
+                    if len(combined) >= limit:
+                        break
+        
         # Convert to response format
-        results = []
-        for match in combined[:limit]:
-            item_data = match["data"]
-            
-            if item_data["type"] == "main_item":
-                # Format main item with batch info
-                result_item = self._format_main_item(item_data, match)
-            else:
-                # Format selling unit
-                result_item = self._format_selling_unit(item_data, match)
-            
-            results.append(result_item)
+        return [self.format_match(match, include_debug) for match in combined[:limit]]
+    
+    def format_match(self, match, include_debug=True):
+        """Response shape of one match ({"score", "data": record, "match_type"}) - shared with /scan"""
+        item_data = match["data"]
         
-        search_time = (time.time() - start_time) * 1000
-        print(f"⚡ Index search: '{query}' found {len(results)} items in {search_time:.1f}ms")
+        if item_data.type == "main_item":
+            # Format main item with batch info
+            result_item = self._format_main_item(item_data, match)
+        else:
+            # Format selling unit
+            result_item = self._format_selling_unit(item_data, match)
         
-        return results
+        if not include_debug:
+            result_item.pop("debug", None)
+        
+        return result_item
     
-    def _format_main_item(self, item_data, match):
+    def _format_main_item(self, item, match):
         """Format main item for response"""
-        item = item_data["original_item"]
-        batches = item.get("batches", [])
-        
-        # Find best batch
-        best_batch = None
-        if batches:
-            # Sort by timestamp (FIFO)
-            sorted_batches = sorted(batches, key=lambda b: b.get("timestamp", 0))
-            for batch in sorted_batches:
-                if batch.get("quantity", 0) >= 0.999999:
-                    best_batch = batch
-                    break
-            if not best_batch and sorted_batches:
-                best_batch = sorted_batches[0]
+        # Oldest batch with a whole unit (FIFO), from the item's derived availability
+        best_batch = item.availability.first_sellable
         
         if best_batch:
-            batch_qty = float(best_batch.get("quantity", 0))
+            batch_qty = float(best_batch.quantity)
             batch_status = "active_healthy" if batch_qty > 3 else "active_low_stock" if batch_qty >= 1 else "exhausted"
             
             return {
                 "type": "main_item",
-                "item_id": item_data["item_id"],
-                "main_item_id": item_data["item_id"],
-                "category_id": item_data["category_id"],
-                "category_name": item_data["category_name"],
-                "name": item_data["name"],
-                "display_name": item_data["name"],
-                "thumbnail": item_data["thumbnail"],
+                "item_id": item.item_id,
+                "main_item_id": item.item_id,
+                "category_id": item.category_id,
+                "category_name": item.category_name,
+                "name": item.name,
+                "display_name": item.name,
+                "thumbnail": item.thumbnail,
                 "batch_status": batch_status,
-                "batch_id": best_batch.get("batch_id"),
-                "batch_name": best_batch.get("batch_name", "Batch"),
+                "batch_id": best_batch.batch_id,
+                "batch_name": best_batch.batch_name,
                 "batch_remaining": batch_qty,
                 "real_available": batch_qty,
-                "price": round(float(best_batch.get("sell_price", 0)), 2),
-                "base_unit": best_batch.get("unit", item_data["base_unit"]),
+                "price": round(float(best_batch.sell_price), 2),
+                "base_unit": best_batch.unit,
                 "can_fulfill": batch_qty >= 0.999999,
                 "unit_type": "base",
                 "search_score": match["score"],
@@ -318,13 +1382,13 @@ class SearchIndex:
         # Fallback if no batch
         return {
             "type": "main_item",
-            "item_id": item_data["item_id"],
-            "main_item_id": item_data["item_id"],
-            "category_id": item_data["category_id"],
-            "category_name": item_data["category_name"],
-            "name": item_data["name"],
-            "display_name": item_data["name"],
-            "thumbnail": item_data["thumbnail"],
+            "item_id": item.item_id,
+            "main_item_id": item.item_id,
+            "category_id": item.category_id,
+            "category_name": item.category_name,
+            "name": item.name,
+            "display_name": item.name,
+            "thumbnail": item.thumbnail,
             "batch_status": "no_batches",
             "batch_id": None,
             "batch_remaining": 0,
@@ -339,52 +1403,44 @@ class SearchIndex:
             }
         }
     
-    def _format_selling_unit(self, item_data, match):
+    def _format_selling_unit(self, unit, match):
         """Format selling unit for response"""
-        su = item_data["original_su"]
-        batches = item_data["batches"]
-        conversion = float(item_data["conversion_factor"])
+        item = unit.item
+        conversion = float(unit.conversion_factor)
         
-        # Calculate available units from batches
-        available_units = 0
-        best_batch = None
-        if batches:
-            sorted_batches = sorted(batches, key=lambda b: b.get("timestamp", 0))
-            for batch in sorted_batches:
-                batch_qty = float(batch.get("quantity", 0))
-                if batch_qty > 0:
-                    available_units += batch_qty * conversion
-                    if not best_batch:
-                        best_batch = batch
+        # Available units and FIFO batch come from the parent's derived availability
+        availability = item.availability
+        available_units = availability.units_available(conversion)
+        best_batch = availability.first_available
         
         batch_status = "active_healthy" if available_units > 10 else "active_low_stock" if available_units >= 1 else "out_of_stock"
         
         # Calculate price per unit
         unit_price = 0
         if best_batch and conversion > 0:
-            unit_price = float(best_batch.get("sell_price", 0)) / conversion
+            unit_price = float(best_batch.sell_price) / conversion
         
         return {
             "type": "selling_unit",
-            "item_id": item_data["item_id"],
-            "main_item_id": item_data["item_id"],
-            "sell_unit_id": item_data["sell_unit_id"],
-            "category_id": item_data["category_id"],
-            "category_name": item_data["category_name"],
-            "name": su.get("name", ""),
-            "display_name": su.get("name", ""),
-            "parent_item_name": item_data["original_item"]["name"],
-            "thumbnail": item_data["thumbnail"],
+            "item_id": item.item_id,
+            "main_item_id": item.item_id,
+            "sell_unit_id": unit.sell_unit_id,
+            "category_id": item.category_id,
+            "category_name": item.category_name,
+            "name": unit.name,
+            "display_name": unit.name,
+            "parent_item_name": item.name,
+            "thumbnail": unit.thumbnail or item.thumbnail,
             "batch_status": batch_status,
-            "batch_id": best_batch.get("batch_id") if best_batch else None,
-            "batch_name": best_batch.get("batch_name", "Batch") if best_batch else None,
+            "batch_id": best_batch.batch_id if best_batch else None,
+            "batch_name": best_batch.batch_name if best_batch else None,
             "real_available_units": available_units,
             "price": round(unit_price, 4),
             "available_stock": available_units,
             "conversion_factor": conversion,
-            "base_unit": best_batch.get("unit", "unit") if best_batch else "unit",
+            "base_unit": best_batch.unit if best_batch else "unit",
             "can_fulfill": available_units > 0.000001,
-            "has_batch_links": item_data["has_batch_links"],
+            "has_batch_links": unit.has_batch_links,
             "unit_type": "selling_unit",
             "search_score": match["score"],
             "matched_by": match["match_type"],
@@ -404,163 +1460,1355 @@ search_index = SearchIndex()
 # ======================================================
 embedding_cache_full = {
     "shops": [],
+    "shops_by_id": {},  # shop_id -> shop entry (same objects as "shops")
+    "shop_stats": {},  # shop_id -> counters maintained on refresh
+    "batch_stats": {},  # platform-wide counters maintained on refresh
+    "generation": 0,  # bumped on every refresh - used for ETags
     "last_updated": None,
     "total_shops": 0
 }
 
-def refresh_full_item_cache():
-    """REVISED: Includes ALL items with BATCH tracking and selling units with batch links"""
-    start = time.time()
-    print("\n[INFO] Refreshing FULL shop cache (with batch tracking)...")
+def _empty_batch_stats():
+    return {
+        "total_items": 0,
+        "total_selling_units": 0,
+        "total_batches": 0,
+        "items_with_batches": 0,
+        "items_without_batches": 0
+    }
 
-    shops_result = []
+def _finalize_batch_stats(stats):
+    """Add derived percentage to a counters dict"""
+    counted = stats["items_with_batches"] + stats["items_without_batches"]
+    stats["percentage_with_batches"] = round(stats["items_with_batches"] / counted * 100, 1) if counted > 0 else 0
+    return stats
 
-    for shop_doc in db.collection("Shops").stream():
-        shop_id = shop_doc.id
-        shop_data = shop_doc.to_dict()
+def cache_etag(*parts):
+    """Strong ETag for a view of the cache; changes whenever the cache is rebuilt"""
+    key = f"{embedding_cache_full['generation']}:{embedding_cache_full['last_updated']}:" + ":".join(str(p) for p in parts)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
 
-        shop_entry = {
-            "shop_id": shop_id,
-            "shop_name": shop_data.get("name", ""),
-            "categories": []
+def get_shop_from_cache(shop_id):
+    """O(1) shop lookup in the cache"""
+    return embedding_cache_full["shops_by_id"].get(shop_id)
+
+def _load_item_entry(shop_id, category_entry, item_doc):
+    """One item's cache entry with its batches and selling units; returns (entry, reads)"""
+    reads = 0
+    cat_id = category_entry["category_id"]
+    item_data = item_doc.to_dict()
+    item_id = item_doc.id
+    item_name = item_data.get("name", "Unnamed")
+
+    # EMBEDDINGS FETCHING - DISABLED (ItemRecord exports an empty list)
+
+    # Get batches for this item
+    batches = item_data.get("batches", [])
+    processed_batches = []
+    for batch in batches:
+        processed_batches.append(BatchRecord(
+            batch_id=batch.get("id", f"batch_{int(time.time()*1000)}"),
+            batch_name=batch.get("batchName", batch.get("batch_name", "Batch")),
+            quantity=float(batch.get("quantity", 0)),
+            unit=batch.get("unit", "unit"),
+            buy_price=float(batch.get("buyPrice", 0) or batch.get("buy_price", 0)),
+            sell_price=float(batch.get("sellPrice", 0) or batch.get("sell_price", 0)),
+            timestamp=batch.get("timestamp", 0),
+            date=batch.get("date", ""),
+            added_by=batch.get("addedBy", ""),
+            selling_unit_allocations=batch.get("sellingUnitAllocations", {})
+        ))
+
+    # Get selling units for this item
+    selling_units = []
+    try:
+        sell_units_ref = db.collection("Shops").document(shop_id) \
+            .collection("categories").document(cat_id) \
+            .collection("items").document(item_id) \
+            .collection("sellUnits")
+        
+        sell_units_docs = fs.stream(sell_units_ref)
+        reads += len(sell_units_docs)
+        
+        for sell_unit_doc in sell_units_docs:
+            sell_unit_data = sell_unit_doc.to_dict()
+            sell_unit_id = sell_unit_doc.id
+            
+            # Batch links are kept for export only - availability derives from the parent's batches
+            batch_links = sell_unit_data.get("batchLinks", [])
+            
+            selling_units.append(SellingUnitRecord(
+                sell_unit_id=sell_unit_doc.id,
+                name=sell_unit_data.get("name", ""),
+                conversion_factor=float(sell_unit_data.get("conversionFactor", 1.0)),
+                sell_price=float(sell_unit_data.get("sellPrice", 0.0)),
+                images=sell_unit_data.get("images", []),
+                is_base_unit=sell_unit_data.get("isBaseUnit", False),
+                thumbnail=sell_unit_data.get("images", [None])[0] if sell_unit_data.get("images") else None,
+                created_at=sell_unit_data.get("createdAt"),
+                updated_at=sell_unit_data.get("updatedAt"),
+                batch_links=batch_links,
+                has_batch_links=len(batch_links) > 0,
+                codes=document_codes(sell_unit_data)
+            ))
+        
+    except Exception as e:
+        log_event("selling_units_fetch_failed", logging.ERROR, shop_id=shop_id, item_id=item_id, error=str(e))
+
+    # Calculate total stock from batches
+    total_stock_from_batches = sum(batch.get("quantity", 0) for batch in batches)
+    main_stock = float(item_data.get("stock", 0) or 0)
+    effective_stock = total_stock_from_batches if total_stock_from_batches > 0 else main_stock
+    
+    item_entry = ItemRecord(
+        item_id=item_doc.id,
+        name=item_data.get("name", ""),
+        thumbnail=item_data.get("images", [None])[0],
+        sell_price=float(item_data.get("sellPrice", 0) or 0),
+        buy_price=float(item_data.get("buyPrice", 0) or 0),
+        stock=effective_stock,
+        base_unit=item_data.get("baseUnit", "unit"),
+        selling_units=selling_units,
+        category_id=category_entry["category_id"],
+        category_name=category_entry["category_name"],
+        batches=processed_batches,
+        total_stock_from_batches=total_stock_from_batches,
+        codes=document_codes(item_data),
+        sales_velocity=sales_velocity_from_transactions(item_data.get("stockTransactions"))
+    )
+    return item_entry, reads
+
+def _load_shop_entry(shop_doc):
+    """One shop's full cache entry (categories, items, batches, selling units); returns (entry, reads)"""
+    reads = 0
+    shop_id = shop_doc.id
+    shop_data = shop_doc.to_dict()
+
+    shop_entry = {
+        "shop_id": shop_id,
+        "shop_name": shop_data.get("name", ""),
+        "categories": [],
+        "category_ids": []
+    }
+
+    for cat_doc in fs.stream(shop_doc.reference.collection("categories")):
+        reads += 1
+        cat_data = cat_doc.to_dict()
+        cat_id = cat_doc.id
+
+        category_entry = {
+            "category_id": _intern(cat_id),
+            "category_name": _intern(cat_data.get("name", "")),
+            "items": []
         }
 
-        for cat_doc in shop_doc.reference.collection("categories").stream():
-            cat_data = cat_doc.to_dict()
-            cat_id = cat_doc.id
+        for item_doc in fs.stream(cat_doc.reference.collection("items")):
+            reads += 1
+            item_entry, item_reads = _load_item_entry(shop_id, category_entry, item_doc)
+            reads += item_reads
+            category_entry["items"].append(item_entry)
 
-            category_entry = {
-                "category_id": cat_id,
-                "category_name": cat_data.get("name", ""),
-                "items": []
-            }
+        shop_entry["category_ids"].append(cat_id)  # empty categories too - their items are listened to
+        if category_entry["items"]:
+            shop_entry["categories"].append(category_entry)
 
-            for item_doc in cat_doc.reference.collection("items").stream():
-                item_data = item_doc.to_dict()
-                item_id = item_doc.id
-                item_name = item_data.get("name", "Unnamed")
-
-                # EMBEDDINGS FETCHING - DISABLED
-                embeddings = []
-
-                # Get batches for this item
-                batches = item_data.get("batches", [])
-                processed_batches = []
-                for batch in batches:
-                    processed_batches.append({
-                        "batch_id": batch.get("id", f"batch_{int(time.time()*1000)}"),
-                        "batch_name": batch.get("batchName", batch.get("batch_name", "Batch")),
-                        "quantity": float(batch.get("quantity", 0)),
-                        "remaining_quantity": float(batch.get("quantity", 0)),
-                        "unit": batch.get("unit", "unit"),
-                        "buy_price": float(batch.get("buyPrice", 0) or batch.get("buy_price", 0)),
-                        "sell_price": float(batch.get("sellPrice", 0) or batch.get("sell_price", 0)),
-                        "timestamp": batch.get("timestamp", 0),
-                        "date": batch.get("date", ""),
-                        "added_by": batch.get("addedBy", ""),
-                        "selling_unit_allocations": batch.get("sellingUnitAllocations", {})
-                    })
+    shop_entry["detail"] = "full"
+    return shop_entry, reads
 
-                # Get selling units for this item
-                selling_units = []
-                try:
-                    sell_units_ref = db.collection("Shops").document(shop_id) \
-                        .collection("categories").document(cat_id) \
-                        .collection("items").document(item_id) \
-                        .collection("sellUnits")
-                    
-                    sell_units_docs = list(sell_units_ref.stream())
-                    
-                    for sell_unit_doc in sell_units_docs:
-                        sell_unit_data = sell_unit_doc.to_dict()
-                        sell_unit_id = sell_unit_doc.id
-                        
-                        # Get batch links
-                        batch_links = sell_unit_data.get("batchLinks", [])
-                        total_units_available = 0
-                        
-                        for link in batch_links:
-                            total_units_available += link.get("maxUnitsAvailable", 0) - link.get("allocatedUnits", 0)
-                        
-                        selling_units.append({
-                            "sell_unit_id": sell_unit_doc.id,
-                            "name": sell_unit_data.get("name", ""),
-                            "conversion_factor": float(sell_unit_data.get("conversionFactor", 1.0)),
-                            "sell_price": float(sell_unit_data.get("sellPrice", 0.0)),
-                            "images": sell_unit_data.get("images", []),
-                            "is_base_unit": sell_unit_data.get("isBaseUnit", False),
-                            "thumbnail": sell_unit_data.get("images", [None])[0] if sell_unit_data.get("images") else None,
-                            "created_at": sell_unit_data.get("createdAt"),
-                            "updated_at": sell_unit_data.get("updatedAt"),
-                            "batch_links": batch_links,
-                            "total_units_available": total_units_available,
-                            "has_batch_links": len(batch_links) > 0
-                        })
-                    
-                except Exception as e:
-                    print(f"❌ ERROR fetching selling units: {e}")
-
-                # Calculate total stock from batches
-                total_stock_from_batches = sum(batch.get("quantity", 0) for batch in batches)
-                main_stock = float(item_data.get("stock", 0) or 0)
-                effective_stock = total_stock_from_batches if total_stock_from_batches > 0 else main_stock
-                
-                category_entry["items"].append({
-                    "item_id": item_doc.id,
-                    "name": item_data.get("name", ""),
-                    "thumbnail": item_data.get("images", [None])[0],
-                    "sell_price": float(item_data.get("sellPrice", 0) or 0),
-                    "buy_price": float(item_data.get("buyPrice", 0) or 0),
-                    "stock": effective_stock,
-                    "base_unit": item_data.get("baseUnit", "unit"),
-                    "embeddings": embeddings,
-                    "has_embeddings": False,
-                    "selling_units": selling_units,
-                    "category_id": category_entry["category_id"],
-                    "category_name": category_entry["category_name"],
-                    "batches": processed_batches,
-                    "has_batches": len(processed_batches) > 0,
-                    "total_stock_from_batches": total_stock_from_batches
-                })
-
-            if category_entry["items"]:
-                shop_entry["categories"].append(category_entry)
+def _shop_batch_stats(shop):
+    """Counters for one shop entry (kept per shop so loads and patches never traverse other shops)"""
+    stats = _empty_batch_stats()
+    for category in shop["categories"]:
+        for item in category["items"]:
+            stats["total_items"] += 1
+            stats["total_selling_units"] += len(item.get("selling_units", []))
+            stats["total_batches"] += len(item.get("batches", []))
+            if item.get("has_batches"):
+                stats["items_with_batches"] += 1
+            else:
+                stats["items_without_batches"] += 1
+    return _finalize_batch_stats(stats)
+
+def _publish_shops(shops_by_id, shop_stats):
+    """Swap in new shop maps wholesale (callers hold _cache_swap_lock)"""
+    platform_stats = _empty_batch_stats()
+    for stats in shop_stats.values():
+        for key in platform_stats:
+            platform_stats[key] += stats[key]
+
+    embedding_cache_full["shops"] = list(shops_by_id.values())
+    embedding_cache_full["shops_by_id"] = shops_by_id
+    embedding_cache_full["shop_stats"] = shop_stats
+    embedding_cache_full["batch_stats"] = _finalize_batch_stats(platform_stats)
+    embedding_cache_full["total_shops"] = len(shops_by_id)
+    embedding_cache_full["last_updated"] = time.time()
+    embedding_cache_full["generation"] += 1
+
+def refresh_full_item_cache():
+    """Load every shop on the platform (CACHE_PRELOAD_ALL_SHOPS and benchmarks; shops normally load lazily)"""
+    start = time.time()
+    log_event("cache_refresh_started")
+
+    shops_result = []
+    reads = 0
 
+    for shop_doc in fs.stream(db.collection("Shops")):
+        reads += 1
+        shop_entry, shop_reads = _load_shop_entry(shop_doc)
+        reads += shop_reads
         if shop_entry["categories"]:
             shops_result.append(shop_entry)
 
-    embedding_cache_full["shops"] = shops_result
-    embedding_cache_full["total_shops"] = len(shops_result)
-    embedding_cache_full["last_updated"] = time.time()
+    # Maintain counters once per refresh so endpoints never traverse the cache
+    shop_stats = {shop["shop_id"]: _shop_batch_stats(shop) for shop in shops_result}
+    with _cache_swap_lock:
+        _publish_shops({shop["shop_id"]: shop for shop in shops_result}, shop_stats)
+    platform_stats = embedding_cache_full["batch_stats"]
 
     # Build search index after cache refresh
     search_index.build(shops_result)
 
-    # Cache statistics
-    total_main_items = 0
-    total_selling_units = 0
-    total_batches = 0
+    reset_cache_memory(shops_result)
+
+    # Shops that disappeared stop listening; loaded ones start (and count as just used)
+    for shop_id in list(shop_watches):
+        if shop_id not in embedding_cache_full["shops_by_id"]:
+            with _shop_locks[shop_id]:
+                _unwatch_shop(shop_id)
     for shop in shops_result:
-        for category in shop["categories"]:
-            total_main_items += len(category["items"])
-            for item in category["items"]:
-                total_selling_units += len(item.get("selling_units", []))
-                total_batches += len(item.get("batches", []))
+        with _shop_locks[shop["shop_id"]]:
+            _sync_shop_watches(shop)
+        _touch_shop(shop["shop_id"])
 
-    print(f"\n[READY] Cached {len(shops_result)} shops, {total_main_items} main items, {total_selling_units} selling units, {total_batches} batches")
-    print(f"[TIME] Cache refresh took {round((time.time()-start)*1000,2)}ms")
+    enforce_cache_budget()
+
+    observe_histogram("cache_rebuild_duration_seconds", time.time() - start, REBUILD_BUCKETS)
+    log_event(
+        "cache_refreshed",
+        duration_ms=round((time.time() - start) * 1000, 2),
+        shops=len(shops_result),
+        main_items=platform_stats["total_items"],
+        selling_units=platform_stats["total_selling_units"],
+        batches=platform_stats["total_batches"],
+        cache_mb=round(cache_memory["total_bytes"] / 1024 / 1024, 2),
+        firestore_reads=reads
+    )
     
     return shops_result
 
-def on_full_item_snapshot(col_snapshot, changes, read_time):
-    """Listener for changes to main items"""
-    print("[LISTENER] Main items changed → refreshing FULL cache")
-    refresh_full_item_cache()
+def on_selling_units_snapshot(changes):
+    """Selling units have no per-shop field to filter on, so one collection-group listener routes
+    changes to the parent item of shops that are resident; other shops are ignored"""
+    record_listener_event("sellUnits", changes)
+    parents = defaultdict(set)  # (shop_id, category_id) -> item ids
+    for change in changes:
+        # Shops/{shop}/categories/{category}/items/{item}/sellUnits/{unit}
+        path = change.document.reference.path.split("/")
+        if len(path) == 8 and path[1] in embedding_cache_full["shops_by_id"]:
+            parents[(path[1], path[3])].add(path[5])
 
-def on_selling_units_snapshot(col_snapshot, changes, read_time):
-    """Listener for changes to selling units"""
-    print("[LISTENER] Selling units changed → refreshing FULL cache")
-    refresh_full_item_cache()
+    for (shop_id, category_id), item_ids in parents.items():
+        refresh_shop_items(shop_id, category_id, item_ids)
+
+# ======================================================
+# CACHE MEMORY BUDGET (per-shop accounting, cold shops compacted)
+# ======================================================
+CACHE_MEMORY_BUDGET_MB = float(os.environ.get("CACHE_MEMORY_BUDGET_MB", 256))  # 0 disables eviction
+SHOP_COLD_AFTER_SECONDS = float(os.environ.get("SHOP_COLD_AFTER_SECONDS", 6 * 3600))
+
+# Fields search never reads; dropped from cold shops and reloaded from Firestore on demand
+COMPACT_DROP_FIELDS = {
+    "item": ("buy_price",),
+    "batch": ("buy_price", "date", "added_by", "selling_unit_allocations"),
+    "selling_unit": ("images", "is_base_unit", "created_at", "updated_at", "batch_links"),
+}
+
+cache_memory = {
+    "by_shop": {},  # shop_id -> {"cache_bytes", "measured_at"}
+    "total_bytes": 0,
+    "evictions": 0,
+    "reloads": 0
+}
+cache_memory_lock = threading.Lock()
+shop_activity = {}  # shop_id -> unix time of the last sale or detail reload
+
+class _ShopLocks:
+    """shop_id -> lock held while that shop is loaded, patched or evicted; an entry lives only while someone holds it"""
+
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+        self._mutex = threading.Lock()
+
+    def __getitem__(self, shop_id):
+        with self._mutex:
+            lock = self._locks.get(shop_id)
+            if lock is None:
+                lock = self._locks[shop_id] = threading.Lock()
+            return lock
+
+    def __len__(self):
+        return len(self._locks)
+
+_shop_locks = _ShopLocks()
+
+def deep_sizeof(obj):
+    """Approximate deep size in bytes of a cache entry (records, dicts, lists and scalars; shared objects counted once)"""
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+        if isinstance(current, CacheRecord):
+            stack.extend(getattr(current, name) for name in current.__slots__ if hasattr(current, name))
+        elif isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set)):
+            stack.extend(current)
+    return total
+
+def measure_shop(shop):
+    """Re-measure one shop and adjust the running total by the difference"""
+    size = deep_sizeof(shop)
+    with cache_memory_lock:
+        previous = cache_memory["by_shop"].get(shop["shop_id"])
+        cache_memory["total_bytes"] += size - (previous["cache_bytes"] if previous else 0)
+        cache_memory["by_shop"][shop["shop_id"]] = {"cache_bytes": size, "measured_at": time.time()}
+    return size
+
+def adjust_shop_memory(shop_id, delta):
+    """Incremental update after a patch that changed only some items"""
+    with cache_memory_lock:
+        entry = cache_memory["by_shop"].setdefault(shop_id, {"cache_bytes": 0, "measured_at": None})
+        entry["cache_bytes"] += delta
+        entry["measured_at"] = time.time()
+        cache_memory["total_bytes"] += delta
+
+def forget_shop_memory(shop_id):
+    with cache_memory_lock:
+        entry = cache_memory["by_shop"].pop(shop_id, None)
+        if entry:
+            cache_memory["total_bytes"] -= entry["cache_bytes"]
+
+def reset_cache_memory(shops):
+    """Fresh accounting after a full refresh (shops that disappeared drop out)"""
+    with cache_memory_lock:
+        cache_memory["by_shop"] = {}
+        cache_memory["total_bytes"] = 0
+    for shop in shops:
+        measure_shop(shop)
+
+def touch_shop_activity(shop_id):
+    shop_activity[shop_id] = time.time()
+
+def _compact_shop(shop):
+    """Drop detail-only fields in place; search records share these dicts and keep working"""
+    for category in shop["categories"]:
+        for item in category["items"]:
+            for field in COMPACT_DROP_FIELDS["item"]:
+                item.pop(field, None)
+            for batch in item.get("batches", []):
+                for field in COMPACT_DROP_FIELDS["batch"]:
+                    batch.pop(field, None)
+            for sell_unit in item.get("selling_units", []):
+                for field in COMPACT_DROP_FIELDS["selling_unit"]:
+                    sell_unit.pop(field, None)
+    shop["detail"] = "compact"
+
+def enforce_cache_budget():
+    """Compact cold shops, least recently active first, until the cache fits the budget"""
+    if CACHE_MEMORY_BUDGET_MB <= 0:
+        return 0
+    budget = CACHE_MEMORY_BUDGET_MB * 1024 * 1024
+    if cache_memory["total_bytes"] <= budget:
+        return 0
+
+    cold_before = time.time() - SHOP_COLD_AFTER_SECONDS
+    candidates = sorted(
+        (shop for shop in embedding_cache_full["shops"]
+         if shop.get("detail") == "full" and shop_activity.get(shop["shop_id"], 0) < cold_before),
+        key=lambda shop: shop_activity.get(shop["shop_id"], 0)
+    )
+
+    compacted = 0
+    freed = 0
+    for shop in candidates:
+        if cache_memory["total_bytes"] <= budget:
+            break
+        with _shop_locks[shop["shop_id"]]:
+            before = cache_memory["by_shop"].get(shop["shop_id"], {}).get("cache_bytes", 0)
+            _compact_shop(shop)
+            freed += before - measure_shop(shop)
+        compacted += 1
+
+    if compacted:
+        with cache_memory_lock:
+            cache_memory["evictions"] += compacted
+        inc_counter("cache_shop_compactions_total", compacted)
+        log_event(
+            "cache_budget_enforced",
+            compacted_shops=compacted,
+            freed_mb=round(freed / 1024 / 1024, 2),
+            total_mb=round(cache_memory["total_bytes"] / 1024 / 1024, 2),
+            budget_mb=CACHE_MEMORY_BUDGET_MB
+        )
+    return compacted
+
+def get_shop_detail(shop_id):
+    """Shop entry with full detail, loading the shop or reloading a compacted one from Firestore first"""
+    shop = ensure_shop_loaded(shop_id)
+    if not shop or shop.get("detail") != "compact" or db is None:
+        return shop
+
+    with _shop_locks[shop_id]:
+        shop = get_shop_from_cache(shop_id)
+        if shop is not None and shop.get("detail") == "compact":  # another request may have reloaded it while we waited
+            shop = _load_and_install_shop(shop_id, reason="detail")
+            if shop is not None:
+                touch_shop_activity(shop_id)
+                with cache_memory_lock:
+                    cache_memory["reloads"] += 1
+                inc_counter("cache_shop_reloads_total")
+
+    enforce_cache_budget()
+    return shop
+
+def cache_memory_summary(top=10):
+    """Budget, totals and the largest shops for /debug-cache"""
+    by_shop = cache_memory["by_shop"]
+    largest = sorted(by_shop.items(), key=lambda entry: entry[1]["cache_bytes"], reverse=True)[:top]
+    return {
+        "budget_mb": CACHE_MEMORY_BUDGET_MB,
+        "cold_after_seconds": SHOP_COLD_AFTER_SECONDS,
+        "total_mb": round(cache_memory["total_bytes"] / 1024 / 1024, 2),
+        "search_index_mb": round(sum(search_index.bytes_by_shop.values()) / 1024 / 1024, 2),
+        "shops_measured": len(by_shop),
+        "compact_shops": sum(1 for shop in embedding_cache_full["shops"] if shop.get("detail") == "compact"),
+        "evictions": cache_memory["evictions"],
+        "reloads": cache_memory["reloads"],
+        "largest_shops": [{
+            "shop_id": shop_id,
+            "cache_kb": round(entry["cache_bytes"] / 1024, 1),
+            "search_index_kb": round(search_index.bytes_by_shop.get(shop_id, 0) / 1024, 1),
+            "detail": (get_shop_from_cache(shop_id) or {}).get("detail"),
+            "last_activity": shop_activity.get(shop_id)
+        } for shop_id, entry in largest]
+    }
+
+# ======================================================
+# SHOP CACHE TIERS (lazy per-shop loading, listeners while hot, LRU/TTL eviction)
+# ======================================================
+CACHE_PRELOAD_ALL_SHOPS = os.environ.get("CACHE_PRELOAD_ALL_SHOPS", "0") == "1"
+SHOP_CACHE_MAX_SHOPS = int(os.environ.get("SHOP_CACHE_MAX_SHOPS", 500))  # 0 = no cap
+SHOP_CACHE_IDLE_SECONDS = float(os.environ.get("SHOP_CACHE_IDLE_SECONDS", 1800))  # 0 = never expire
+SHOP_CACHE_SWEEP_SECONDS = 60
+MISSING_SHOP_TTL_SECONDS = float(os.environ.get("MISSING_SHOP_TTL_SECONDS", 30))  # negative cache for unknown shop ids
+
+shop_last_access = OrderedDict()  # shop_id -> unix time of last request, least recently used first
+shop_watches = {}  # shop_id -> {"categories": watch, "items": {category_id: watch}}
+_lru_lock = threading.Lock()
+_cache_swap_lock = threading.Lock()  # serializes swaps of embedding_cache_full's shop maps
+missing_shops = TTLCache(maxsize=10000, ttl=MISSING_SHOP_TTL_SECONDS)  # shop ids with no Shops doc
+_missing_shops_lock = threading.Lock()
+
+def _touch_shop(shop_id):
+    with _lru_lock:
+        shop_last_access[shop_id] = time.time()
+        shop_last_access.move_to_end(shop_id)
+
+def _install_shop(shop, memory_delta=None):
+    """Swap one shop's entry, counters, search shard and memory accounting into the cache"""
+    shop_id = shop["shop_id"]
+    stats = _shop_batch_stats(shop)
+    # Shard first: a request that sees the shop resident must find it searchable
+    search_index.build_shop(shop)
+    with _cache_swap_lock:
+        shops_by_id = dict(embedding_cache_full["shops_by_id"])
+        shops_by_id[shop_id] = shop
+        shop_stats = dict(embedding_cache_full["shop_stats"])
+        shop_stats[shop_id] = stats
+        _publish_shops(shops_by_id, shop_stats)
+    if memory_delta is None:
+        measure_shop(shop)
+    else:
+        adjust_shop_memory(shop_id, memory_delta)
+
+def _load_and_install_shop(shop_id, reason):
+    """Fetch one shop from Firestore and make it resident (caller holds _shop_locks[shop_id])"""
+    start = time.time()
+    try:
+        shop_doc = fs.get(db.collection("Shops").document(shop_id))
+        if not shop_doc.exists:
+            with _missing_shops_lock:
+                missing_shops[shop_id] = True
+            return None
+        shop, reads = _load_shop_entry(shop_doc)
+    except Exception as e:
+        log_event("shop_load_failed", logging.ERROR, exc_info=True, shop_id=shop_id, reason=reason, error=str(e))
+        return None
+
+    _install_shop(shop)
+    _sync_shop_watches(shop)
+    if cache_bus is not None:
+        cache_bus.hold([shop_id])  # followers: have the leader listen to it
+    inc_counter("shop_cache_loads_total", reason=reason)
+    observe_histogram("shop_cache_load_duration_seconds", time.time() - start, REBUILD_BUCKETS)
+    log_event(
+        "shop_loaded",
+        shop_id=shop_id,
+        reason=reason,
+        main_items=embedding_cache_full["shop_stats"][shop_id]["total_items"],
+        firestore_reads=reads + 1,
+        duration_ms=round((time.time() - start) * 1000, 2)
+    )
+    return shop
+
+def ensure_shop_loaded(shop_id):
+    """Resident shop entry, loaded on first use; concurrent callers share a single Firestore fetch"""
+    shop = get_shop_from_cache(shop_id)
+    if shop is not None:
+        _touch_shop(shop_id)
+        return shop
+    if db is None or not shop_id:
+        return None
+    with _missing_shops_lock:
+        if shop_id in missing_shops:
+            return None  # unknown id seen recently - skip the Firestore read
+
+    with _shop_locks[shop_id]:
+        shop = get_shop_from_cache(shop_id)
+        if shop is None:  # first caller loads; the others waited on the lock and find it resident
+            shop = _load_and_install_shop(shop_id, reason="first_use")
+    if shop is None:
+        return None
+
+    _touch_shop(shop_id)
+    _evict_over_capacity()
+    enforce_cache_budget()
+    return shop
+
+def _skip_initial_snapshot(handler):
+    """Snapshot callback that ignores the initial snapshot - the shop was just loaded from the same documents"""
+    state = {"initial": True}
+
+    def callback(col_snapshot, changes, read_time):
+        if state["initial"]:
+            state["initial"] = False
+            return
+        handler(changes)
+    return callback
+
+def _sync_shop_watches(shop):
+    """Listen to the shop's categories and each category's items while it is resident (caller holds its lock)"""
+    if not owns_catalogue_listeners():
+        return
+    shop_id = shop["shop_id"]
+    categories_ref = db.collection("Shops").document(shop_id).collection("categories")
+    watches = shop_watches.setdefault(shop_id, {"categories": None, "items": {}})
+
+    if watches["categories"] is None:
+        watches["categories"] = categories_ref.on_snapshot(
+            _skip_initial_snapshot(lambda changes: on_shop_categories_snapshot(shop_id, changes)))
+
+    category_ids = set(shop["category_ids"])
+    for category_id in category_ids - watches["items"].keys():
+        watches["items"][category_id] = categories_ref.document(category_id).collection("items").on_snapshot(
+            _skip_initial_snapshot(lambda changes, category_id=category_id: on_shop_items_snapshot(shop_id, category_id, changes)))
+    for category_id in watches["items"].keys() - category_ids:
+        _detach_watch(shop_id, watches["items"].pop(category_id))
+
+def _detach_watch(shop_id, watch):
+    try:
+        watch.unsubscribe()
+    except Exception as e:
+        log_event("listener_detach_failed", logging.WARNING, shop_id=shop_id, error=str(e))
+
+def _unwatch_shop(shop_id):
+    """Detach every listener of an evicted shop (caller holds its lock)"""
+    watches = shop_watches.pop(shop_id, None)
+    if not watches:
+        return
+    if watches["categories"] is not None:
+        _detach_watch(shop_id, watches["categories"])
+    for watch in watches["items"].values():
+        _detach_watch(shop_id, watch)
+
+def _patch_shop_items(shop, category_id, item_docs, removed_ids):
+    """Copy-on-write shop entry with one category's changed items rebuilt; returns (shop, reads, bytes delta)"""
+    shop_id = shop["shop_id"]
+    reads = 0
+    category = next((c for c in shop["categories"] if c["category_id"] == category_id), None)
+    if category is None:
+        # Category was empty when the shop loaded
+        cat_doc = fs.get(db.collection("Shops").document(shop_id).collection("categories").document(category_id))
+        reads += 1
+        category = {
+            "category_id": category_id,
+            "category_name": (cat_doc.to_dict() or {}).get("name", "") if cat_doc.exists else "",
+            "items": []
+        }
+
+    entries = {}
+    for item_doc in item_docs:
+        entries[item_doc.id], item_reads = _load_item_entry(shop_id, category, item_doc)
+        reads += item_reads
+
+    shop, delta = _replace_category_items(shop, category, entries, removed_ids)
+    return shop, reads, delta
+
+def _replace_category_items(shop, category, entries, removed_ids):
+    """Copy-on-write shop entry with entries (item_id -> ItemRecord) upserted into category and
+    removed_ids dropped; category is used as-is only when the shop does not have it yet. Returns (shop, bytes delta)"""
+    categories = list(shop["categories"])
+    position = next((i for i, c in enumerate(categories) if c["category_id"] == category["category_id"]), None)
+    if position is None:
+        categories.append(category)
+        position = len(categories) - 1
+    category = dict(categories[position])
+    entries = dict(entries)
+
+    delta = sum(deep_sizeof(entry) for entry in entries.values())
+    items = []
+    for item in category["items"]:
+        if item["item_id"] in removed_ids or item["item_id"] in entries:
+            delta -= deep_sizeof(item)
+        if item["item_id"] in removed_ids:
+            continue
+        items.append(entries.pop(item["item_id"], item))
+    items.extend(entries.values())  # items added since the load
+    category["items"] = items
+
+    if items:
+        categories[position] = category
+    else:
+        categories.pop(position)
+    return dict(shop, categories=categories), delta
+
+def on_shop_items_snapshot(shop_id, category_id, changes):
+    """Listener for one resident shop's category items - patches only the changed items"""
+    record_listener_event("shop_items", changes)
+    item_docs = [change.document for change in changes if change.type.name != "REMOVED"]
+    removed_ids = {change.document.id for change in changes if change.type.name == "REMOVED"}
+
+    with _shop_locks[shop_id]:
+        shop = get_shop_from_cache(shop_id)
+        if shop is None:
+            return  # evicted while the event was in flight
+        shop, reads, delta = _patch_shop_items(shop, category_id, item_docs, removed_ids)
+        _install_shop(shop, memory_delta=delta)
+        publish_items_delta(shop, category_id, {item_doc.id for item_doc in item_docs}, removed_ids)
+    log_event("shop_items_patched", logging.DEBUG, shop_id=shop_id, category_id=category_id,
+              changed=len(item_docs), removed=len(removed_ids), firestore_reads=reads)
+
+def refresh_shop_items(shop_id, category_id, item_ids):
+    """Re-read some items of a resident shop (their selling units changed)"""
+    with _shop_locks[shop_id]:
+        shop = get_shop_from_cache(shop_id)
+        if shop is None:
+            return
+        items_ref = db.collection("Shops").document(shop_id).collection("categories").document(category_id).collection("items")
+        snapshots = fs.get_all([items_ref.document(item_id) for item_id in item_ids])
+        item_docs = [snapshot for snapshot in snapshots if snapshot.exists]
+        removed_ids = {snapshot.id for snapshot in snapshots if not snapshot.exists}
+        shop, reads, delta = _patch_shop_items(shop, category_id, item_docs, removed_ids)
+        _install_shop(shop, memory_delta=delta)
+        publish_items_delta(shop, category_id, {item_doc.id for item_doc in item_docs}, removed_ids)
+
+def on_shop_categories_snapshot(shop_id, changes):
+    """A category was added, renamed or removed - reload that shop (rare)"""
+    record_listener_event("shop_categories", changes)
+    with _shop_locks[shop_id]:
+        if get_shop_from_cache(shop_id) is not None and _load_and_install_shop(shop_id, reason="categories_changed"):
+            if cache_bus is not None:
+                cache_bus.publish(shop_id, "reload")
+
+def evict_shop(shop_id, reason):
+    """Drop a shop from the cache, index and accounting and stop listening to it"""
+    with _lru_lock:
+        shop_last_access.pop(shop_id, None)
+    with _shop_locks[shop_id]:
+        _unwatch_shop(shop_id)
+        with _cache_swap_lock:
+            if shop_id not in embedding_cache_full["shops_by_id"]:
+                return False
+            shops_by_id = dict(embedding_cache_full["shops_by_id"])
+            shops_by_id.pop(shop_id)
+            shop_stats = dict(embedding_cache_full["shop_stats"])
+            shop_stats.pop(shop_id, None)
+            _publish_shops(shops_by_id, shop_stats)
+        search_index.drop_shop(shop_id)
+        forget_shop_memory(shop_id)
+        if cache_bus is not None:
+            cache_bus.publish(shop_id, "drop")  # leader only - followers must not keep a shop nobody listens to
+    inc_counter("shop_cache_evictions_total", reason=reason)
+    log_event("shop_evicted", shop_id=shop_id, reason=reason)
+    return True
+
+def _held_by_follower(shop_id):
+    """Bus leader: a follower announced this shop recently - evicting it would only bounce it back"""
+    return cache_bus is not None and cache_bus.is_held(shop_id)
+
+def _evict_over_capacity():
+    evicted = 0
+    while SHOP_CACHE_MAX_SHOPS > 0:
+        with _lru_lock:
+            if len(shop_last_access) <= SHOP_CACHE_MAX_SHOPS:
+                break
+            # Held shops stay resident on the leader and do not count against the cap
+            evictable = [s for s in shop_last_access if not _held_by_follower(s)]
+            if len(evictable) <= SHOP_CACHE_MAX_SHOPS:
+                break
+        evicted += evict_shop(evictable[0], "capacity")
+    return evicted
+
+def sweep_shop_cache():
+    """Evict shops idle longer than SHOP_CACHE_IDLE_SECONDS, then the least recently used over the cap"""
+    evicted = 0
+    if SHOP_CACHE_IDLE_SECONDS > 0:
+        idle_before = time.time() - SHOP_CACHE_IDLE_SECONDS
+        with _lru_lock:
+            idle = []
+            for shop_id, last_access in shop_last_access.items():
+                if last_access >= idle_before:
+                    break  # LRU order - everything after this was used more recently
+                idle.append(shop_id)
+        for shop_id in idle:
+            evicted += evict_shop(shop_id, "idle")
+    return evicted + _evict_over_capacity()
+
+def _shop_cache_janitor():
+    while True:
+        time.sleep(SHOP_CACHE_SWEEP_SECONDS)
+        try:
+            sweep_shop_cache()
+        except Exception as e:
+            log_event("shop_cache_sweep_failed", logging.ERROR, exc_info=True, error=str(e))
+
+def shop_cache_summary():
+    """Residency and listener counts for /debug-cache"""
+    with _lru_lock:
+        oldest = next(iter(shop_last_access.items()), None)
+    return {
+        "resident_shops": embedding_cache_full["total_shops"],
+        "max_shops": SHOP_CACHE_MAX_SHOPS,
+        "idle_seconds": SHOP_CACHE_IDLE_SECONDS,
+        "preload_all": CACHE_PRELOAD_ALL_SHOPS,
+        "listeners": sum(len(watches["items"]) + 1 for watches in list(shop_watches.values())),
+        "least_recent": {"shop_id": oldest[0], "last_access": oldest[1]} if oldest else None
+    }
+
+# ======================================================
+# CACHE INVALIDATION BUS (several instances, one set of catalogue listeners)
+# ======================================================
+# Unset CACHE_BUS_URL: every instance listens to Firestore for the shops it
+# holds (single-instance deployments). Set: instances elect a leader that alone
+# owns the catalogue listeners (the sellUnits group listener and the per-shop
+# items/categories listeners) and publishes each patch as a per-shop delta;
+# followers attach none and apply the deltas to the shops they hold.
+#
+#   redis://host:6379/0    Redis pub/sub; the leader holds a lease renewed every heartbeat
+#   tcp://127.0.0.1:7077   local stand-in; whoever binds the port leads and relays
+#
+# Followers announce the shops they hold every heartbeat so the leader keeps
+# those resident (and listened to). Deltas carry (epoch, shop_id, seq), seq
+# counting per shop within one leader's epoch. A seq jump, or a heartbeat listing
+# a later seq than a follower has applied, resyncs that shop from Firestore; a new
+# epoch (leader change) drops every held shop so each reloads on next use.
+CACHE_BUS_URL = os.environ.get("CACHE_BUS_URL", "")
+CACHE_BUS_CHANNEL = os.environ.get("CACHE_BUS_CHANNEL", "superkeeper-cache")
+CACHE_BUS_HEARTBEAT_SECONDS = float(os.environ.get("CACHE_BUS_HEARTBEAT_SECONDS", 5))
+
+class RedisBusTransport:
+    """Pub/sub on <channel>:deltas and <channel>:holds; leadership is a SET NX lease of three heartbeats"""
+    # Extend the lease only if we still own it - one round trip, so it cannot extend a lease another instance just took
+    RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+    def __init__(self, url, instance_id):
+        import redis  # optional - only needed for redis:// bus URLs
+        self.client = redis.Redis.from_url(url)
+        self.instance_id = instance_id
+        self.lease_key = f"{CACHE_BUS_CHANNEL}:leader"
+        self.lease_ms = int(CACHE_BUS_HEARTBEAT_SECONDS * 3000)
+        self._renew_lease = self.client.register_script(self.RENEW_LEASE_SCRIPT)
+
+    def start(self, deliver):
+        threading.Thread(target=self._listen, args=(deliver,), name="cache-bus-redis", daemon=True).start()
+
+    def try_lead(self):
+        if self.client.set(self.lease_key, self.instance_id, nx=True, px=self.lease_ms):
+            return True
+        return bool(self._renew_lease(keys=[self.lease_key], args=[self.instance_id, self.lease_ms]))
+
+    def send(self, channel, payload):
+        self.client.publish(f"{CACHE_BUS_CHANNEL}:{channel}", payload)
+
+    def _listen(self, deliver):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(f"{CACHE_BUS_CHANNEL}:deltas", f"{CACHE_BUS_CHANNEL}:holds")
+                for message in pubsub.listen():
+                    deliver(message["channel"].decode().rpartition(":")[2], message["data"])
+            except Exception as e:
+                log_event("cache_bus_disconnected", logging.WARNING, transport="redis", error=str(e))
+                time.sleep(CACHE_BUS_HEARTBEAT_SECONDS)
+
+class TcpBusTransport:
+    """
+    Local stand-in for Redis (tests, several workers on one host). The instance
+    that binds host:port is the leader and hub; the others connect to it and try
+    to bind again when it goes away. One JSON payload per line: deltas flow hub
+    -> followers, holds followers -> hub.
+    """
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.server = None
+        self.peers = set()  # leader: follower connections
+        self.upstream = None  # follower: connection to the leader
+        self.deliver = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # whole lines only - several threads publish
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def try_lead(self):
+        with self._lock:
+            if self.server is not None:
+                return True
+            if self.upstream is not None:
+                return False
+        try:
+            self.server = socket.create_server(self.address)
+            threading.Thread(target=self._accept, name="cache-bus-hub", daemon=True).start()
+            return True
+        except OSError:
+            pass  # someone else is the hub - follow it
+        try:
+            connection = socket.create_connection(self.address, timeout=CACHE_BUS_HEARTBEAT_SECONDS)
+        except OSError as e:
+            log_event("cache_bus_disconnected", logging.WARNING, transport="tcp", error=str(e))
+            return False
+        connection.settimeout(None)  # not the process-wide default - the hub may be quiet for a heartbeat
+        with self._lock:
+            self.upstream = connection
+        threading.Thread(target=self._read, args=(connection, "deltas"), name="cache-bus-upstream", daemon=True).start()
+        return False
+
+    def send(self, channel, payload):
+        with self._lock:
+            if channel == "deltas":
+                targets = list(self.peers)
+            else:
+                targets = [self.upstream] if self.upstream is not None else []
+        line = payload + b"\n"
+        with self._send_lock:
+            for connection in targets:
+                try:
+                    connection.sendall(line)
+                except OSError:
+                    connection.close()  # its reader thread drops it
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return  # hub closed
+            connection.settimeout(None)
+            with self._lock:
+                self.peers.add(connection)
+            threading.Thread(target=self._read, args=(connection, "holds"), name="cache-bus-peer", daemon=True).start()
+
+    def _read(self, connection, channel):
+        try:
+            for line in connection.makefile("rb"):
+                self.deliver(channel, line)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self.peers.discard(connection)
+                if connection is self.upstream:
+                    self.upstream = None  # the next try_lead binds or reconnects
+            connection.close()
+
+class CacheBus:
+    """Leader election, delta publishing (leader) and delta application (followers) over one transport"""
+    def __init__(self, transport, instance_id):
+        self.transport = transport
+        self.instance_id = instance_id
+        self.is_leader = False
+        self.epoch = None  # epoch this instance publishes (leader) or follows
+        self.seqs = {}  # shop_id -> last seq published (leader) or applied (follower) in the epoch
+        self.holds = {}  # leader: shop_id -> time a follower's hold on it lapses
+        self.last_heartbeat = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Decide the role now, then heartbeat in the background"""
+        self.transport.start(self._deliver)
+        self._tick()
+        threading.Thread(target=self._run, name="cache-bus", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(CACHE_BUS_HEARTBEAT_SECONDS)
+            try:
+                self._tick()
+            except Exception as e:
+                log_event("cache_bus_tick_failed", logging.ERROR, exc_info=True, error=str(e))
+
+    def _tick(self):
+        leading = self.transport.try_lead()
+        if leading and not self.is_leader:
+            self._become_leader()
+        elif not leading and self.is_leader:
+            self._step_down()
+
+        if self.is_leader:
+            with self._lock:
+                message = {"op": "heartbeat", "epoch": self.epoch, "seqs": dict(self.seqs)}
+            self._send("deltas", message)
+        else:
+            with _lru_lock:
+                held = list(shop_last_access)
+            if held:
+                self.hold(held)
+
+    def _become_leader(self):
+        with self._lock:
+            self.is_leader = True
+            self.epoch = f"{self.instance_id}:{int(time.time() * 1000)}"
+            self.seqs = {}
+        inc_counter("cache_bus_role_changes_total", role="leader")
+        log_event("cache_bus_leader", epoch=self.epoch)
+        _attach_catalogue_listeners()
+        # Nobody may have been listening since our copies were made - reload them (which also attaches their listeners)
+        for shop_id in list(embedding_cache_full["shops_by_id"]):
+            self._resync(shop_id, "bus_leader")
+
+    def _step_down(self):
+        with self._lock:
+            self.is_leader = False
+            self.epoch = None
+            self.seqs = {}
+            self.holds = {}
+        inc_counter("cache_bus_role_changes_total", role="follower")
+        log_event("cache_bus_follower", logging.WARNING)
+        _detach_catalogue_listeners()
+        for shop_id in list(shop_watches):
+            with _shop_locks[shop_id]:
+                _unwatch_shop(shop_id)
+
+    def _send(self, channel, message):
+        try:
+            self.transport.send(channel, app.json.dumps(message).encode("utf-8"))
+        except Exception as e:
+            log_event("cache_bus_send_failed", logging.WARNING, channel=channel, op=message["op"], error=str(e))
+
+    def publish(self, shop_id, op, **fields):
+        """Leader: send a delta stamped with the shop's next seq (caller holds the shop's lock, which orders them)"""
+        with self._lock:
+            if not self.is_leader:
+                return
+            seq = self.seqs[shop_id] = self.seqs.get(shop_id, 0) + 1
+            epoch = self.epoch
+        self._send("deltas", {"op": op, "epoch": epoch, "shop_id": shop_id, "seq": seq, **fields})
+        inc_counter("cache_bus_messages_total", direction="published", op=op)
+
+    def hold(self, shop_ids):
+        """Follower: ask the leader to keep these shops resident and listened to"""
+        if not self.is_leader:
+            self._send("holds", {"op": "hold", "shops": shop_ids})
+
+    def _deliver(self, channel, payload):
+        try:
+            message = app.json.loads(payload)
+            if channel == "holds":
+                if self.is_leader:
+                    self._on_hold(message["shops"])
+            elif not self.is_leader:
+                if message["op"] == "heartbeat":
+                    self._on_heartbeat(message)
+                else:
+                    self._on_delta(message)
+        except Exception as e:
+            log_event("cache_bus_message_failed", logging.ERROR, exc_info=True, channel=channel, error=str(e))
+
+    def is_held(self, shop_id):
+        """Leader: has a follower announced this shop within the last three heartbeats?"""
+        return self.holds.get(shop_id, 0) > time.time()
+
+    def _on_hold(self, shop_ids):
+        held_until = time.time() + CACHE_BUS_HEARTBEAT_SECONDS * 3
+        with self._lock:
+            for shop_id in shop_ids:
+                self.holds[shop_id] = held_until
+            self.holds = {shop_id: until for shop_id, until in self.holds.items() if until > time.time()}
+        loaded = False
+        for shop_id in shop_ids:
+            if get_shop_from_cache(shop_id) is None:
+                with _shop_locks[shop_id]:
+                    if get_shop_from_cache(shop_id) is None and _load_and_install_shop(shop_id, reason="bus_hold"):
+                        loaded = True
+                        # The follower loaded it before we listened - have it reload from here on
+                        self.publish(shop_id, "reload")
+            _touch_shop(shop_id)
+        if loaded:
+            _evict_over_capacity()
+            enforce_cache_budget()
+
+    def _on_heartbeat(self, message):
+        seqs = message["seqs"]
+        with self._lock:
+            joined = message["epoch"] != self.epoch
+            if joined:
+                self.epoch = message["epoch"]
+                self.seqs = dict(seqs)
+                behind = []
+            else:
+                behind = [shop_id for shop_id, seq in seqs.items() if seq > self.seqs.get(shop_id, 0)]
+                for shop_id in behind:
+                    self.seqs[shop_id] = seqs[shop_id]
+            self.last_heartbeat = time.time()
+
+        if joined:
+            inc_counter("cache_bus_epoch_changes_total")
+            log_event("cache_bus_joined", epoch=self.epoch)
+            # Held shops may have missed changes before this leader's stream - reload on next use
+            for shop_id in list(embedding_cache_full["shops_by_id"]):
+                evict_shop(shop_id, "bus_epoch")
+        for shop_id in behind:
+            inc_counter("cache_bus_gaps_total")
+            self._resync(shop_id, "bus_gap")
+
+    def _on_delta(self, message):
+        shop_id, seq = message["shop_id"], message["seq"]
+        with self._lock:
+            if message["epoch"] != self.epoch:
+                return  # a leader we have not joined yet (its heartbeat decides) or one that stepped down
+            expected = self.seqs.get(shop_id, 0) + 1
+            if seq < expected:
+                return  # already applied
+            self.seqs[shop_id] = seq
+        inc_counter("cache_bus_messages_total", direction="received", op=message["op"])
+
+        if seq > expected:
+            inc_counter("cache_bus_gaps_total")
+            self._resync(shop_id, "bus_gap")
+        elif message["op"] == "items":
+            self._apply_items(message)
+        elif message["op"] == "reload":
+            self._resync(shop_id, "bus_reload")
+        elif message["op"] == "drop":
+            evict_shop(shop_id, "bus_drop")
+
+    def _apply_items(self, message):
+        shop_id = message["shop_id"]
+        with _shop_locks[shop_id]:
+            shop = get_shop_from_cache(shop_id)
+            if shop is None:
+                return  # not held here
+            entries = {state["item_id"]: ItemRecord.from_state(state) for state in message["items"]}
+            category = {
+                "category_id": _intern(message["category_id"]),
+                "category_name": _intern(message["category_name"]),
+                "items": []
+            }
+            shop, delta = _replace_category_items(shop, category, entries, set(message["removed"]))
+            _install_shop(shop, memory_delta=delta)
+
+    def _resync(self, shop_id, reason):
+        """Snapshot resync of a held shop from Firestore; dropped if that fails, so it reloads on next use"""
+        with _shop_locks[shop_id]:
+            if get_shop_from_cache(shop_id) is None:
+                return
+            reloaded = _load_and_install_shop(shop_id, reason=reason) is not None
+        if not reloaded:
+            evict_shop(shop_id, reason)
+
+    def summary(self):
+        with self._lock:
+            return {
+                "instance": self.instance_id,
+                "role": "leader" if self.is_leader else "follower",
+                "epoch": self.epoch,
+                "shops_sequenced": len(self.seqs),
+                "last_heartbeat_age_s": round(time.time() - self.last_heartbeat, 1) if self.last_heartbeat else None
+            }
+
+cache_bus = None  # CacheBus once warm_up() has started it (CACHE_BUS_URL set)
+catalogue_watches = {}  # "sellUnits" -> group listener while this instance owns the catalogue listeners
+
+def start_cache_bus():
+    global cache_bus
+    if not CACHE_BUS_URL or cache_bus is not None:
+        return
+    instance_id = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+    scheme, _, rest = CACHE_BUS_URL.partition("://")
+    if scheme == "redis":
+        transport = RedisBusTransport(CACHE_BUS_URL, instance_id)
+    elif scheme == "tcp":
+        host, _, port = rest.rpartition(":")
+        transport = TcpBusTransport(host or "127.0.0.1", int(port))
+    else:
+        raise ValueError(f"Unsupported CACHE_BUS_URL scheme: {scheme}")
+    bus = CacheBus(transport, instance_id)
+    cache_bus = bus
+    bus.start()
+
+def owns_catalogue_listeners():
+    """Single instance, or the bus leader - followers get catalogue changes as deltas instead"""
+    return cache_bus is None or cache_bus.is_leader
+
+def _attach_catalogue_listeners():
+    # Items are listened to per resident shop (see SHOP CACHE TIERS); selling units are routed from here
+    if "sellUnits" not in catalogue_watches:
+        catalogue_watches["sellUnits"] = db.collection_group("sellUnits").on_snapshot(
+            _skip_initial_snapshot(on_selling_units_snapshot))
+
+def _detach_catalogue_listeners():
+    watch = catalogue_watches.pop("sellUnits", None)
+    if watch is not None:
+        _detach_watch(None, watch)
+
+def publish_items_delta(shop, category_id, item_ids, removed_ids):
+    """Leader: ship a patched category's changed items to the followers (caller holds the shop's lock)"""
+    if cache_bus is None or not cache_bus.is_leader:
+        return
+    category = next((c for c in shop["categories"] if c["category_id"] == category_id), None)
+    cache_bus.publish(
+        shop["shop_id"], "items",
+        category_id=category_id,
+        category_name=category["category_name"] if category else "",
+        items=[item.to_state() for item in category["items"] if item.item_id in item_ids] if category else [],
+        removed=sorted(removed_ids)
+    )
+
+# ======================================================
+# STAFF LOOKUP INDEX (email -> shop membership, fed by listeners)
+# ======================================================
+staff_index = {
+    "by_email": {},  # email -> {staff doc path: record}
+    "email_by_path": {},  # staff doc path -> indexed email (handles email edits and deletes)
+    "count_by_shop": defaultdict(int),  # shop_id -> staff seats in use
+    "last_updated": None
+}
+shop_plans = {}  # shop_id -> plan document data from Shops/{shop_id}/plan/default
+shop_plans_state = {"loaded": False}  # True once the plan listener delivered its first snapshot
+staff_index_lock = threading.Lock()
+
+def _normalize_email(email):
+    return (email or "").strip().lower()
+
+def _remove_staff_doc(path):
+    email = staff_index["email_by_path"].pop(path, None)
+    if email is None:
+        return
+    records = staff_index["by_email"].get(email, {})
+    removed = records.pop(path, None)
+    if removed:
+        staff_index["count_by_shop"][removed["shopId"]] -= 1
+    if not records:
+        staff_index["by_email"].pop(email, None)
+
+def on_staff_snapshot(col_snapshot, changes, read_time):
+    """Listener for Shops/*/staff - applies only the changed documents"""
+    record_listener_event("staff", changes)
+    with staff_index_lock:
+        for change in changes:
+            doc = change.document
+            path = doc.reference.path
+            _remove_staff_doc(path)
+            if change.type.name == "REMOVED":
+                continue
+
+            data = doc.to_dict() or {}
+            email = _normalize_email(data.get("email"))
+            if not email:
+                continue
+
+            staff_index["by_email"].setdefault(email, {})[path] = {
+                "staffId": doc.id,
+                "shopId": doc.reference.parent.parent.id,
+                "staffDocPath": path,
+                "email": email,
+                "name": data.get("name"),
+                "phone": data.get("phone"),
+                "roleName": data.get("roleName"),
+                "accessLevel": data.get("accessLevel"),
+                "shopName": data.get("shopName"),
+                "createdAt": data.get("createdAt"),
+                "updatedAt": data.get("updatedAt")
+            }
+            staff_index["email_by_path"][path] = email
+            staff_index["count_by_shop"][doc.reference.parent.parent.id] += 1
+        staff_index["last_updated"] = time.time()
+
+    log_event("listener_applied", listener="staff", changes=len(changes), indexed=len(staff_index["email_by_path"]))
+
+def on_plan_snapshot(col_snapshot, changes, read_time):
+    """Listener for Shops/*/plan - keeps each shop's plan and drops its cached entitlements"""
+    record_listener_event("plan", changes)
+    for change in changes:
+        doc = change.document
+        if doc.id != "default":
+            continue
+        shop_id = doc.reference.parent.parent.id
+        if change.type.name == "REMOVED":
+            shop_plans.pop(shop_id, None)
+        else:
+            shop_plans[shop_id] = doc.to_dict() or {}
+        invalidate_entitlements(shop_id)
+    shop_plans_state["loaded"] = True
+
+def lookup_staff_by_email(email):
+    """O(1) lookup - every shop membership registered for this email"""
+    with staff_index_lock:
+        return [dict(record) for record in staff_index["by_email"].get(_normalize_email(email), {}).values()]
+
+# ======================================================
+# UPGRADE REQUEST INDEX (admin dashboard, fed by one listener)
+# ======================================================
+PAID_UPGRADE_STATUSES = ("submitted", "payment_submitted", "pending_verification")
+UPGRADE_CATEGORIES = ("paid", "requested", "verified")
+ADMIN_EMAILS = {
+    email.strip().lower() for email in os.environ.get("ADMIN_EMAILS", "").split(",") if email.strip()
+}
+
+upgrade_requests = {
+    "by_path": {},  # upgrade request doc path -> record
+    "by_status": defaultdict(set),  # status -> {doc path}
+    "by_reference": defaultdict(set),  # normalized M-Pesa reference -> {doc path}
+    "generation": 0,
+    "last_updated": None
+}
+upgrade_requests_lock = threading.Lock()
+
+def _normalize_mpesa_reference(reference):
+    return (reference or "").strip().upper()
+
+def _timestamp_seconds(value):
+    """Firestore timestamp / datetime / ISO string -> epoch seconds (0 when missing)"""
+    if value is None:
+        return 0
+    if hasattr(value, "timestamp"):
+        return value.timestamp()
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return 0
+    return 0
+
+def _upgrade_category(record):
+    if record["verifiedAt"] is not None:
+        return "verified"
+    return "paid" if record["status"] in PAID_UPGRADE_STATUSES else "requested"
+
+def _remove_upgrade_request(path):
+    record = upgrade_requests["by_path"].pop(path, None)
+    if record is None:
+        return
+    paths = upgrade_requests["by_status"].get(record["status"])
+    if paths is not None:
+        paths.discard(path)
+        if not paths:
+            upgrade_requests["by_status"].pop(record["status"], None)
+    reference = _normalize_mpesa_reference(record["mpesaReference"])
+    paths = upgrade_requests["by_reference"].get(reference)
+    if paths is not None:
+        paths.discard(path)
+        if not paths:
+            upgrade_requests["by_reference"].pop(reference, None)
+
+def on_upgrade_request_snapshot(col_snapshot, changes, read_time):
+    """Listener for Shops/*/upgradeRequests - applies only the changed documents"""
+    record_listener_event("upgradeRequests", changes)
+    now = time.time()
+    with upgrade_requests_lock:
+        for change in changes:
+            doc = change.document
+            path = doc.reference.path
+            _remove_upgrade_request(path)
+            if change.type.name == "REMOVED":
+                continue
+
+            data = doc.to_dict() or {}
+            shop_id = doc.reference.parent.parent.id
+            requested_plan = data.get("requestedPlan") or data.get("planName") or "N/A"
+            record = {
+                "id": doc.id,
+                "shopId": shop_id,
+                "shopName": data.get("shopName"),
+                "requestedPlan": requested_plan,
+                "status": data.get("status") or data.get("paymentStatus") or "unknown",
+                "paymentStatus": data.get("paymentStatus"),
+                "mpesaReference": data.get("mpesaReference"),
+                "requestedAt": data.get("requestedAt") or data.get("timestamp"),
+                "paymentSubmittedAt": data.get("paymentSubmittedAt"),
+                "verifiedAt": data.get("verifiedAt"),
+                "priceKES": data.get("priceKES"),
+                "staffLimit": data.get("staffLimit"),
+                "updatedAt": data.get("updatedAt"),
+                "indexedAt": now
+            }
+            record["category"] = _upgrade_category(record)
+            sort_field = {"verified": "verifiedAt", "paid": "paymentSubmittedAt"}.get(record["category"], "requestedAt")
+            record["sortKey"] = _timestamp_seconds(record[sort_field] or record["requestedAt"])
+
+            upgrade_requests["by_path"][path] = record
+            upgrade_requests["by_status"][record["status"]].add(path)
+            reference = _normalize_mpesa_reference(record["mpesaReference"])
+            if reference:
+                upgrade_requests["by_reference"][reference].add(path)
+        upgrade_requests["generation"] += 1
+        upgrade_requests["last_updated"] = now
+
+    log_event("listener_applied", listener="upgradeRequests", changes=len(changes), indexed=len(upgrade_requests["by_path"]))
+
+def _upgrade_request_view(record):
+    view = dict(record)
+    cached_shop = get_shop_from_cache(record["shopId"])
+    view["shopName"] = (cached_shop and cached_shop["shop_name"]) or record["shopName"] or "Unknown Shop"
+    return view
+
+def lookup_upgrade_requests_by_reference(reference):
+    """O(1) lookup - every upgrade request that quoted this M-Pesa reference"""
+    with upgrade_requests_lock:
+        paths = upgrade_requests["by_reference"].get(_normalize_mpesa_reference(reference), ())
+        records = [upgrade_requests["by_path"][path] for path in paths]
+    return [_upgrade_request_view(record) for record in records]
+
+def summarize_upgrade_requests(category=None, status=None, cursor=0, limit=100):
+    """Counts per dashboard category plus one page of records, most recent first"""
+    with upgrade_requests_lock:
+        if status:
+            records = [upgrade_requests["by_path"][path] for path in upgrade_requests["by_status"].get(status, ())]
+        else:
+            records = list(upgrade_requests["by_path"].values())
+
+    counts = {name: 0 for name in UPGRADE_CATEGORIES}
+    for record in records:
+        counts[record["category"]] += 1
+    counts["total"] = len(records)
+
+    if category:
+        records = [record for record in records if record["category"] == category]
+    records.sort(key=lambda record: record["sortKey"], reverse=True)
+    page = records[cursor:cursor + limit]
+    next_cursor = cursor + limit if cursor + limit < len(records) else None
+    return counts, [_upgrade_request_view(record) for record in page], next_cursor
 
 # ======================================================
 # BATCH-AWARE FIFO HELPER FUNCTIONS
@@ -568,12 +2816,12 @@ def on_selling_units_snapshot(col_snapshot, changes, read_time):
 
 def find_item_in_cache(shop_id, item_id):
     """Find item in cache by shop_id and item_id"""
-    for shop in embedding_cache_full["shops"]:
-        if shop["shop_id"] == shop_id:
-            for category in shop["categories"]:
-                for item in category["items"]:
-                    if item["item_id"] == item_id:
-                        return item
+    shop = get_shop_detail(shop_id)
+    if shop:
+        for category in shop["categories"]:
+            for item in category["items"]:
+                if item["item_id"] == item_id:
+                    return item
     return None
 
 def find_selling_unit_in_cache(shop_id, item_id, sell_unit_id):
@@ -592,7 +2840,8 @@ def allocate_main_item_fifo(batches, requested_quantity):
     if not batches:
         return {"success": False, "error": "No batches available"}
     
-    sorted_batches = sorted(batches, key=lambda x: x.get("timestamp", 0))
+    # Cached BatchRecords - the same objects the search index formats results from
+    sorted_batches = sorted(batches, key=lambda x: x.timestamp)
     
     allocation = []
     remaining = requested_quantity
@@ -602,17 +2851,17 @@ def allocate_main_item_fifo(batches, requested_quantity):
         if remaining <= 0:
             break
         
-        available = batch.get("remaining_quantity", 0)
+        available = batch.remaining_quantity
         if available > 0:
             take = min(available, remaining)
-            batch_price = batch.get("sell_price", 0)
+            batch_price = batch.sell_price
             
             allocation.append({
-                "batch_id": batch["batch_id"],
-                "batch_name": batch.get("batch_name", "Batch"),
+                "batch_id": batch.batch_id,
+                "batch_name": batch.batch_name,
                 "quantity": take,
                 "price": batch_price,
-                "unit": batch.get("unit", "unit"),
+                "unit": batch.unit,
                 "batch_info": batch
             })
             
@@ -624,32 +2873,33 @@ def allocate_main_item_fifo(batches, requested_quantity):
     
     return {"success": True, "allocation": allocation, "total_price": total_price}
 
-def allocate_selling_unit_fifo(batch_links, requested_units, conversion_factor):
+def allocate_selling_unit_fifo(batches, requested_units, conversion_factor):
     """
-    Allocate selling units from batch links using FIFO
+    Allocate selling units from the parent item's batches using FIFO
+    (units available in a batch = batch quantity x conversion factor)
     """
-    if not batch_links:
-        return {"success": False, "error": "No batch links available"}
+    if not batches:
+        return {"success": False, "error": "No batches available"}
     
-    sorted_links = sorted(batch_links, key=lambda x: x.get("batchTimestamp", 0))
+    sorted_batches = sorted(batches, key=lambda x: x.timestamp)
     
     allocation = []
     remaining_units = requested_units
     total_price = 0
     
-    for link in sorted_links:
+    for batch in sorted_batches:
         if remaining_units <= 0:
             break
         
-        available_units = link.get("maxUnitsAvailable", 0) - link.get("allocatedUnits", 0)
+        available_units = batch.remaining_quantity * conversion_factor
         if available_units > 0:
             take_units = min(available_units, remaining_units)
-            price_per_unit = link.get("pricePerUnit", 0)
+            price_per_unit = batch.sell_price / conversion_factor
             
             take_main_units = take_units / conversion_factor
             
             allocation.append({
-                "batch_id": link.get("batchId"),
+                "batch_id": batch.batch_id,
                 "units_taken": take_units,
                 "main_units_taken": take_main_units,
                 "price_per_unit": price_per_unit,
@@ -664,12 +2914,40 @@ def allocate_selling_unit_fifo(batch_links, requested_units, conversion_factor):
     
     return {"success": True, "allocation": allocation, "total_price": total_price}
 
+def apply_sale_to_cache(shop_id, item_id, batch_id, remaining_quantity, new_total_stock,
+                        units_sold=0, sold_at=None):
+    """
+    Mirror a committed sale into the cached item so search and the next sale
+    see the new availability before the item listener's snapshot arrives.
+    Only the sold batch's quantity changes; availability is re-derived from
+    the batches in one pass, and the sale moves the item up the search
+    completions. The listener's patch replaces the record anyway.
+    """
+    item = search_index.get_record(shop_id, item_id)
+    if item is None:
+        return False
+    
+    with _shop_locks[shop_id]:
+        batch = next((b for b in item.batches if b.batch_id == batch_id), None)
+        if batch is None:
+            return False
+        batch.quantity = float(remaining_quantity)
+        item.stock = new_total_stock
+        item.total_stock_from_batches = sum(b.quantity for b in item.batches)
+        item.refresh_availability()
+        if units_sold > 0:
+            item.sales_velocity = add_sale_velocity(item.sales_velocity, units_sold, sold_at or time.time())
+            search_index.record_sale(shop_id, item)
+        search_index.bump_generation(shop_id)
+    return True
+
 # PLANS
 PLANS_CONFIG = {
     "SOLO": {
         "id": "SOLO",
         "name": "Solo",
         "staff_limit": 0,
+        "item_limit": 50,
         "price_kes": 0,
         "description": "Perfect for individual entrepreneurs",
         "features": [
@@ -688,6 +2966,7 @@ PLANS_CONFIG = {
         "id": "BASIC",
         "name": "Basic",
         "staff_limit": 5,
+        "item_limit": 200,
         "price_kes": 250,
         "description": "Small business with employees",
         "features": [
@@ -706,6 +2985,7 @@ PLANS_CONFIG = {
         "id": "TEAM",
         "name": "Team",
         "staff_limit": 10,
+        "item_limit": 500,
         "price_kes": 500,
         "description": "Growing business with team",
         "features": [
@@ -725,6 +3005,7 @@ PLANS_CONFIG = {
         "id": "BUSINESS",
         "name": "Business",
         "staff_limit": 20,
+        "item_limit": None,
         "price_kes": 1000,
         "description": "Multiple counters/locations",
         "features": [
@@ -743,6 +3024,7 @@ PLANS_CONFIG = {
         "id": "ENTERPRISE",
         "name": "Enterprise",
         "staff_limit": 50,
+        "item_limit": None,
         "price_kes": 3000,
         "description": "Supermarkets & large operations",
         "features": [
@@ -757,14 +3039,126 @@ PLANS_CONFIG = {
         "button_class": "btn-enterprise",
         "best_for": "Custom solutions available"
     }
-}
+}
+
+# ======================================================
+# PLAN ENTITLEMENTS (TTL CACHE, INVALIDATED BY THE PLAN LISTENER)
+# ======================================================
+ENTITLEMENT_CACHE_SIZE = 10000
+ENTITLEMENT_TTL_SECONDS = 300  # safety net if a listener update is ever missed
+
+entitlement_cache = TTLCache(maxsize=ENTITLEMENT_CACHE_SIZE, ttl=ENTITLEMENT_TTL_SECONDS)
+entitlement_lock = threading.Lock()
+
+def invalidate_entitlements(shop_id):
+    with entitlement_lock:
+        entitlement_cache.pop(shop_id, None)
+
+def _load_plan_data(shop_id):
+    """Plan document for a shop - from the listener map, Firestore only before it has loaded"""
+    if shop_id in shop_plans or shop_plans_state["loaded"] or db is None:
+        return shop_plans.get(shop_id)
+    plan_doc = fs.get(db.collection("Shops").document(shop_id).collection("plan").document("default"))
+    return plan_doc.to_dict() if plan_doc.exists else None
+
+def get_entitlements(shop_id):
+    """Plan limits for a shop, cached by shop_id"""
+    with entitlement_lock:
+        cached = entitlement_cache.get(shop_id)
+    if cached is not None:
+        return cached
+
+    plan_data = _load_plan_data(shop_id)
+    plan_name = (plan_data or {}).get("name", "Solo")
+    plan_config = PLANS_CONFIG.get(plan_name.upper(), PLANS_CONFIG["SOLO"])
+    staff_limit = (plan_data or {}).get("staffLimit")
+    entitlements = {
+        "shop_id": shop_id,
+        "plan_exists": plan_data is not None,
+        "plan_id": plan_config["id"],
+        "plan_name": plan_name,
+        "item_limit": plan_config["item_limit"],
+        "staff_limit": staff_limit if staff_limit is not None else plan_config["staff_limit"],
+        "features": (plan_data or {}).get("features", {})
+    }
+
+    with entitlement_lock:
+        entitlement_cache[shop_id] = entitlements
+    return entitlements
+
+# Creations written by /add-item and /add-staff that the listeners have not brought
+# into the counters yet - counted as usage so back-to-back creations cannot overshoot
+ENTITLEMENT_PENDING_SECONDS = 60  # a creation the listener never reports stops counting after this
+pending_creations = {}  # (shop_id, resource) -> {doc path: created_at}
+_pending_creations_lock = threading.Lock()
+_creation_locks = _ShopLocks()  # shop_id -> lock serializing that shop's check-then-create
+
+def _creation_counted(resource, path):
+    """Has the listener brought this created doc into the in-memory counters?"""
+    if resource == "staff":
+        return path in staff_index["email_by_path"]
+    parts = path.split("/")  # Shops/{shop}/categories/{category}/items/{item}
+    return search_index.get_record(parts[1], parts[5]) is not None
+
+def _pending_count(shop_id, resource):
+    now = time.time()
+    with _pending_creations_lock:
+        pending = pending_creations.get((shop_id, resource))
+        if not pending:
+            return 0
+        for path, created_at in list(pending.items()):
+            if created_at < now - ENTITLEMENT_PENDING_SECONDS or _creation_counted(resource, path):
+                del pending[path]
+        if not pending:
+            del pending_creations[(shop_id, resource)]
+        return len(pending)
+
+def get_shop_usage(shop_id):
+    """Current usage from in-memory counters - no Firestore reads once the shop is resident"""
+    ensure_shop_loaded(shop_id)  # item counts come from the shop's cache entry
+    return {
+        "items": embedding_cache_full["shop_stats"].get(shop_id, {}).get("total_items", 0) + _pending_count(shop_id, "items"),
+        "staff": staff_index["count_by_shop"].get(shop_id, 0) + _pending_count(shop_id, "staff")
+    }
+
+def create_within_entitlement(shop_id, resource, ref, data):
+    """
+    Write a new item/staff doc only if the shop's plan has room for it.
+    Check and write are serialized per shop. Returns (created, details).
+    """
+    with _creation_locks[shop_id]:
+        allowed, details = check_entitlement(shop_id, resource)
+        if not allowed:
+            inc_counter("entitlement_denials_total", resource=resource)
+            return False, details
+        fs.set(ref, data)
+        with _pending_creations_lock:
+            pending_creations.setdefault((shop_id, resource), {})[ref.path] = time.time()
+    return True, details
+
+def check_entitlement(shop_id, resource, adding=1):
+    """
+    Can `adding` more items/staff be created under the shop's plan?
+    Returns (allowed, details).
+    """
+    entitlements = get_entitlements(shop_id)
+    limit = entitlements["item_limit"] if resource == "items" else entitlements["staff_limit"]
+    used = get_shop_usage(shop_id)[resource]
+    allowed = limit is None or used + adding <= limit
+    return allowed, {
+        "resource": resource,
+        "plan_id": entitlements["plan_id"],
+        "limit": limit,
+        "used": used,
+        "remaining": None if limit is None else max(limit - used, 0)
+    }
 
 # ======================================================
 # ROUTES
 # ======================================================
 @app.route("/")
 def home():
-    return render_template(
+    return render_cached_page(
         "home.html",
         title="Superkeeper - Inventory POS for Small Businesses",
         meta_desc="Mobile-first POS and inventory for small businesses. Start free, upgrade as you grow.",
@@ -773,15 +3167,15 @@ def home():
 
 @app.route("/features")
 def features():
-    return render_template(
+    return render_cached_page(
         "features.html",
         title="Features - Superkeeper",
         meta_desc="Everything you need, nothing you don't. Mobile-first POS, staff control, alerts, and more.",
         active_page="features"
     )
 
-@app.route("/pricing")
-def pricing():
+def build_annual_discounts():
+    """Annual (20% off) pricing rows for the pricing page - PLANS_CONFIG is static"""
     annual_discounts = []
     for plan_id, plan in PLANS_CONFIG.items():
         if plan["price_kes"] > 0 and plan_id != "ENTERPRISE":
@@ -795,20 +3189,25 @@ def pricing():
                 "new_price": discounted_price,
                 "savings": savings
             })
-    
-    return render_template(
+    return annual_discounts
+
+ANNUAL_DISCOUNTS = build_annual_discounts()
+
+@app.route("/pricing")
+def pricing():
+    return render_cached_page(
         "pricing.html",
         title="Pricing - Superkeeper",
         meta_desc="Simple, seat-based pricing. Start free, upgrade as you grow.",
         active_page="pricing",
         plans=PLANS_CONFIG.values(),
-        annual_discounts=annual_discounts,
+        annual_discounts=ANNUAL_DISCOUNTS,
         featured_plan="TEAM"
     )
 
 @app.route("/testimonials")
 def testimonials():
-    return render_template(
+    return render_cached_page(
         "testimonials.html",
         title="Success Stories - Superkeeper",
         meta_desc="Real results from real shops. See how Superkeeper helps small businesses.",
@@ -817,7 +3216,7 @@ def testimonials():
 
 @app.route("/story")
 def story():
-    return render_template(
+    return render_cached_page(
         "story.html",
         title="Our Story - Superkeeper",
         meta_desc="How Superkeeper was built for small businesses with big dreams.",
@@ -828,6 +3227,175 @@ def story():
 def dashboard():
     return render_template("dashboard.html")
 
+# ======================================================
+# ADMISSION CONTROL (per-shop search rate, sale commits first, single-flight)
+# ======================================================
+# Search-as-you-type sends a /sales POST per keystroke per till. Each shop gets a
+# token bucket, so one busy supermarket cannot crowd out other shops; searches
+# then need one of SEARCH_MAX_CONCURRENCY slots, waiting at most
+# SEARCH_QUEUE_TIMEOUT_SECONDS. Sale commits go first: each running commit
+# reserves a slot (searches always keep one), and a shop's searches wait for
+# that shop's own commits - other shops are unaffected. Identical in-flight
+# searches (shop, query, cache generation) share one computation.
+# All of this needs a threaded worker (gunicorn.conf.py: gthread, GUNICORN_THREADS);
+# at most SEARCH_MAX_WAITING searches block at once, so computing and waiting
+# searches never hold every request thread and /complete-sale always gets one.
+WORKER_THREADS = max(1, int(os.environ.get("GUNICORN_THREADS", 8)))
+SEARCH_RATE_PER_SHOP = float(os.environ.get("SEARCH_RATE_PER_SHOP", 15))  # searches/second; 0 = unlimited
+SEARCH_BURST_PER_SHOP = float(os.environ.get("SEARCH_BURST_PER_SHOP", 30))
+SEARCH_MAX_CONCURRENCY = max(1, int(os.environ.get("SEARCH_MAX_CONCURRENCY", 4)))
+SEARCH_MAX_WAITING = int(os.environ.get("SEARCH_MAX_WAITING", max(0, WORKER_THREADS - SEARCH_MAX_CONCURRENCY - 2)))
+SEARCH_QUEUE_TIMEOUT_SECONDS = float(os.environ.get("SEARCH_QUEUE_TIMEOUT_SECONDS", 0.25))
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take a token; returns 0 when granted, else the seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class SearchOverloaded(Exception):
+    """No search slot freed up within SEARCH_QUEUE_TIMEOUT_SECONDS"""
+
+search_buckets = TTLCache(maxsize=10000, ttl=300)  # shop_id -> TokenBucket; an idle bucket would be full anyway
+admission_state = {"searches_running": 0, "searches_waiting": 0, "commits_running": 0, "commits_by_shop": {}}
+_admission_cond = threading.Condition()
+_search_flights = {}  # (shop_id, query, generation, include_debug) -> _Flight
+_search_flights_lock = threading.Lock()
+
+def admit_search(shop_id):
+    """Take from the shop's bucket; returns 0 when admitted, else seconds to wait before retrying"""
+    if SEARCH_RATE_PER_SHOP <= 0:
+        return 0.0
+    with _admission_cond:
+        bucket = search_buckets.get(shop_id)
+        if bucket is None:
+            bucket = search_buckets[shop_id] = TokenBucket(SEARCH_RATE_PER_SHOP, SEARCH_BURST_PER_SHOP)
+        retry_after = bucket.take()
+    if retry_after:
+        inc_counter("search_admission_total", outcome="shed_rate")
+    return retry_after
+
+def acquire_search_slot(shop_id):
+    """Wait for a search slot not reserved by a sale commit and for the shop's own commits; False if none frees up in time"""
+    with _admission_cond:
+        def free():
+            slots = max(1, SEARCH_MAX_CONCURRENCY - admission_state["commits_running"])
+            return (admission_state["searches_running"] < slots
+                    and shop_id not in admission_state["commits_by_shop"])
+        if not free():
+            if admission_state["searches_waiting"] >= SEARCH_MAX_WAITING:
+                inc_counter("search_admission_total", outcome="shed_overload")
+                return False
+            start = time.perf_counter()
+            inc_counter("search_admission_total", outcome="queued")
+            admission_state["searches_waiting"] += 1
+            try:
+                admitted = _admission_cond.wait_for(free, SEARCH_QUEUE_TIMEOUT_SECONDS)
+            finally:
+                admission_state["searches_waiting"] -= 1
+            observe_histogram("search_queue_wait_seconds", time.perf_counter() - start)
+            if not admitted:
+                inc_counter("search_admission_total", outcome="shed_overload")
+                return False
+        admission_state["searches_running"] += 1
+    inc_counter("search_admission_total", outcome="admitted")
+    return True
+
+def release_search_slot():
+    with _admission_cond:
+        admission_state["searches_running"] -= 1
+        _admission_cond.notify()
+
+def single_flight_search(shop_id, key, compute):
+    """compute() in one of shop_id's search slots, once for concurrent identical searches; returns (results, coalesced)"""
+    with _search_flights_lock:
+        flight = _search_flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _search_flights[key] = _Flight()
+
+    if not leader:
+        with _admission_cond:
+            if admission_state["searches_waiting"] >= SEARCH_MAX_WAITING:
+                inc_counter("search_admission_total", outcome="shed_overload")
+                raise SearchOverloaded()
+            admission_state["searches_waiting"] += 1
+        inc_counter("search_admission_total", outcome="coalesced")
+        try:
+            finished = flight.done.wait(SEARCH_QUEUE_TIMEOUT_SECONDS + 5)
+        finally:
+            with _admission_cond:
+                admission_state["searches_waiting"] -= 1
+        if not finished:
+            raise SearchOverloaded()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, True
+
+    try:
+        if not acquire_search_slot(shop_id):
+            raise SearchOverloaded()
+        try:
+            flight.result = compute()
+        finally:
+            release_search_slot()
+        return flight.result, False
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _search_flights_lock:
+            _search_flights.pop(key, None)
+        flight.done.set()
+
+@app.before_request
+def begin_sale_commit():
+    # Sale commits reserve a search slot and hold off their own shop's searches until they finish
+    if request.endpoint == "complete_sale":
+        shop_id = (request.get_json(force=True, silent=True) or {}).get("shop_id")
+        with _admission_cond:
+            admission_state["commits_running"] += 1
+            commits_by_shop = admission_state["commits_by_shop"]
+            commits_by_shop[shop_id] = commits_by_shop.get(shop_id, 0) + 1
+        g.sale_commit = shop_id
+
+@app.teardown_request
+def end_sale_commit(exc):
+    if "sale_commit" in g:
+        shop_id = g.pop("sale_commit")
+        with _admission_cond:
+            admission_state["commits_running"] -= 1
+            commits_by_shop = admission_state["commits_by_shop"]
+            commits_by_shop[shop_id] -= 1
+            if not commits_by_shop[shop_id]:
+                del commits_by_shop[shop_id]
+            _admission_cond.notify_all()
+
+def _search_shed(start_time, error, retry_after, status):
+    response = jsonify({
+        "items": [],
+        "meta": {
+            "error": error,
+            "retry_after_s": round(retry_after, 3),
+            "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+        }
+    })
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response, status
+
 # ======================================================
 # OPTIMIZED SALES SEARCH ROUTE - NOW LIGHTNING FAST! ⚡
 # ======================================================
@@ -843,8 +3411,6 @@ def sales():
         # Log minimal info for debugging
         query = (data.get("query") or "").lower().strip()
         shop_id = data.get("shop_id")
-        
-        print(f"\n⚡ SEARCH: '{query}' for shop {shop_id}")
 
         # Validate input
         if not query or len(query) < 2 or not shop_id:
@@ -856,10 +3422,29 @@ def sales():
                 }
             }), 400
 
-        # Use search index for lightning-fast results
-        results = search_index.search(query, shop_id)
+        # Per-shop rate limit before any work (including a first-use shop load)
+        retry_after = admit_search(shop_id)
+        if retry_after:
+            return _search_shed(start_time, "Too many searches for this shop", retry_after, 429)
+
+        # Load the shop on its first search; concurrent first searches share one fetch
+        ensure_shop_loaded(shop_id)
+
+        # Repeated queries come from the shop's result cache; on a miss identical
+        # in-flight searches compute once
+        include_debug = app.config["INCLUDE_DEBUG_PAYLOADS"]
+        try:
+            results, cached = search_index.search_cached(
+                query, shop_id, include_debug=include_debug,
+                compute=lambda generation: single_flight_search(
+                    shop_id, (shop_id, query, generation, include_debug),
+                    lambda: search_index.search(query, shop_id, include_debug=include_debug))[0])
+        except SearchOverloaded:
+            return _search_shed(start_time, "Search is busy, please retry", SEARCH_QUEUE_TIMEOUT_SECONDS, 503)
         
         processing_time = (time.time() - start_time) * 1000
+        log_event("search", shop_id=shop_id, query=query, results=len(results), cached=cached,
+                  duration_ms=round(processing_time, 2))
         
         return jsonify({
             "items": results,
@@ -874,9 +3459,7 @@ def sales():
         }), 200
 
     except Exception as e:
-        import traceback
-        print(f"❌ SEARCH ERROR: {e}")
-        traceback.print_exc()
+        log_event("search_failed", logging.ERROR, exc_info=True, error=str(e))
         
         return jsonify({
             "items": [],
@@ -886,6 +3469,86 @@ def sales():
             }
         }), 500
 
+# ======================================================
+# BARCODE / SKU SCAN
+# ======================================================
+# Scanner tills look a code up per scan, often several a second. The lookup is
+# a dict hit in the shop's shard, so scans skip the search admission control.
+@app.route("/scan", methods=["POST"])
+def scan():
+    """
+    Exact barcode / SKU lookup: {"shop_id", "code", "quantity": 1}.
+    Returns the matching item or selling unit in the /sales result shape plus
+    its FIFO batch allocation for `quantity`, ready to add to the cart.
+    """
+    start_time = time.time()
+    data = request.get_json(silent=True) or {}
+    shop_id = data.get("shop_id")
+    code = normalize_code(data.get("code"))
+    try:
+        quantity = float(data.get("quantity") or 1)
+    except (TypeError, ValueError):
+        quantity = 0
+
+    if not shop_id or not code or not math.isfinite(quantity) or quantity <= 0:
+        return jsonify({
+            "item": None,
+            "meta": {
+                "error": "shop_id, code and a positive quantity are required",
+                "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+            }
+        }), 400
+
+    try:
+        ensure_shop_loaded(shop_id)
+        record = search_index.lookup_code(shop_id, code)
+        if record is None:
+            log_event("scan", shop_id=shop_id, code=code, found=False)
+            return jsonify({
+                "item": None,
+                "meta": {
+                    "error": f"No item with code {code}",
+                    "code": code,
+                    "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+                }
+            }), 404
+
+        item = search_index.format_match({"score": 100, "data": record, "match_type": "code"},
+                                         app.config["INCLUDE_DEBUG_PAYLOADS"])
+        if record.type == "main_item":
+            allocation = allocate_main_item_fifo(record.batches, quantity)
+        else:
+            allocation = allocate_selling_unit_fifo(record.item.batches, quantity, float(record.conversion_factor))
+        if allocation["success"]:
+            # BatchRecords carry buy prices - the till only needs the batch ids
+            allocation["allocation"] = [{key: value for key, value in entry.items() if key != "batch_info"}
+                                        for entry in allocation["allocation"]]
+
+        processing_time = (time.time() - start_time) * 1000
+        log_event("scan", shop_id=shop_id, code=code, found=True, type=record.type,
+                  can_fulfill=allocation["success"], duration_ms=round(processing_time, 2))
+
+        return jsonify({
+            "item": item,
+            "allocation": allocation,
+            "meta": {
+                "shop_id": shop_id,
+                "code": code,
+                "quantity": quantity,
+                "processing_time_ms": round(processing_time, 2)
+            }
+        }), 200
+
+    except Exception as e:
+        log_event("scan_failed", logging.ERROR, exc_info=True, shop_id=shop_id, error=str(e))
+        return jsonify({
+            "item": None,
+            "meta": {
+                "error": str(e),
+                "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+            }
+        }), 500
+
 # ======================================================
 # COMPLETE SALE ROUTE
 # ======================================================
@@ -894,6 +3557,8 @@ def complete_sale():
     """
     COMPLETE SALE (FIXED CONVERSION LOGIC)
     """
+    from firebase_admin import firestore
+
     try:
         data = request.get_json(force=True)
         shop_id = data.get("shop_id")
@@ -903,14 +3568,28 @@ def complete_sale():
         if not shop_id or not items:
             return jsonify({"success": False, "error": "Missing shop_id or items"}), 400
 
+        if db is None:
+            return jsonify({"success": False, "error": "Database connection not available"}), 503
+
+        # Keep the shop resident so its item listener patches the stock this sale changes
+        ensure_shop_loaded(shop_id)
+
         updated_items = []
 
-        print("\n🔥 COMPLETE SALE REQUEST")
-        print(f"Shop ID: {shop_id} | Items: {len(items)}")
+        log_event("complete_sale", shop_id=shop_id, items=len(items))
+
+        # Read every item the cart touches in one get_all; lines for the same item
+        # then share (and keep deducting from) one copy of its document
+        items_col = db.collection("Shops").document(shop_id).collection("categories")
+        line_refs = {
+            (line.get("category_id"), line.get("item_id")):
+                items_col.document(line.get("category_id")).collection("items").document(line.get("item_id"))
+            for line in items if line.get("category_id") and line.get("item_id")
+        }
+        item_docs = dict(zip(line_refs, fs.get_all(line_refs.values())))
+        item_states = {}
 
         for idx, cart_item in enumerate(items):
-            print(f"\n📦 Processing item {idx + 1}")
-            
             item_id = cart_item.get("item_id")
             category_id = cart_item.get("category_id")
             batch_id = cart_item.get("batch_id") or cart_item.get("batchId")
@@ -918,10 +3597,16 @@ def complete_sale():
             unit = cart_item.get("unit", "unit")
             conversion_factor = float(cart_item.get("conversion_factor", 1))
             item_type = cart_item.get("type", "main_item")
-            
-            print(f"   Type: {item_type}")
-            print(f"   Quantity entered: {quantity}")
-            print(f"   Conversion factor: {conversion_factor}")
+            sell_unit_id = cart_item.get("sell_unit_id")
+
+            # The cached selling unit's factor is the one search priced and counted availability with
+            cached_unit = search_index.get_record(shop_id, item_id, sell_unit_id) \
+                if item_type == "selling_unit" and sell_unit_id else None
+            if cached_unit is not None and cached_unit.conversion_factor:
+                conversion_factor = float(cached_unit.conversion_factor)
+
+            sale_trace(shop_id, "sale_item", index=idx + 1, item_id=item_id, type=item_type,
+                       quantity=quantity, conversion_factor=conversion_factor)
 
             if not item_id or not category_id or not batch_id or quantity <= 0:
                 return jsonify({
@@ -930,24 +3615,17 @@ def complete_sale():
                     "item": cart_item
                 }), 400
 
-            # Firestore path to item
-            item_ref = (
-                db.collection("Shops")
-                .document(shop_id)
-                .collection("categories")
-                .document(category_id)
-                .collection("items")
-                .document(item_id)
-            )
-
-            item_doc = item_ref.get()
+            item_ref = line_refs[(category_id, item_id)]
+            item_doc = item_docs[(category_id, item_id)]
             if not item_doc.exists:
                 return jsonify({
                     "success": False,
                     "error": f"Item {item_id} not found"
                 }), 404
 
-            item_data = item_doc.to_dict()
+            item_data = item_states.get((category_id, item_id))
+            if item_data is None:
+                item_data = item_states[(category_id, item_id)] = item_doc.to_dict()
             batches = item_data.get("batches", [])
             total_stock = float(item_data.get("stock", 0))
 
@@ -965,25 +3643,26 @@ def complete_sale():
             # CRITICAL FIX: CONVERSION LOGIC
             if item_type == "selling_unit":
                 base_qty = quantity / conversion_factor
-                print(f"   Selling unit: {quantity} units ÷ {conversion_factor} = {base_qty} base units")
             else:
                 base_qty = quantity
-                print(f"   Main item: {quantity} base units")
 
-            print(f"   Batch available: {batch_qty} base units")
-            print(f"   Required to deduct: {base_qty} base units")
+            sale_trace(shop_id, "sale_item_batch", item_id=item_id, batch_id=batch_id,
+                       batch_available=batch_qty, base_units_required=base_qty)
 
             if batch_qty < base_qty:
+                details = {
+                    "item_type": item_type,
+                    "quantity_requested": quantity,
+                    "conversion_factor": conversion_factor,
+                    "base_units_needed": base_qty,
+                    "base_units_available": batch_qty
+                }
+                if cached_unit is not None:
+                    details["selling_units_available"] = cached_unit.total_units_available
                 return jsonify({
                     "success": False,
                     "error": f"Insufficient stock in batch {batch_id}. Available: {batch_qty} base units, requested: {base_qty} base units",
-                    "details": {
-                        "item_type": item_type,
-                        "quantity_requested": quantity,
-                        "conversion_factor": conversion_factor,
-                        "base_units_needed": base_qty,
-                        "base_units_available": batch_qty
-                    }
+                    "details": details
                 }), 400
 
             # Deduct stock
@@ -1019,13 +3698,17 @@ def complete_sale():
             stock_transactions.append(stock_txn)
 
             # Update Firestore
-            item_ref.update({
+            fs.update(item_ref, {
                 "batches": batches,
                 "stock": new_total_stock,
                 "stockTransactions": stock_transactions,
                 "lastStockUpdate": firestore.SERVER_TIMESTAMP,
                 "lastTransactionId": stock_txn["id"]
             })
+            item_data["stock"] = new_total_stock
+            item_data["stockTransactions"] = stock_transactions
+            apply_sale_to_cache(shop_id, item_id, batch_id, batches[batch_index]["quantity"], new_total_stock,
+                                base_qty, stock_txn["timestamp"])
 
             exhausted = batches[batch_index]["quantity"] == 0
 
@@ -1041,9 +3724,10 @@ def complete_sale():
                 "total_price": total_price
             })
 
-            print(f"   ✅ Deducted: {base_qty} base units from batch")
-            print(f"   ✅ Remaining in batch: {batches[batch_index]['quantity']}")
-            print(f"   ✅ Total price: ${total_price}")
+            sale_trace(shop_id, "sale_item_deducted", item_id=item_id, batch_id=batch_id, base_units_deducted=base_qty,
+                       remaining_batch_quantity=batches[batch_index]["quantity"], total_price=total_price)
+
+        touch_shop_activity(shop_id)
 
         return jsonify({
             "success": True,
@@ -1052,69 +3736,112 @@ def complete_sale():
         }), 200
 
     except Exception as e:
-        print("🔥 COMPLETE SALE ERROR:", str(e))
-        import traceback
-        traceback.print_exc()
+        log_event("complete_sale_failed", logging.ERROR, exc_info=True, error=str(e))
         return jsonify({"success": False, "error": str(e)}), 500
 
 # ======================================================
 # ITEM OPTIMIZATION (UPDATED WITH BATCH INFO)
 # ======================================================
+ITEM_OPTIMIZATION_DEFAULT_LIMIT = 200
+ITEM_OPTIMIZATION_MAX_LIMIT = 1000
+
 @app.route("/item-optimization", methods=["GET"])
 def item_optimization():
-    total_batches = 0
-    items_with_batches = 0
-    items_without_batches = 0
-    
-    for shop in embedding_cache_full["shops"]:
-        for category in shop["categories"]:
-            for item in category["items"]:
-                if item.get("has_batches"):
-                    items_with_batches += 1
-                    total_batches += len(item.get("batches", []))
-                else:
-                    items_without_batches += 1
-    
-    return jsonify({
-        "status": "success",
-        "shops": embedding_cache_full["shops"],
-        "total_shops": embedding_cache_full["total_shops"],
-        "last_updated": embedding_cache_full["last_updated"],
-        "batch_stats": {
-            "total_batches": total_batches,
-            "items_with_batches": items_with_batches,
-            "items_without_batches": items_without_batches,
-            "percentage_with_batches": round(items_with_batches / (items_with_batches + items_without_batches) * 100, 1) if (items_with_batches + items_without_batches) > 0 else 0
-        }
-    })
+    """
+    Shop-scoped catalogue export.
+    Query params: shop_id (required), cursor (offset from previous page),
+    limit, fields (comma separated item keys to keep).
+    Items are streamed one at a time so the worker never holds the full body.
+    """
+    shop_id = request.args.get("shop_id")
+    if not shop_id:
+        return jsonify({"status": "error", "error": "shop_id is required"}), 400
+
+    try:
+        cursor = int(request.args.get("cursor") or 0)
+        limit = int(request.args.get("limit") or ITEM_OPTIMIZATION_DEFAULT_LIMIT)
+    except ValueError:
+        return jsonify({"status": "error", "error": "cursor and limit must be integers"}), 400
+    if cursor < 0 or limit <= 0:
+        return jsonify({"status": "error", "error": "cursor must be >= 0 and limit > 0"}), 400
+    limit = min(limit, ITEM_OPTIMIZATION_MAX_LIMIT)
+
+    fields_param = request.args.get("fields")
+    fields = [f.strip() for f in fields_param.split(",") if f.strip()] if fields_param else None
+
+    if not ensure_shop_loaded(shop_id):
+        return jsonify({"status": "error", "error": f"Shop {shop_id} not found in cache"}), 404
+
+    # Sales patch stock in place and bump only the shop's shard generation
+    etag = cache_etag("item-optimization", shop_id, search_index.shop_generation(shop_id), cursor, limit, fields_param)
+    if etag_matches(etag):
+        return not_modified(etag)
+
+    # Cold shops keep only what search needs; reload the full detail before exporting it
+    shop = get_shop_detail(shop_id)
+
+    # Snapshot the references now - a listener refresh swaps them out wholesale
+    categories = shop["categories"]
+    batch_stats = embedding_cache_full["shop_stats"].get(shop_id, _finalize_batch_stats(_empty_batch_stats()))
+    last_updated = embedding_cache_full["last_updated"]
+
+    def generate():
+        yield '{"status":"success","shop_id":%s,"shop_name":%s,"last_updated":%s,"items":[' % (
+            json.dumps(shop_id), json.dumps(shop["shop_name"]), json.dumps(last_updated)
+        )
+
+        position = 0
+        emitted = 0
+        for category in categories:
+            items = category["items"]
+            # Skip whole categories that sit before the cursor
+            if position + len(items) <= cursor:
+                position += len(items)
+                continue
+            for item in items:
+                if position < cursor:
+                    position += 1
+                    continue
+                if emitted == limit:
+                    break
+                if fields:
+                    item = {key: item[key] for key in fields if key in item}
+                yield ("," if emitted else "") + app.json.dumps(item)
+                emitted += 1
+                position += 1
+            if emitted == limit:
+                break
+
+        next_cursor = cursor + emitted if cursor + emitted < batch_stats["total_items"] else None
+        yield '],"count":%d,"next_cursor":%s,"batch_stats":%s}' % (
+            emitted, json.dumps(next_cursor), json.dumps(batch_stats)
+        )
+
+    response = Response(stream_with_context(generate()), mimetype="application/json")
+    response.set_etag(etag)
+    return response
 
 # ======================================================
 # DEBUG ENDPOINT (UPDATED WITH BATCH INFO)
 # ======================================================
 @app.route("/debug-cache", methods=["GET"])
 def debug_cache():
-    """Debug endpoint to check cache contents (updated with batch tracking)"""
+    """Debug endpoint to check cache contents (updated with batch tracking); live diagnostics, never cached"""
     if not embedding_cache_full["shops"]:
         return jsonify({"error": "Cache empty"}), 404
     
     try:
-        first_shop = embedding_cache_full["shops"][0]
+        # Lazily loaded shops can be empty (new shops are cached too)
+        first_shop = next((shop for shop in embedding_cache_full["shops"] if shop["categories"]), None)
+        if first_shop is None:
+            return jsonify({"error": "No cached shop has items yet"}), 404
         first_category = first_shop["categories"][0]
         first_item = first_category["items"][0]
         
-        total_selling_units = 0
-        total_batches = 0
-        items_with_batches = 0
+        batch_stats = embedding_cache_full["batch_stats"]
+        search_index_counts = search_index.counts()
         
-        for shop in embedding_cache_full["shops"]:
-            for category in shop["categories"]:
-                for item in category["items"]:
-                    total_selling_units += len(item.get("selling_units", []))
-                    total_batches += len(item.get("batches", []))
-                    if item.get("has_batches"):
-                        items_with_batches += 1
-        
-        return jsonify({
+        response = jsonify({
             "first_item": {
                 "name": first_item["name"],
                 "has_sell_price": "sell_price" in first_item or "sellPrice" in first_item,
@@ -1127,22 +3854,301 @@ def debug_cache():
             "cache_details": {
                 "total_shops": len(embedding_cache_full["shops"]),
                 "total_categories": sum(len(shop["categories"]) for shop in embedding_cache_full["shops"]),
-                "total_items": sum(len(category["items"]) for shop in embedding_cache_full["shops"] for category in shop["categories"]),
-                "total_selling_units": total_selling_units,
-                "total_batches": total_batches,
-                "items_with_batches": items_with_batches,
+                "total_items": batch_stats["total_items"],
+                "total_selling_units": batch_stats["total_selling_units"],
+                "total_batches": batch_stats["total_batches"],
+                "items_with_batches": batch_stats["items_with_batches"],
                 "last_updated": embedding_cache_full["last_updated"]
             },
             "search_index": {
                 "built_at": search_index.last_built,
                 "total_items_indexed": search_index.total_items,
                 "total_selling_units_indexed": search_index.total_selling_units,
-                "unique_keywords": len(search_index.word_index)
-            }
+                "shops_indexed": search_index_counts["shops"],
+                "unique_keywords": search_index_counts["words"],
+                "completion_lists": search_index_counts["completion_lists"],
+                "codes": search_index_counts["codes"],
+                "result_cache": search_index.result_cache.summary()
+            },
+            "shop_cache": shop_cache_summary(),
+            "memory": cache_memory_summary(),
+            "cache_bus": cache_bus.summary() if cache_bus is not None else None
         })
+        response.headers["Cache-Control"] = "no-store"
+        return response
     except (IndexError, KeyError) as e:
         return jsonify({"error": f"Cache structure issue: {str(e)}"}), 500
 
+@app.route("/debug/logging", methods=["GET", "POST"])
+def debug_logging():
+    """
+    Inspect or change logging at runtime (admin ID token required).
+    POST body (all optional): {"level": "DEBUG", "sample_rates": {"/sales": 0.1},
+    "trace_shop": "<shop_id>", "untrace_shop": "<shop_id>"}
+    """
+    decoded_token, error_response = require_admin()
+    if error_response:
+        return error_response
+
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        level = str(data.get("level", "")).upper()
+        if level:
+            if level not in ("DEBUG", "INFO", "WARNING", "ERROR"):
+                return jsonify({"success": False, "error": "level must be DEBUG, INFO, WARNING or ERROR"}), 400
+            log.setLevel(level)
+        try:
+            for route, rate in (data.get("sample_rates") or {}).items():
+                LOG_SAMPLE_RATES[route] = min(max(float(rate), 0.0), 1.0)
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "sample_rates must map routes to numbers"}), 400
+        if data.get("trace_shop"):
+            sale_trace_shops.add(data["trace_shop"])
+        if data.get("untrace_shop"):
+            sale_trace_shops.discard(data["untrace_shop"])
+        log_event("logging_reconfigured", logging.WARNING, by=decoded_token.get("email"), change=data)
+
+    return jsonify({
+        "success": True,
+        "level": logging.getLevelName(log.level),
+        "sample_rates": LOG_SAMPLE_RATES,
+        "sale_trace_shops": sorted(sale_trace_shops),
+        "slow_request_ms": SLOW_REQUEST_MS
+    })
+
+# ======================================================
+# PROFILING (admin-only sampling profiler + per-request tracer)
+# ======================================================
+PROFILE_MAX_SECONDS = 60
+PROFILE_DEFAULT_INTERVAL_MS = 5
+TRACE_HEADER = "X-Debug-Trace"
+
+profile_results = TTLCache(maxsize=5, ttl=3600)  # profile id -> SamplingProfiler
+request_traces = TTLCache(maxsize=20, ttl=3600)  # trace id -> report
+_debug_results_lock = threading.Lock()  # guards profile_results and request_traces (gthread workers)
+_profile_lock = threading.Lock()  # one sampling profile per worker at a time
+_trace_lock = threading.Lock()  # cProfile hooks the whole process - one traced request at a time
+
+class SamplingProfiler:
+    """
+    Samples every thread's stack (request handlers, listeners, warm-up) via
+    sys._current_frames() and aggregates collapsed stacks.
+    mode="wall" counts samples; mode="cpu" weights each sample by the thread's
+    CPU time (microseconds) since its previous sample, so idle threads drop out.
+    """
+
+    def __init__(self, seconds, interval_ms, mode):
+        self.id = secrets.token_hex(6)
+        self.seconds = seconds
+        self.interval = interval_ms / 1000
+        self.mode = mode
+        self.stacks = defaultdict(int)
+        self.samples = 0
+        self.status = "running"
+        self.started_at = time.time()
+        self.finished_at = None
+        self._labels = {}  # code object -> frame label
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def run(self):
+        me = threading.get_ident()
+        cpu_clocks, last_cpu = {}, {}
+        deadline = time.monotonic() + self.seconds
+        try:
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    weight = 1
+                    if self.mode == "cpu":
+                        try:
+                            clock = cpu_clocks.get(ident) or cpu_clocks.setdefault(ident, time.pthread_getcpuclockid(ident))
+                            now = time.clock_gettime(clock)
+                        except OSError:  # thread exited between enumerate and here
+                            continue
+                        weight = int((now - last_cpu.get(ident, now)) * 1e6)
+                        last_cpu[ident] = now
+                        if weight <= 0:
+                            continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self._label(frame.f_code))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, f"thread-{ident}"))
+                    self.stacks[";".join(reversed(stack))] += weight
+                self.samples += 1
+                time.sleep(self.interval)
+            self.status = "done"
+        except Exception as e:
+            self.status = f"failed: {e}"
+        finally:
+            self.finished_at = time.time()
+            _profile_lock.release()
+
+    def collapsed(self):
+        """Brendan Gregg collapsed format - feed to flamegraph.pl or speedscope"""
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+    def summary(self, top=25):
+        self_time = defaultdict(int)
+        for stack, count in self.stacks.items():
+            self_time[stack.rsplit(";", 1)[-1]] += count
+        total = sum(self.stacks.values()) or 1
+        return {
+            "profile_id": self.id,
+            "status": self.status,
+            "mode": self.mode,
+            "unit": "cpu_us" if self.mode == "cpu" else "samples",
+            "seconds": self.seconds,
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "top_self": [
+                {"frame": frame, "weight": count, "percent": round(count * 100 / total, 2)}
+                for frame, count in sorted(self_time.items(), key=lambda entry: -entry[1])[:top]
+            ]
+        }
+
+@app.route("/debug/profile", methods=["POST"])
+def start_profile():
+    """
+    Start a bounded sampling profile of this worker in the background (admin only).
+    Body: {"seconds": 10, "interval_ms": 5, "mode": "wall" | "cpu"}
+    Fetch the result from GET /debug/profile/<profile_id>.
+    """
+    _, error_response = require_admin()
+    if error_response:
+        return error_response
+
+    data = request.get_json(silent=True) or {}
+    mode = data.get("mode", "wall")
+    if mode not in ("wall", "cpu"):
+        return jsonify({"success": False, "error": "mode must be wall or cpu"}), 400
+    if mode == "cpu" and not hasattr(time, "pthread_getcpuclockid"):
+        return jsonify({"success": False, "error": "cpu mode needs per-thread CPU clocks (Linux/macOS)"}), 400
+    try:
+        seconds = min(max(float(data.get("seconds", 10)), 0.1), PROFILE_MAX_SECONDS)
+        interval_ms = min(max(float(data.get("interval_ms", PROFILE_DEFAULT_INTERVAL_MS)), 1), 1000)
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "seconds and interval_ms must be numbers"}), 400
+
+    if not _profile_lock.acquire(blocking=False):
+        return jsonify({"success": False, "error": "A profile is already running on this worker"}), 409
+    profiler = SamplingProfiler(seconds, interval_ms, mode)
+    with _debug_results_lock:
+        profile_results[profiler.id] = profiler
+    threading.Thread(target=profiler.run, name="sampling-profiler", daemon=True).start()
+    log_event("profile_started", logging.WARNING, profile_id=profiler.id, mode=mode, seconds=seconds)
+
+    return jsonify({
+        "success": True,
+        "profile_id": profiler.id,
+        "seconds": seconds,
+        "interval_ms": interval_ms,
+        "mode": mode,
+        "result_url": f"/debug/profile/{profiler.id}"
+    }), 202
+
+@app.route("/debug/profile/<profile_id>", methods=["GET"])
+def get_profile(profile_id):
+    """Profile result (admin only): ?format=collapsed (default, flamegraph-ready) or json"""
+    _, error_response = require_admin()
+    if error_response:
+        return error_response
+
+    with _debug_results_lock:
+        profiler = profile_results.get(profile_id)
+    if profiler is None:
+        return jsonify({"success": False, "error": "Unknown or expired profile"}), 404
+    if profiler.status == "running":
+        return jsonify({"success": True, **profiler.summary(top=0)}), 202
+
+    if request.args.get("format") == "json":
+        return jsonify({"success": True, **profiler.summary()})
+    response = Response(profiler.collapsed(), mimetype="text/plain")
+    response.headers["Content-Disposition"] = f"attachment; filename=profile-{profile_id}-{profiler.mode}.collapsed"
+    return response
+
+@app.before_request
+def start_request_trace():
+    # Admins can trace a single request by sending X-Debug-Trace: 1 with their ID token;
+    # anyone else's header is ignored and the request is served untraced
+    if TRACE_HEADER not in request.headers:
+        return None
+    _, error_response = require_admin()
+    if error_response:
+        return None
+    if not _trace_lock.acquire(blocking=False):
+        return None  # another request is being traced
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiling tool is active (3.12+ allows only one)
+        _trace_lock.release()
+        return None
+    g.request_profiler = profiler
+    g.request_trace_locked = True
+    return None
+
+@app.after_request
+def finish_request_trace(response):
+    profiler = g.pop("request_profiler", None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    import io
+    import pstats
+
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(40)
+    trace_id = secrets.token_hex(6)
+    trace = {
+        "trace_id": trace_id,
+        "method": request.method,
+        "path": request.full_path,
+        "status": response.status_code,
+        "duration_ms": round((time.perf_counter() - g.request_started) * 1000, 2),
+        "firestore_reads": g.get("firestore_reads", 0),
+        "firestore_writes": g.get("firestore_writes", 0),
+        "created_at": time.time(),
+        "report": report.getvalue()
+    }
+    with _debug_results_lock:
+        request_traces[trace_id] = trace
+    response.headers["X-Debug-Trace-Id"] = trace_id
+    return response
+
+@app.teardown_request
+def end_request_trace(exc):
+    if g.pop("request_trace_locked", False):
+        profiler = g.pop("request_profiler", None)
+        if profiler is not None:  # the request failed before finish_request_trace ran
+            profiler.disable()
+        _trace_lock.release()
+
+@app.route("/debug/traces/<trace_id>", methods=["GET"])
+def get_request_trace(trace_id):
+    """cProfile report of one traced request (admin only); ?format=text for the raw report"""
+    _, error_response = require_admin()
+    if error_response:
+        return error_response
+    with _debug_results_lock:
+        trace = request_traces.get(trace_id)
+    if trace is None:
+        return jsonify({"success": False, "error": "Unknown or expired trace"}), 404
+    if request.args.get("format") == "text":
+        return Response(trace["report"], mimetype="text/plain")
+    return jsonify({"success": True, **trace})
+
 # ======================================================
 # PLAN INITIALIZATION ROUTES
 # ======================================================
@@ -1152,9 +4158,11 @@ def ensure_plan():
     Ensure a default plan exists for a given shop.
     Creates a 'Solo' plan only if none exists.
     """
+    from firebase_admin import firestore
+
     try:
         if db is None:
-            print("❌ Firebase not initialized - cannot ensure plan")
+            log_event("ensure_plan_unavailable", logging.ERROR, reason="Firebase not initialized")
             return jsonify({
                 "success": False,
                 "error": "Database connection not available",
@@ -1170,7 +4178,16 @@ def ensure_plan():
                 "error": "shop_id is required"
             }), 400
 
-        print(f"📝 Ensuring plan for shop: {shop_id}")
+        log_event("ensure_plan", shop_id=shop_id)
+        with _missing_shops_lock:
+            missing_shops.pop(shop_id, None)  # a new shop may have been looked up before its doc existed
+
+        # Answer from the entitlement cache when we already know a plan exists
+        if get_entitlements(shop_id)["plan_exists"]:
+            return jsonify({
+                "success": True,
+                "message": "Plan already exists for this shop."
+            })
 
         plan_ref = (
             db.collection("Shops")
@@ -1179,7 +4196,7 @@ def ensure_plan():
               .document("default")
         )
 
-        plan_doc = plan_ref.get()
+        plan_doc = fs.get(plan_ref)
         if plan_doc.exists:
             return jsonify({
                 "success": True,
@@ -1199,8 +4216,9 @@ def ensure_plan():
             "updatedAt": firestore.SERVER_TIMESTAMP
         }
 
-        plan_ref.set(default_plan)
-        print(f"✅ Default plan initialized for shop: {shop_id}")
+        fs.set(plan_ref, default_plan)
+        invalidate_entitlements(shop_id)
+        log_event("default_plan_initialized", shop_id=shop_id)
 
         return jsonify({
             "success": True,
@@ -1208,15 +4226,194 @@ def ensure_plan():
         })
 
     except Exception as e:
-        print(f"🔥 ensure-plan error: {e}")
-        import traceback
-        traceback.print_exc()
+        log_event("ensure_plan_failed", logging.ERROR, exc_info=True, error=str(e))
         return jsonify({
             "success": False,
             "error": "Internal server error",
             "details": str(e)
         }), 500
 
+# ======================================================
+# STAFF LOGIN LOOKUP
+# ======================================================
+def verify_request_token():
+    """Verify the Firebase ID token in `Authorization: Bearer <token>`; returns (claims, error response)"""
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None, (jsonify({"success": False, "error": "Missing ID token"}), 401)
+
+    from firebase_admin import auth
+
+    try:
+        return auth.verify_id_token(auth_header[len("Bearer "):]), None
+    except Exception as e:
+        return None, (jsonify({"success": False, "error": "Invalid ID token", "details": str(e)}), 401)
+
+def require_admin():
+    """verify_request_token() plus an ADMIN_EMAILS check; returns (claims, error response)"""
+    decoded_token, error_response = verify_request_token()
+    if error_response:
+        return None, error_response
+    if _normalize_email(decoded_token.get("email")) not in ADMIN_EMAILS:
+        return None, (jsonify({"success": False, "error": "Admin access required"}), 403)
+    return decoded_token, None
+
+@app.route("/staff-lookup", methods=["POST"])
+def staff_lookup():
+    """
+    Resolve which shop a staff email belongs to from the in-memory staff index.
+    Requires a Firebase ID token (Authorization: Bearer <token>). Callers may look
+    up their own email, or - as a shop owner - staff registered in their own shop.
+    """
+    if db is None:
+        return jsonify({"success": False, "error": "Database connection not available"}), 503
+
+    if staff_index["last_updated"] is None:
+        return jsonify({"success": False, "error": "Staff index not ready"}), 503
+
+    decoded_token, error_response = verify_request_token()
+    if error_response:
+        return error_response
+
+    data = request.get_json(silent=True) or {}
+    token_email = _normalize_email(decoded_token.get("email"))
+    email = _normalize_email(data.get("email")) or token_email
+
+    matches = lookup_staff_by_email(email)
+    if email != token_email:
+        # Owners (shop_id == owner uid) may only see their own shop's staff
+        matches = [m for m in matches if m["shopId"] == decoded_token.get("uid")]
+
+    if not matches:
+        return jsonify({"success": True, "found": False}), 404
+
+    staff = matches[0]
+    cached_shop = get_shop_from_cache(staff["shopId"])
+    if cached_shop and cached_shop["shop_name"]:
+        staff["shopName"] = cached_shop["shop_name"]
+    staff["plan"] = get_entitlements(staff["shopId"])["plan_name"]
+
+    return jsonify({
+        "success": True,
+        "found": True,
+        "staff": staff,
+        "other_shop_ids": [m["shopId"] for m in matches[1:]]
+    })
+
+def authorize_shop_member(shop_id):
+    """verify_request_token() plus: caller owns the shop, is one of its staff, or is an admin; returns (claims, error response)"""
+    decoded_token, error_response = verify_request_token()
+    if error_response:
+        return None, error_response
+    email = _normalize_email(decoded_token.get("email"))
+    if (
+        decoded_token.get("uid") != shop_id
+        and email not in ADMIN_EMAILS
+        and not any(m["shopId"] == shop_id for m in lookup_staff_by_email(email))
+    ):
+        return None, (jsonify({"success": False, "error": "Not a member of this shop"}), 403)
+    return decoded_token, None
+
+@app.route("/entitlements", methods=["GET"])
+def entitlements():
+    """Plan limits and current usage for a shop, answered from memory"""
+    shop_id = request.args.get("shop_id")
+    if not shop_id:
+        return jsonify({"success": False, "error": "shop_id is required"}), 400
+
+    _, error_response = authorize_shop_member(shop_id)
+    if error_response:
+        return error_response
+
+    can_add_item, items = check_entitlement(shop_id, "items")
+    can_add_staff, staff = check_entitlement(shop_id, "staff")
+    plan = get_entitlements(shop_id)
+
+    return jsonify({
+        "success": True,
+        "shop_id": shop_id,
+        "plan_id": plan["plan_id"],
+        "plan_name": plan["plan_name"],
+        "features": plan["features"],
+        "items": items,
+        "staff": staff,
+        "can_add_item": can_add_item,
+        "can_add_staff": can_add_staff
+    })
+
+# ======================================================
+# ITEM & STAFF CREATION (PLAN LIMITS ENFORCED)
+# ======================================================
+STAFF_FIELDS = ("name", "email", "phone", "roleName", "accessLevel")
+
+@app.route("/add-item", methods=["POST"])
+def add_item():
+    """
+    Create an item in a category if the shop's plan allows another one.
+    Body: shop_id, category_id, item (document fields; name required).
+    403 with the plan usage when the item limit is reached.
+    """
+    if db is None:
+        return jsonify({"success": False, "error": "Database connection not available"}), 503
+    data = request.get_json(silent=True) or {}
+    shop_id = data.get("shop_id")
+    category_id = data.get("category_id")
+    item = data.get("item")
+    if not shop_id or not category_id or not isinstance(item, dict) or not str(item.get("name") or "").strip():
+        return jsonify({"success": False, "error": "shop_id, category_id and item.name are required"}), 400
+
+    _, error_response = authorize_shop_member(shop_id)
+    if error_response:
+        return error_response
+
+    item_ref = db.collection("Shops").document(shop_id).collection("categories").document(category_id) \
+        .collection("items").document()
+    fields = dict(item, categoryId=category_id, createdAt=int(time.time() * 1000))
+    try:
+        created, details = create_within_entitlement(shop_id, "items", item_ref, fields)
+    except Exception as e:
+        log_event("add_item_failed", logging.ERROR, exc_info=True, shop_id=shop_id, error=str(e))
+        return jsonify({"success": False, "error": "Could not create item", "details": str(e)}), 500
+    if not created:
+        return jsonify({"success": False, "allowed": False, "error": "Plan limit reached", **details}), 403
+    log_event("item_created", shop_id=shop_id, category_id=category_id, item_id=item_ref.id)
+    return jsonify({"success": True, "item_id": item_ref.id, **details}), 201
+
+@app.route("/add-staff", methods=["POST"])
+def add_staff():
+    """
+    Register a staff member if the shop's plan has a free seat.
+    Body: shop_id, staff (name, email, phone, roleName, accessLevel).
+    403 with the plan usage when the staff limit is reached.
+    """
+    from firebase_admin import firestore
+
+    if db is None:
+        return jsonify({"success": False, "error": "Database connection not available"}), 503
+    data = request.get_json(silent=True) or {}
+    shop_id = data.get("shop_id")
+    staff = data.get("staff")
+    if not shop_id or not isinstance(staff, dict) or not _normalize_email(staff.get("email")):
+        return jsonify({"success": False, "error": "shop_id and staff.email are required"}), 400
+
+    _, error_response = authorize_shop_member(shop_id)
+    if error_response:
+        return error_response
+
+    staff_id = f"staff_{shop_id[:6].upper()}_{int(time.time() * 1000)}_{secrets.token_hex(3)}"  # staff_{shop prefix}_{ms}_{random}
+    staff_ref = db.collection("Shops").document(shop_id).collection("staff").document(staff_id)
+    fields = {field: staff[field] for field in STAFF_FIELDS if field in staff}
+    fields.update(createdAt=firestore.SERVER_TIMESTAMP, updatedAt=firestore.SERVER_TIMESTAMP)
+    try:
+        created, details = create_within_entitlement(shop_id, "staff", staff_ref, fields)
+    except Exception as e:
+        log_event("add_staff_failed", logging.ERROR, exc_info=True, shop_id=shop_id, error=str(e))
+        return jsonify({"success": False, "error": "Could not add staff member", "details": str(e)}), 500
+    if not created:
+        return jsonify({"success": False, "allowed": False, "error": "Plan limit reached", **details}), 403
+    log_event("staff_created", shop_id=shop_id, staff_id=staff_id)
+    return jsonify({"success": True, "staff_id": staff_id, **details}), 201
+
 # ======================================================
 # ADMIN DASHBOARD
 # ======================================================
@@ -1224,6 +4421,74 @@ def ensure_plan():
 def admin():
     return render_template("admindashboard.html")
 
+@app.route("/admin/upgrade-requests", methods=["GET"])
+def admin_upgrade_requests():
+    """
+    Paginated upgrade-request summary for the admin dashboard, answered from the
+    upgradeRequests index. Requires an ID token for an email listed in ADMIN_EMAILS.
+    Query: category=paid|requested|verified, status, cursor, limit (default 100, max 500).
+    """
+    if upgrade_requests["last_updated"] is None:
+        return jsonify({"success": False, "error": "Upgrade request index not ready"}), 503
+
+    decoded_token, error_response = require_admin()
+    if error_response:
+        return error_response
+
+    category = request.args.get("category") or None
+    if category and category not in UPGRADE_CATEGORIES:
+        return jsonify({"success": False, "error": f"category must be one of {', '.join(UPGRADE_CATEGORIES)}"}), 400
+    try:
+        cursor = max(int(request.args.get("cursor", 0)), 0)
+        limit = min(max(int(request.args.get("limit", 100)), 1), 500)
+    except ValueError:
+        return jsonify({"success": False, "error": "cursor and limit must be integers"}), 400
+    status = request.args.get("status") or None
+
+    # Shop names come from the item cache, so its generation is part of the ETag too
+    etag = cache_etag("upgrade-requests", upgrade_requests["generation"], category, status, cursor, limit)
+    if etag_matches(etag):
+        return not_modified(etag)
+
+    counts, records, next_cursor = summarize_upgrade_requests(category, status, cursor, limit)
+    response = jsonify({
+        "success": True,
+        "counts": counts,
+        "requests": records,
+        "count": len(records),
+        "next_cursor": next_cursor,
+        "generation": upgrade_requests["generation"],
+        "last_updated": upgrade_requests["last_updated"]
+    })
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+@app.route("/upgrade-requests/by-reference/<reference>", methods=["GET"])
+def upgrade_requests_by_reference(reference):
+    """
+    O(1) M-Pesa reference lookup. Admins see every request quoting the reference;
+    shop owners see their own requests plus whether another shop already used it.
+    """
+    if upgrade_requests["last_updated"] is None:
+        return jsonify({"success": False, "error": "Upgrade request index not ready"}), 503
+
+    decoded_token, error_response = verify_request_token()
+    if error_response:
+        return error_response
+
+    matches = lookup_upgrade_requests_by_reference(reference)
+    is_admin = _normalize_email(decoded_token.get("email")) in ADMIN_EMAILS
+    visible = matches if is_admin else [m for m in matches if m["shopId"] == decoded_token.get("uid")]
+
+    return jsonify({
+        "success": True,
+        "reference": _normalize_mpesa_reference(reference),
+        "in_use": bool(matches),
+        "used_by_other_shop": any(m["shopId"] != decoded_token.get("uid") for m in matches),
+        "requests": visible
+    })
+
 # ======================================================
 # TEST SELLING UNITS ENDPOINT
 # ======================================================
@@ -1238,7 +4503,7 @@ def test_selling_units():
             return jsonify({"error": "shop_id and item_id required"}), 400
         
         items_ref = db.collection("Shops").document(shop_id).collection("items").document(item_id)
-        item_doc = items_ref.get()
+        item_doc = fs.get(items_ref)
         
         if not item_doc.exists:
             return jsonify({"error": "Item not found"}), 404
@@ -1246,7 +4511,7 @@ def test_selling_units():
         item_data = item_doc.to_dict()
         
         sell_units_ref = items_ref.collection("sellUnits")
-        sell_units_docs = list(sell_units_ref.stream())
+        sell_units_docs = fs.stream(sell_units_ref)
         
         result = {
             "item_name": item_data.get("name"),
@@ -1282,28 +4547,182 @@ def google_verify():
     return send_from_directory('.', 'google0da523514258b2c9.html')
 
 # ======================================================
-# RUN SERVER
+# WARM-UP (FIREBASE + CACHE + LISTENERS, IN BACKGROUND)
 # ======================================================
-print("[INIT] Preloading FULL cache (with batch tracking)...")
-try:
-    db = get_firebase_client()
-    refresh_full_item_cache()
-    print("✅ Cache and search index initialized successfully")
-except Exception as e:
-    print(f"⚠️ Cache initialization error: {e}")
-    print("⚠️ Continuing anyway - cache will populate on first request")
-
-# Set up listeners for both main items AND selling units
-print("[INIT] Setting up Firestore listeners...")
-try:
-    if db:
-        db.collection_group("items").on_snapshot(on_full_item_snapshot)
-        db.collection_group("sellUnits").on_snapshot(on_selling_units_snapshot)
-        print("[READY] Listeners active for items and selling units")
-except Exception as e:
-    print(f"⚠️ Listener setup error: {e}")
+WARMUP_RETRY_SECONDS = 30
+
+warmup_state = {
+    "status": "pending",  # pending -> warming -> ready | failed
+    "started_at": None,
+    "ready_at": None,
+    "failed_at": None,
+    "error": None,
+    "steps_ms": {}
+}
+_warmup_lock = threading.Lock()
+
+def _warmup_step(name, fn):
+    start = time.time()
+    result = fn()
+    warmup_state["steps_ms"][name] = round((time.time() - start) * 1000, 2)
+    return result
+
+def _attach_listeners():
+    if cache_bus is None:
+        _attach_catalogue_listeners()  # otherwise the bus attaches them on whichever instance leads
+    db.collection_group("staff").on_snapshot(on_staff_snapshot)
+    db.collection_group("plan").on_snapshot(on_plan_snapshot)
+    db.collection_group("upgradeRequests").on_snapshot(on_upgrade_request_snapshot)
+    log_event("listeners_attached", collections=list(catalogue_watches) + ["staff", "plan", "upgradeRequests"])
+
+def warm_up():
+    """Connect Firebase and attach listeners; shops load on first use unless CACHE_PRELOAD_ALL_SHOPS=1"""
+    global db
+    log_event("warmup_started")
+    try:
+        db = _warmup_step("firebase", get_firebase_client)
+        _warmup_step("cache_bus", start_cache_bus)
+        if CACHE_PRELOAD_ALL_SHOPS:
+            _warmup_step("cache", refresh_full_item_cache)
+        _warmup_step("listeners", _attach_listeners)
+        threading.Thread(target=_shop_cache_janitor, name="shop-cache-janitor", daemon=True).start()
+        warmup_state["status"] = "ready"
+        warmup_state["ready_at"] = time.time()
+        log_event("warmup_complete", duration_ms=round((warmup_state["ready_at"] - warmup_state["started_at"]) * 1000, 2),
+                  steps_ms=warmup_state["steps_ms"])
+    except Exception as e:
+        warmup_state["status"] = "failed"
+        warmup_state["failed_at"] = time.time()
+        warmup_state["error"] = str(e)
+        log_event("warmup_failed", logging.ERROR, exc_info=True, error=str(e), retry_after_s=WARMUP_RETRY_SECONDS)
+
+def start_warmup():
+    """Start warm_up() in a background thread once per process (retries after failures)"""
+    with _warmup_lock:
+        status = warmup_state["status"]
+        if status in ("warming", "ready"):
+            return
+        if status == "failed" and time.time() - warmup_state["failed_at"] < WARMUP_RETRY_SECONDS:
+            return
+        warmup_state["status"] = "warming"
+        warmup_state["started_at"] = time.time()
+        warmup_state["error"] = None
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+@app.before_request
+def ensure_warmup_started():
+    # Normally started by gunicorn's post_worker_init hook; this covers other servers
+    if warmup_state["status"] in ("pending", "failed"):
+        start_warmup()
 
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness probe - 200 once Firebase and listeners are up (and the cache, when preloading)"""
+    is_ready = warmup_state["status"] == "ready"
+    return jsonify({
+        "ready": is_ready,
+        "status": warmup_state["status"],
+        "error": warmup_state["error"],
+        "steps_ms": warmup_state["steps_ms"],
+        "cache_last_updated": embedding_cache_full["last_updated"]
+    }), 200 if is_ready else 503
+
+# ======================================================
+# METRICS ENDPOINT
+# ======================================================
+def _metric_gauges():
+    """(name, help, value) read straight from the in-memory indexes at scrape time"""
+    index_counts = search_index.counts()
+    return [
+        ("cache_generation", "Shop cache generation (bumps on every shop load, patch or eviction)", embedding_cache_full["generation"]),
+        ("cache_last_updated_timestamp_seconds", "Unix time of the last cache rebuild", embedding_cache_full["last_updated"] or 0),
+        ("cache_shops", "Shops resident in the cache", embedding_cache_full["total_shops"]),
+        ("shop_cache_listeners", "Per-shop snapshot listeners attached", shop_cache_summary()["listeners"]),
+        ("cache_memory_bytes", "Approximate deep size of the full shop cache", cache_memory["total_bytes"]),
+        ("cache_memory_budget_bytes", "Configured cache budget (0 = unlimited)", CACHE_MEMORY_BUDGET_MB * 1024 * 1024),
+        ("cache_compact_shops", "Cold shops holding only search fields",
+         sum(1 for shop in embedding_cache_full["shops"] if shop.get("detail") == "compact")),
+        ("search_index_items", "Main items in the search index", search_index.total_items),
+        ("search_index_selling_units", "Selling units in the search index", search_index.total_selling_units),
+        ("search_index_keys", "Documents in the search index", index_counts["keys"]),
+        ("search_index_words", "Distinct words summed over shop shards", index_counts["words"]),
+        ("search_index_prefixes", "Distinct prefixes summed over shop shards", index_counts["prefixes"]),
+        ("search_index_completion_lists", "Prefixes with a precomputed top-k completion list", index_counts["completion_lists"]),
+        ("search_index_codes", "Barcodes / SKUs in the scan index", index_counts["codes"]),
+        ("staff_index_entries", "Staff documents in the staff lookup index", len(staff_index["email_by_path"])),
+        ("upgrade_requests_indexed", "Upgrade requests in the admin index", len(upgrade_requests["by_path"])),
+        ("entitlement_cache_entries", "Shops with cached plan entitlements", len(entitlement_cache)),
+        ("warmup_ready", "1 once Firebase, cache and listeners are up", 1 if warmup_state["status"] == "ready" else 0),
+        ("metric_thread_shards", "Live threads holding a metrics shard (exited threads are folded into one total)", len(_metric_shards)),
+        ("search_result_cache_entries", "Cached /sales result lists", len(search_index.result_cache.entries)),
+        ("search_result_cache_bytes", "Approximate size of the cached /sales results", search_index.result_cache.bytes),
+        ("searches_running", "/sales searches computing right now", admission_state["searches_running"]),
+        ("searches_waiting", "/sales searches blocked on a slot or an identical in-flight search", admission_state["searches_waiting"]),
+        ("sale_commits_running", "/complete-sale requests in progress (each reserves a search slot)", admission_state["commits_running"]),
+        ("cache_bus_leader", "1 while this instance owns the catalogue listeners for the cache bus",
+         1 if cache_bus is not None and cache_bus.is_leader else 0),
+        ("firestore_retry_tokens", "Firestore retry budget tokens left (retries pause below half)", fs.retry_budget.tokens),
+    ]
+
+# Scrapers on these networks need no token; anyone else must be an admin
+METRICS_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(network.strip())
+    for network in os.environ.get("METRICS_ALLOWED_NETWORKS", "127.0.0.1/32,::1/128").split(",") if network.strip()
+]
+
+def _metrics_client_allowed():
+    try:
+        address = ipaddress.ip_address(request.remote_addr or "")
+    except ValueError:
+        return False
+    return any(address in network for network in METRICS_ALLOWED_NETWORKS)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus text exposition of request, Firestore, listener and index metrics (allowlisted networks or admins)"""
+    if not _metrics_client_allowed():
+        _, error_response = require_admin()
+        if error_response:
+            return error_response
+    counters, histograms = _collect_metrics()
+    lines = []
+
+    by_name = defaultdict(list)
+    for (name, labels), value in counters.items():
+        by_name[name].append((labels, value))
+    for (name, labels), counts in histograms.items():
+        by_name[name].append((labels, counts))
+
+    for name in sorted(by_name):
+        kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in sorted(by_name[name], key=lambda entry: entry[0]):
+            if kind != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+                continue
+            cumulative = 0
+            for bound, count in zip(_histogram_buckets[name] + ("+Inf",), value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]:g}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    for name, help_text, value in _metric_gauges():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value:g}")
+
+    response = Response("\n".join(lines) + "\n", mimetype="text/plain")
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+# ======================================================
+# RUN SERVER
+# ======================================================
 # This block ONLY runs for local development
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    start_warmup()
     app.run(host="0.0.0.0", port=port, debug=True)
\ No newline at end of file
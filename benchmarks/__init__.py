@@ -0,0 +1,7 @@
+"""
+Offline benchmarks for the Superkeeper backend.
+
+synthetic.py generates seeded catalogues in the Firestore document shapes
+the app reads, fake_firestore.py serves them through the client surface
+app.py uses, and the bench_*.py scripts measure the hot paths.
+"""
@@ -0,0 +1,102 @@
+"""
+Recall-vs-latency benchmark for the IVF image index (static/ann_index.py)
+against exact brute-force search.
+
+Vectors are synthetic clustered embeddings (similar products cluster into
+families, photos of one product cluster tightly), normalized like MobileNet
+feature vectors.
+
+Usage:
+    python benchmarks/bench_ann.py [--vectors 100000] [--dim 1280] [--lists 256]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static"))
+
+from ann_index import IVFIndex, l2_normalize
+
+
+def synthetic_embeddings(count, dim, seed=0):
+    """Two-level clusters: product families -> products -> photos of a product"""
+    rng = np.random.default_rng(seed)
+    families = rng.standard_normal((max(1, count // 500), dim)).astype(np.float32)
+    products = families[rng.integers(0, len(families), max(1, count // 4))]
+    products = products + 0.6 * rng.standard_normal(products.shape).astype(np.float32)
+    photos = products[rng.integers(0, len(products), count)]
+    return l2_normalize(photos + 0.3 * rng.standard_normal((count, dim)).astype(np.float32))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=1280)
+    parser.add_argument("--lists", type=int, default=256)
+    parser.add_argument("--shops", type=int, default=50)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    vectors = synthetic_embeddings(args.vectors, args.dim)
+    shop_of = np.random.default_rng(1).integers(0, args.shops, args.vectors)
+    rng = np.random.default_rng(2)
+    query_rows = rng.choice(args.vectors, args.queries, replace=False)
+    queries = l2_normalize(vectors[query_rows] + 0.05 * rng.standard_normal((args.queries, args.dim)).astype(np.float32))
+
+    index = IVFIndex(args.dim, n_lists=args.lists, train_threshold=args.vectors + 1)
+    start = time.perf_counter()
+    for row in range(args.vectors):
+        index.add(f"v{row}", vectors[row], f"shop{shop_of[row]}")
+    insert_s = time.perf_counter() - start
+    start = time.perf_counter()
+    index.train()
+    train_s = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "index.npz")
+        start = time.perf_counter()
+        index.save(path)
+        save_s = time.perf_counter() - start
+        start = time.perf_counter()
+        index = IVFIndex.load(path)
+        load_s = time.perf_counter() - start
+
+    print(f"\n{args.vectors} x {args.dim} vectors, {args.lists} lists")
+    print(f"insert {insert_s:.2f}s  train {train_s:.2f}s  save {save_s:.2f}s  load {load_s:.2f}s")
+
+    # Exact baseline
+    start = time.perf_counter()
+    truth = []
+    for query in queries:
+        scores = vectors @ query
+        truth.append(set(np.argpartition(-scores, args.k - 1)[:args.k]))
+    brute_ms = (time.perf_counter() - start) / args.queries * 1000
+
+    print(f"\n{'n_probe':>8}{'recall@' + str(args.k):>12}{'ms/query':>12}{'speedup':>10}")
+    print(f"{'brute':>8}{1.0:>12.3f}{brute_ms:>12.2f}{1.0:>10.1f}")
+    for n_probe in (1, 2, 4, 8, 16, 32, 64):
+        if n_probe > args.lists:
+            break
+        hits = 0
+        start = time.perf_counter()
+        results = [index.search(query, args.k, n_probe=n_probe) for query in queries]
+        ann_ms = (time.perf_counter() - start) / args.queries * 1000
+        for found, expected in zip(results, truth):
+            hits += len({int(key[1:]) for key, _, _ in found} & expected)
+        recall = hits / (args.queries * args.k)
+        print(f"{n_probe:>8}{recall:>12.3f}{ann_ms:>12.2f}{brute_ms / ann_ms:>10.1f}")
+
+    shop_id = "shop0"
+    start = time.perf_counter()
+    for query in queries:
+        index.search(query, args.k, shop_id=shop_id)
+    print(f"\nper-shop filtered search ({shop_id}): {(time.perf_counter() - start) / args.queries * 1000:.2f} ms/query")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""
+Hot-path benchmarks on a seeded synthetic catalogue served by FakeFirestore.
+
+Measures refresh_full_item_cache, SearchIndex.build, SearchIndex.search,
+allocate_main_item_fifo, POST /complete-sale and a cold per-shop load
+(ensure_shop_loaded after eviction), reporting throughput,
+latency percentiles and peak traced memory. --json writes a record that can
+be compared with --compare from another commit.
+
+Usage:
+    python benchmarks/bench_catalogue.py [--items 10000] [--shops 50] [--seed 42]
+                                         [--json out.json] [--compare baseline.json]
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Keep the app quiet and offline: no sampled request logs, no Firebase warm-up
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.pop("FIREBASE_KEY", None)
+
+import app as superkeeper
+from benchmarks.synthetic import load_fake_firestore, sample_queries
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies_s, peak_bytes=None):
+    latencies_ms = sorted(value * 1000 for value in latencies_s)
+    total_s = sum(latencies_s)
+    result = {
+        "ops": len(latencies_ms),
+        "total_s": round(total_s, 4),
+        "ops_per_s": round(len(latencies_ms) / total_s, 1) if total_s else None,
+        "p50_ms": round(percentile(latencies_ms, 0.50), 4),
+        "p95_ms": round(percentile(latencies_ms, 0.95), 4),
+        "p99_ms": round(percentile(latencies_ms, 0.99), 4),
+        "max_ms": round(latencies_ms[-1], 4) if latencies_ms else 0.0,
+    }
+    if peak_bytes is not None:
+        result["peak_mem_mb"] = round(peak_bytes / 1024 / 1024, 2)
+    return result
+
+
+def timed(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def peak_memory(fn):
+    """Peak bytes allocated while fn runs (separate pass - tracemalloc slows everything down)"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    results = {}
+
+    start = time.perf_counter()
+    db = load_fake_firestore(args.items, args.shops, seed=args.seed)
+    print(f"generated {len(db)} documents ({args.items} items, {args.shops} shops) in {time.perf_counter() - start:.2f}s")
+
+    superkeeper.db = db
+    superkeeper.warmup_state["status"] = "ready"  # keep before_request from starting a real warm-up
+
+    # refresh_full_item_cache (includes SearchIndex.build)
+    reads_before = db.stats["reads"]
+    latencies = timed(superkeeper.refresh_full_item_cache, args.rebuilds)
+    results["refresh_full_item_cache"] = summarize(
+        latencies, peak_memory(superkeeper.refresh_full_item_cache) if args.memory else None)
+    results["refresh_full_item_cache"]["firestore_reads"] = (db.stats["reads"] - reads_before) // args.rebuilds
+    shops = superkeeper.embedding_cache_full["shops"]
+
+    # SearchIndex.build on its own
+    index = superkeeper.SearchIndex()
+    results["search_index_build"] = summarize(
+        timed(lambda: index.build(shops), args.rebuilds),
+        peak_memory(lambda: superkeeper.SearchIndex().build(shops)) if args.memory else None)
+
+    # SearchIndex.search - prefix queries spread over shops
+    rng = random.Random(args.seed)
+    shop_ids = [shop["shop_id"] for shop in shops]
+    queries = [(query, rng.choice(shop_ids)) for query in sample_queries(args.queries, args.seed)]
+    latencies, hits = [], 0
+    for query, shop_id in queries:
+        start = time.perf_counter()
+        found = index.search(query, shop_id, include_debug=False)
+        latencies.append(time.perf_counter() - start)
+        hits += len(found)
+    results["search"] = summarize(latencies)
+    results["search"]["avg_results"] = round(hits / len(queries), 2)
+
+    # allocate_main_item_fifo on cached items
+    items = [item for shop in shops for category in shop["categories"] for item in category["items"] if item["batches"]]
+    picks = [(rng.choice(items)["batches"], rng.uniform(1, 40)) for _ in range(args.allocations)]
+    latencies = []
+    for batches, quantity in picks:
+        start = time.perf_counter()
+        superkeeper.allocate_main_item_fifo(batches, quantity)
+        latencies.append(time.perf_counter() - start)
+    results["allocate_main_item_fifo"] = summarize(latencies)
+
+    # POST /complete-sale through the Flask test client (reads + writes hit FakeFirestore)
+    client = superkeeper.app.test_client()
+    sellable = [(shop["shop_id"], item) for shop in shops for category in shop["categories"]
+                for item in category["items"] if any(batch["quantity"] >= 1 for batch in item["batches"])]
+    latencies, failures = [], 0
+    client.get("/ready")  # first request pays Flask's one-off setup
+    writes_before = db.stats["writes"]
+    for _ in range(args.sales):
+        shop_id, item = rng.choice(sellable)
+        batch = rng.choice([batch for batch in item["batches"] if batch["quantity"] >= 1])
+        payload = {"shop_id": shop_id, "seller": {"name": "bench"}, "items": [{
+            "item_id": item["item_id"], "category_id": item["category_id"],
+            "batch_id": batch["batch_id"], "quantity": 1, "type": "main_item"
+        }]}
+        start = time.perf_counter()
+        response = client.post("/complete-sale", json=payload)
+        latencies.append(time.perf_counter() - start)
+        failures += response.status_code != 200
+    results["complete_sale"] = summarize(latencies)
+    results["complete_sale"]["failures"] = failures
+    results["complete_sale"]["firestore_writes"] = db.stats["writes"] - writes_before
+
+    # Cold per-shop load: evict, then load through the single-flight loader (attaches the shop's listeners)
+    latencies = []
+    reads_before = db.stats["reads"]
+    for _ in range(args.shop_loads):
+        shop_id = rng.choice(shop_ids)
+        superkeeper.evict_shop(shop_id, "benchmark")
+        start = time.perf_counter()
+        superkeeper.ensure_shop_loaded(shop_id)
+        latencies.append(time.perf_counter() - start)
+    results["shop_load_cold"] = summarize(latencies)
+    results["shop_load_cold"]["firestore_reads"] = (db.stats["reads"] - reads_before) // max(1, args.shop_loads)
+
+    return results
+
+
+def print_results(results, baseline=None):
+    print(f"\n{'benchmark':<26}{'ops':>8}{'ops/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak MB':>10}{'vs base':>10}")
+    for name, result in results.items():
+        change = ""
+        if baseline and name in baseline and baseline[name].get("p50_ms"):
+            change = f"{(result['p50_ms'] / baseline[name]['p50_ms'] - 1) * 100:+.1f}%"
+        print(f"{name:<26}{result['ops']:>8}{result['ops_per_s'] or 0:>12.1f}{result['p50_ms']:>10.3f}"
+              f"{result['p95_ms']:>10.3f}{result['p99_ms']:>10.3f}{result.get('peak_mem_mb', ''):>10}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=10000, help="catalogue size (1k - 1M)")
+    parser.add_argument("--shops", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--rebuilds", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--allocations", type=int, default=20000)
+    parser.add_argument("--sales", type=int, default=500)
+    parser.add_argument("--shop-loads", type=int, default=20)
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the tracemalloc passes")
+    parser.add_argument("--json", dest="json_path")
+    parser.add_argument("--compare", help="JSON from an earlier run; prints p50 change")
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "config": {key: value for key, value in vars(args).items() if key not in ("json_path", "compare")},
+                "results": results
+            }, f, indent=2)
+        print(f"\nWrote {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
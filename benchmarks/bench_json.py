@@ -0,0 +1,79 @@
+"""
+JSON encoding benchmark for the hot endpoints.
+
+Compares Flask's stdlib encoder with the app's FastJSONProvider on
+realistic /sales search results (with and without debug blocks) and an
+/item-optimization catalogue page.
+
+Usage:
+    python benchmarks/bench_json.py [--items 2000] [--repeat 200]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from flask.json.provider import DefaultJSONProvider
+
+import app as superkeeper
+from benchmarks.synthetic import load_fake_firestore
+
+
+def build_shop(item_count, seed=42):
+    """One synthetic shop, loaded through refresh_full_item_cache so it has the cache's shape"""
+    superkeeper.db = load_fake_firestore(item_count, shops=1, seed=seed)
+    superkeeper.refresh_full_item_cache()
+    return superkeeper.embedding_cache_full["shops"][0]
+
+
+def time_encoder(encode, payload, repeat):
+    encode(payload)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = encode(payload)
+    elapsed = time.perf_counter() - start
+    return elapsed / repeat * 1e6, len(body if isinstance(body, bytes) else body.encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    shop = build_shop(args.items)
+    index = superkeeper.search_index
+
+    def search_payload(include_debug):
+        results = index.search("su", shop["shop_id"], include_debug=include_debug)
+        return {"items": results, "meta": {"shop_id": shop["shop_id"], "query": "su", "results": len(results),
+                                           "processing_time_ms": 0.42, "using_index": True,
+                                           "cache_last_updated": time.time()}}
+
+    catalogue_items = [item for category in shop["categories"] for item in category["items"]][:200]
+    payloads = {
+        "search (debug)": search_payload(True),
+        "search (no debug)": search_payload(False),
+        "catalogue page (200 items)": {"status": "success", "items": catalogue_items},
+    }
+
+    stdlib = DefaultJSONProvider(superkeeper.app)
+    stdlib.default = superkeeper.FastJSONProvider.default  # cache records -> dicts, as the app does
+    fast = superkeeper.FastJSONProvider(superkeeper.app)
+    encoders = {
+        "stdlib json (Flask default)": lambda obj: stdlib.dumps(obj, separators=(",", ":")),
+        f"FastJSONProvider ({'orjson' if superkeeper.orjson else 'stdlib fallback'})": fast.dumps_bytes,
+    }
+
+    print(f"\n{'payload':<30}{'encoder':<40}{'us/encode':>12}{'bytes':>12}")
+    for payload_name, payload in payloads.items():
+        for encoder_name, encode in encoders.items():
+            micros, size = time_encoder(encode, payload, args.repeat)
+            print(f"{payload_name:<30}{encoder_name:<40}{micros:>12.1f}{size:>12}")
+
+
+if __name__ == "__main__":
+    main()
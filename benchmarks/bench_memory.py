@@ -0,0 +1,70 @@
+"""
+Resident memory of the shop cache and search index per catalogue item.
+
+Loads a seeded synthetic catalogue through refresh_full_item_cache and
+reports the bytes still allocated afterwards (tracemalloc, after a full
+collection), divided by the number of items, next to the app's own deep
+size estimate (cache_memory). Run it on two commits to compare layouts.
+
+Usage:
+    python benchmarks/bench_memory.py [--items 20000] [--shops 50] [--seed 42] [--json out.json]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.pop("FIREBASE_KEY", None)
+os.environ["CACHE_MEMORY_BUDGET_MB"] = "0"  # measure the full layout, never compacted
+
+import app as superkeeper
+from benchmarks.synthetic import load_fake_firestore
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=20000)
+    parser.add_argument("--shops", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_path")
+    args = parser.parse_args()
+
+    superkeeper.db = load_fake_firestore(args.items, args.shops, seed=args.seed)
+    superkeeper.warmup_state["status"] = "ready"
+
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    superkeeper.refresh_full_item_cache()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+
+    stats = superkeeper.embedding_cache_full["batch_stats"]
+    items = stats["total_items"]
+    result = {
+        "items": items,
+        "selling_units": stats["total_selling_units"],
+        "batches": stats["total_batches"],
+        "retained_mb": round(retained / 1024 / 1024, 2),
+        "retained_bytes_per_item": round(retained / items),
+        "deep_size_bytes_per_item": round(superkeeper.cache_memory["total_bytes"] / items),
+    }
+    for key, value in result.items():
+        print(f"{key:<28}{value:>14}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"config": {key: value for key, value in vars(args).items() if key != "json_path"},
+                       "results": result}, f, indent=2)
+        print(f"\nWrote {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Worker boot benchmark based on `python -X importtime`.
+
+Imports the app module in a fresh interpreter several times and reports
+the median total import time plus the slowest modules by cumulative time.
+Use --json to write a record that can be diffed release to release.
+
+Usage:
+    python benchmarks/bench_startup.py [--module app] [--runs 5] [--top 15] [--json startup.json]
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def profile_import(module):
+    """One cold import; returns (wall seconds, {module: (self_us, cumulative_us, depth)}) for its subtree"""
+    env = dict(os.environ)
+    env.pop("FIREBASE_KEY", None)  # measure import cost only, never connect
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{completed.stderr[-2000:]}")
+
+    # importtime prints children before their parent; keep only the subtree of `module`
+    modules, subtree = {}, {}
+    for line in completed.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        depth = len(indent) // 2
+        subtree[name] = (int(self_us), int(cumulative_us), depth)
+        if depth == 0:
+            if name == module:
+                modules = subtree
+            subtree = {}
+    return wall, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--json", dest="json_path")
+    args = parser.parse_args()
+
+    walls, totals, runs = [], [], []
+    for _ in range(args.runs):
+        wall, modules = profile_import(args.module)
+        walls.append(wall)
+        totals.append(modules[args.module][1] / 1000)
+        runs.append(modules)
+
+    # Median cumulative time of the modules `module` imports directly
+    names = set().union(*runs)
+    cumulative = {
+        name: statistics.median(run[name][1] for run in runs if name in run) / 1000
+        for name in names
+    }
+    slowest = sorted(
+        (name for name in names if name != args.module and runs[0].get(name, (0, 0, 0))[2] <= 1),
+        key=lambda name: -cumulative[name]
+    )[:args.top]
+
+    print(f"\n{args.module}: median import {statistics.median(totals):.1f} ms, "
+          f"interpreter wall {statistics.median(walls) * 1000:.1f} ms ({args.runs} runs)")
+    print(f"\n{'module':<45}{'cumulative ms':>15}")
+    for name in slowest:
+        print(f"{name:<45}{cumulative[name]:>15.1f}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({
+                "module": args.module,
+                "python": sys.version.split()[0],
+                "runs": args.runs,
+                "import_ms_median": round(statistics.median(totals), 2),
+                "wall_ms_median": round(statistics.median(walls) * 1000, 2),
+                "slowest_modules_ms": {name: round(cumulative[name], 2) for name in slowest}
+            }, f, indent=2)
+        print(f"\nWrote {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+In-process fake of the Firestore client surface app.py uses:
+
+    db.collection(name) / db.collection_group(name) / db.get_all(references)
+    CollectionReference.document([id]) / .stream() / .on_snapshot(callback)
+    DocumentReference.collection(name) / .get() / .set() / .update() / .delete()
+    snapshot.id / .exists / .reference / .to_dict()
+
+Documents live in one dict keyed by path tuple, with per-collection and
+per-collection-group indexes so stream() costs O(children), not O(catalogue).
+Snapshot listeners are called synchronously on the writing thread once the
+write has been applied, starting with an initial snapshot of everything
+(like the real client).
+Calls accept (and ignore) the client's retry= and timeout= keywords.
+Every document read and write is counted in `stats`.
+"""
+import copy
+import secrets
+import string
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+_ADDED = SimpleNamespace(name="ADDED")
+_MODIFIED = SimpleNamespace(name="MODIFIED")
+_REMOVED = SimpleNamespace(name="REMOVED")
+
+
+def _resolve_sentinels(value):
+    # firestore.SERVER_TIMESTAMP and friends are google.cloud.firestore_v1 Sentinel objects
+    if type(value).__name__ == "Sentinel":
+        return datetime.now(timezone.utc)
+    return value
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+
+class DocumentChange:
+    def __init__(self, change_type, document):
+        self.type = change_type
+        self.document = document
+
+
+class Watch:
+    def __init__(self, listeners, entry):
+        self._listeners = listeners
+        self._entry = entry
+
+    def unsubscribe(self):
+        if self._entry in self._listeners:
+            self._listeners.remove(self._entry)
+
+
+class DocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+        self.id = path[-1]
+
+    @property
+    def path(self):
+        return "/".join(self._path)
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self._path[:-1])
+
+    def collection(self, name):
+        return CollectionReference(self._client, self._path + (name,))
+
+    def get(self, retry=None, timeout=None):
+        return self._client._get(self._path)
+
+    def set(self, data, merge=False, retry=None, timeout=None):
+        self._client._set(self._path, data, merge)
+
+    def update(self, data, retry=None, timeout=None):
+        self._client._update(self._path, data)
+
+    def delete(self, retry=None, timeout=None):
+        self._client._delete(self._path)
+
+
+class CollectionReference:
+    def __init__(self, client, path, group=False):
+        self._client = client
+        self._path = path
+        self._group = group
+        self.id = path[-1]
+
+    @property
+    def parent(self):
+        return DocumentReference(self._client, self._path[:-1]) if len(self._path) > 1 else None
+
+    def document(self, document_id=None):
+        if document_id is None:  # auto id, 20 alphanumerics like the real client
+            document_id = "".join(secrets.choice(string.ascii_letters + string.digits) for _ in range(20))
+        return DocumentReference(self._client, self._path + (document_id,))
+
+    def _paths(self):
+        if self._group:
+            return list(self._client._groups.get(self.id, ()))
+        return [self._path + (doc_id,) for doc_id in self._client._children.get(self._path, ())]
+
+    def stream(self, retry=None, timeout=None):
+        for path in self._paths():
+            snapshot = self._client._get(path)
+            if snapshot.exists:
+                yield snapshot
+
+    def on_snapshot(self, callback):
+        return self._client._listen(self, callback)
+
+    def _matches(self, path):
+        if self._group:
+            return path[-2] == self.id
+        return path[:-1] == self._path
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(lambda: reference.set(data, merge))
+
+    def update(self, reference, data):
+        self._writes.append(lambda: reference.update(data))
+
+    def delete(self, reference):
+        self._writes.append(reference.delete)
+
+    def commit(self):
+        for write in self._writes:
+            write()
+        self._writes = []
+
+
+class FakeFirestore:
+    def __init__(self):
+        self._docs = {}  # path tuple -> document dict
+        self._children = defaultdict(dict)  # collection path -> {doc id: None} (insertion ordered)
+        self._groups = defaultdict(dict)  # collection id -> {doc path: None}
+        self._listeners = []  # [(CollectionReference, callback)]
+        self._lock = threading.RLock()
+        self.stats = {"reads": 0, "writes": 0, "listener_callbacks": 0}
+
+    # --- client surface -------------------------------------------------
+    def collection(self, name):
+        return CollectionReference(self, (name,))
+
+    def collection_group(self, name):
+        return CollectionReference(self, (name,), group=True)
+
+    def document(self, path):
+        return DocumentReference(self, tuple(path.split("/")))
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def get_all(self, references, retry=None, timeout=None):
+        for reference in references:
+            yield self._get(reference._path)
+
+    # --- bulk loading (not counted as writes, no listener events) --------
+    def load(self, documents):
+        """Insert (path tuple, dict) pairs, e.g. from synthetic.generate_catalogue()"""
+        count = 0
+        with self._lock:
+            for path, data in documents:
+                self._index(path)
+                self._docs[path] = data
+                count += 1
+        return count
+
+    def __len__(self):
+        return len(self._docs)
+
+    # --- internals -------------------------------------------------------
+    def _index(self, path):
+        self._children[path[:-1]][path[-1]] = None
+        self._groups[path[-2]][path] = None
+
+    def _unindex(self, path):
+        self._children[path[:-1]].pop(path[-1], None)
+        self._groups[path[-2]].pop(path, None)
+
+    def _get(self, path):
+        with self._lock:
+            self.stats["reads"] += 1
+            return DocumentSnapshot(DocumentReference(self, path), self._docs.get(path))
+
+    def _set(self, path, data, merge):
+        with self._lock:
+            existed = path in self._docs
+            data = {key: _resolve_sentinels(value) for key, value in data.items()}
+            if merge and existed:
+                self._docs[path].update(data)
+            else:
+                self._docs[path] = data
+            self._index(path)
+            self.stats["writes"] += 1
+        self._notify(path, _MODIFIED if existed else _ADDED)
+
+    def _update(self, path, data):
+        with self._lock:
+            if path not in self._docs:
+                raise KeyError(f"No document to update: {'/'.join(path)}")
+            document = self._docs[path]
+            for field_path, value in data.items():
+                *parents, leaf = field_path.split(".")
+                target = document
+                for part in parents:
+                    target = target.setdefault(part, {})
+                target[leaf] = _resolve_sentinels(value)
+            self.stats["writes"] += 1
+        self._notify(path, _MODIFIED)
+
+    def _delete(self, path):
+        with self._lock:
+            if self._docs.pop(path, None) is None:
+                return
+            self._unindex(path)
+            self.stats["writes"] += 1
+        self._notify(path, _REMOVED)
+
+    def _listen(self, collection, callback):
+        with self._lock:
+            entry = (collection, callback)
+            self._listeners.append(entry)
+            initial = [DocumentChange(_ADDED, DocumentSnapshot(DocumentReference(self, path), self._docs[path]))
+                       for path in collection._paths()]
+            self.stats["listener_callbacks"] += 1
+        callback([change.document for change in initial], initial, datetime.now(timezone.utc))
+        return Watch(self._listeners, entry)
+
+    def _notify(self, path, change_type):
+        # Called after the write releases the lock, like the real client's watch thread,
+        # so callbacks may read or write the database themselves
+        with self._lock:
+            data = copy.deepcopy(self._docs.get(path))
+            listeners = [entry for entry in self._listeners if entry[0]._matches(path)]
+            self.stats["listener_callbacks"] += len(listeners)
+        for collection, callback in listeners:
+            snapshot = DocumentSnapshot(DocumentReference(self, path), data)
+            callback([snapshot], [DocumentChange(change_type, snapshot)], datetime.now(timezone.utc))
@@ -0,0 +1,137 @@
+"""
+Seeded synthetic catalogue generator.
+
+Produces Firestore documents in the shapes the app reads:
+
+    Shops/{shop}                                    {name}
+    Shops/{shop}/categories/{cat}                   {name}
+    .../categories/{cat}/items/{item}               {name, sellPrice, stock, batches: [...], ...}
+    .../items/{item}/sellUnits/{su}                 {name, conversionFactor, batchLinks: [...], ...}
+
+Same seed + same sizes -> identical catalogue, so runs are comparable across
+commits. Items are spread over shops with a long tail (a few large shops,
+many small ones) like production.
+"""
+import random
+
+WORDS = [
+    "sugar", "milk", "bread", "soap", "rice", "salt", "tea", "flour", "oil", "beans",
+    "maize", "unga", "juice", "water", "omo", "colgate", "royco", "kimbo", "eggs", "matches",
+    "sukari", "maziwa", "mkate", "sabuni", "mchele", "chumvi", "chai", "mafuta", "maharagwe", "soda",
+    "biscuits", "noodles", "tissue", "candles", "pens", "books", "battery", "bulb", "nails", "paint",
+]
+BRANDS = ["Kabras", "Mumias", "Brookside", "Elianto", "Pembe", "Jogoo", "Ketepa", "Menengai", "Daawat", "Exe"]
+UNITS = ["kg", "packet", "unit", "litre", "bale", "carton"]
+SELL_UNIT_NAMES = [("half", 2), ("quarter", 4), ("piece", 10), ("tin", 20), ("cup", 8)]
+
+BASE_TIMESTAMP_MS = 1_700_000_000_000
+DAY_MS = 86_400_000
+
+
+def shop_sizes(total_items, shops, rng):
+    """Long-tailed split of total_items over shops (each shop gets at least one item)"""
+    weights = [1.0 / (rank + 1) ** 0.8 for rank in range(shops)]
+    rng.shuffle(weights)
+    scale = (total_items - shops) / sum(weights)
+    sizes = [1 + int(weight * scale) for weight in weights]
+    sizes[0] += total_items - sum(sizes)
+    return sizes
+
+
+def _batches(rng, unit, sell_price):
+    batches = []
+    for b in range(rng.choice((1, 1, 2, 2, 3, 4))):
+        buy_price = round(sell_price * rng.uniform(0.6, 0.9), 2)
+        batches.append({
+            "id": f"batch_{b}",
+            "batchName": f"Batch {b + 1}",
+            "quantity": float(rng.randint(0, 60)),
+            "unit": unit,
+            "buyPrice": buy_price,
+            "sellPrice": sell_price,
+            "timestamp": BASE_TIMESTAMP_MS + b * DAY_MS + rng.randint(0, DAY_MS),
+            "date": "01/01/2025",
+            "addedBy": "owner@example.com",
+            "sellingUnitAllocations": {}
+        })
+    return batches
+
+
+def _sell_units(rng, item_name, batches, sell_price):
+    units = []
+    for s in range(rng.choice((0, 0, 1, 1, 2))):
+        label, factor = rng.choice(SELL_UNIT_NAMES)
+        links = [{
+            "batchId": batch["id"],
+            "maxUnitsAvailable": int(batch["quantity"] * factor),
+            "allocatedUnits": 0,
+            "batchTimestamp": batch["timestamp"],
+            "pricePerUnit": round(sell_price / factor, 2)
+        } for batch in batches if batch["quantity"] > 0]
+        units.append((f"su_{s}", {
+            "name": f"{label} {item_name.split()[0]}",
+            "conversionFactor": float(factor),
+            "sellPrice": round(sell_price / factor * 1.1, 2),
+            "images": [f"https://res.cloudinary.com/demo/image/upload/su_{s}.jpg"],
+            "isBaseUnit": False,
+            "batchLinks": links
+        }))
+    return units
+
+
+def generate_catalogue(total_items=1000, shops=10, items_per_category=50, seed=42):
+    """
+    Yield (path tuple, document dict) for a whole catalogue, parents before
+    children. A generator so 1M-item catalogues can be loaded without an
+    intermediate list.
+    """
+    rng = random.Random(seed)
+    for shop_no, shop_items in enumerate(shop_sizes(total_items, shops, rng)):
+        shop_id = f"shop_{shop_no:05d}"
+        shop_path = ("Shops", shop_id)
+        yield shop_path, {"name": f"{rng.choice(BRANDS)} Store {shop_no}"}
+
+        for cat_no in range((shop_items + items_per_category - 1) // items_per_category):
+            cat_id = f"cat_{cat_no:04d}"
+            cat_path = shop_path + ("categories", cat_id)
+            yield cat_path, {"name": f"{rng.choice(WORDS).title()} & more {cat_no}"}
+
+            first = cat_no * items_per_category
+            for item_no in range(first, min(first + items_per_category, shop_items)):
+                item_id = f"item_{item_no:06d}"
+                item_path = cat_path + ("items", item_id)
+                name = f"{rng.choice(WORDS)} {rng.choice(BRANDS)} {rng.choice(WORDS)} {item_no}"
+                unit = rng.choice(UNITS)
+                sell_price = round(rng.uniform(10, 2500), 2)
+                batches = _batches(rng, unit, sell_price)
+                yield item_path, {
+                    "name": name,
+                    "sellPrice": sell_price,
+                    "buyPrice": batches[0]["buyPrice"],
+                    "stock": sum(batch["quantity"] for batch in batches),
+                    "baseUnit": unit,
+                    "images": [f"https://res.cloudinary.com/demo/image/upload/{shop_id}_{item_id}.jpg"],
+                    "batches": batches,
+                    "stockTransactions": []
+                }
+                for su_id, su_doc in _sell_units(rng, name, batches, sell_price):
+                    yield item_path + ("sellUnits", su_id), su_doc
+
+
+def load_fake_firestore(total_items=1000, shops=10, items_per_category=50, seed=42):
+    """FakeFirestore pre-loaded with a synthetic catalogue"""
+    from benchmarks.fake_firestore import FakeFirestore
+
+    db = FakeFirestore()
+    db.load(generate_catalogue(total_items, shops, items_per_category, seed))
+    return db
+
+
+def sample_queries(count, seed=7):
+    """Search-as-you-type queries: 2..6 character prefixes of catalogue words"""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        word = rng.choice(WORDS + [brand.lower() for brand in BRANDS])
+        queries.append(word[:rng.randint(2, min(6, len(word)))])
+    return queries
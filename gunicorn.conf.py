@@ -1,11 +1,14 @@
 # gunicorn.conf.py - SSL/TLS Optimized
+import os
+
 bind = "0.0.0.0:10000"
-workers = 1
+workers = 1  # >1: set CACHE_BUS_URL=tcp://127.0.0.1:7077 so one worker owns the Firestore listeners
 timeout = 120
 keepalive = 5
 max_requests = 50
 max_requests_jitter = 10
-worker_class = "sync"
+worker_class = "gthread"  # /sales searches and /complete-sale run side by side (see ADMISSION CONTROL in app.py)
+threads = int(os.environ.get("GUNICORN_THREADS", 8))  # app.py reads the same variable to size its search queue
 worker_connections = 1000
 limit_request_line = 4094
 limit_request_fields = 100
@@ -15,3 +18,10 @@ limit_request_field_size = 8190
 worker_tmp_dir = "/dev/shm"  # Use RAM for temp files
 graceful_timeout = 30
 preload_app = True  # Preload app to reduce memory
+
+
+def post_worker_init(worker):
+    # Firebase and listeners are warmed up per worker in the background (shops load on first use):
+    # listener threads started in the preloading master would not survive fork.
+    from app import start_warmup
+    start_warmup()
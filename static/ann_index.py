@@ -0,0 +1,273 @@
+"""
+IVF (inverted file) approximate nearest-neighbour index for image embeddings.
+
+Vectors are L2-normalized, so inner product == cosine similarity.
+Spherical k-means splits the space into `n_lists` cells; a query only scans
+the `n_probe` cells whose centroids are closest to it. Each vector carries a
+shop code so results can be filtered per shop inside the scan.
+"""
+import json
+import threading
+
+import numpy as np
+
+
+def l2_normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def spherical_kmeans(vectors, n_clusters, iterations=20, seed=0):
+    """k-means on the unit sphere (cosine); returns normalized centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        # Re-seed empty clusters with random points
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = l2_normalize(sums)
+    return centroids
+
+
+class _InvertedList:
+    """Growable vectors + shop codes + keys for one IVF cell"""
+
+    def __init__(self, dim):
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.shop_codes = np.zeros(0, dtype=np.int32)
+        self.keys = []
+        self.size = 0
+
+    def append(self, key, vector, shop_code):
+        if self.size == len(self.vectors):
+            capacity = max(16, self.size * 2)
+            vectors = np.zeros((capacity, self.vectors.shape[1]), dtype=np.float32)
+            vectors[:self.size] = self.vectors[:self.size]
+            shop_codes = np.zeros(capacity, dtype=np.int32)
+            shop_codes[:self.size] = self.shop_codes[:self.size]
+            self.vectors, self.shop_codes = vectors, shop_codes
+        self.vectors[self.size] = vector
+        self.shop_codes[self.size] = shop_code
+        self.keys.append(key)
+        self.size += 1
+        return self.size - 1
+
+    def remove(self, position):
+        """Swap-remove; returns the key that moved into `position` (or None)"""
+        last = self.size - 1
+        moved_key = None
+        if position != last:
+            self.vectors[position] = self.vectors[last]
+            self.shop_codes[position] = self.shop_codes[last]
+            self.keys[position] = self.keys[last]
+            moved_key = self.keys[position]
+        self.keys.pop()
+        self.size -= 1
+        return moved_key
+
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbour index with incremental insert/delete,
+    per-shop filtering and save/load.
+
+    Until `train_threshold` vectors have been added the index is untrained and
+    every vector lives in a single list (exact search). It trains itself once
+    the threshold is crossed.
+    """
+
+    def __init__(self, dim, n_lists=256, n_probe=8, train_threshold=None, seed=0):
+        self.dim = dim
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.train_threshold = train_threshold or n_lists * 40
+        self.seed = seed
+        self.centroids = None
+        self.lists = [_InvertedList(dim)]
+        self.locations = {}  # key -> (list_no, position)
+        self.payloads = {}  # key -> match payload
+        self.shop_codes = {}  # shop_id -> int code
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.locations)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def _shop_code(self, shop_id):
+        code = self.shop_codes.get(shop_id)
+        if code is None:
+            code = len(self.shop_codes)
+            self.shop_codes[shop_id] = code
+        return code
+
+    def _assign(self, vectors):
+        if not self.is_trained:
+            return np.zeros(len(vectors), dtype=np.int64)
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def _all_entries(self):
+        for inverted_list in self.lists:
+            for position in range(inverted_list.size):
+                yield (inverted_list.keys[position], inverted_list.vectors[position],
+                       inverted_list.shop_codes[position])
+
+    def train(self, iterations=20):
+        """(Re)cluster every stored vector into n_lists cells"""
+        with self.lock:
+            entries = list(self._all_entries())
+            if len(entries) < self.n_lists:
+                return False
+            vectors = np.stack([vector for _, vector, _ in entries])
+            sample_size = min(len(vectors), self.n_lists * 256)
+            sample = vectors[np.random.default_rng(self.seed).choice(len(vectors), sample_size, replace=False)]
+            self.centroids = spherical_kmeans(sample, self.n_lists, iterations, self.seed)
+
+            self.lists = [_InvertedList(self.dim) for _ in range(self.n_lists)]
+            self.locations = {}
+            for (key, vector, shop_code), list_no in zip(entries, self._assign(vectors)):
+                position = self.lists[list_no].append(key, vector, shop_code)
+                self.locations[key] = (int(list_no), position)
+            return True
+
+    def add(self, key, vector, shop_id, payload=None):
+        """Insert or replace one vector"""
+        vector = l2_normalize(vector).ravel()
+        with self.lock:
+            if key in self.locations:
+                self.remove(key)
+            list_no = int(self._assign(vector[None, :])[0])
+            position = self.lists[list_no].append(key, vector, self._shop_code(shop_id))
+            self.locations[key] = (list_no, position)
+            self.payloads[key] = payload
+            if not self.is_trained and len(self.locations) >= self.train_threshold:
+                self.train()
+
+    def holds(self, key, vector, payload=None):
+        """True if `key` is stored with this vector and payload (add() would change nothing)"""
+        with self.lock:
+            location = self.locations.get(key)
+            if location is None or self.payloads.get(key) != payload:
+                return False
+            list_no, position = location
+            stored = self.lists[list_no].vectors[position]
+            return bool(np.allclose(stored, l2_normalize(vector).ravel(), atol=1e-6))
+
+    def remove(self, key):
+        with self.lock:
+            location = self.locations.pop(key, None)
+            if location is None:
+                return False
+            self.payloads.pop(key, None)
+            list_no, position = location
+            moved_key = self.lists[list_no].remove(position)
+            if moved_key is not None:
+                self.locations[moved_key] = (list_no, position)
+            return True
+
+    def search(self, query, k=10, shop_id=None, n_probe=None):
+        """Top-k (key, score, payload), optionally restricted to one shop"""
+        query = l2_normalize(query).ravel()
+        with self.lock:
+            shop_code = None
+            if shop_id is not None:
+                shop_code = self.shop_codes.get(shop_id)
+                if shop_code is None:
+                    return []
+
+            if not self.is_trained:
+                return self._scan([0], query, k, shop_code)
+
+            n_probe = min(n_probe or self.n_probe, self.n_lists)
+            centroid_order = np.argsort(-(self.centroids @ query))
+            results = self._scan(centroid_order[:n_probe], query, k, shop_code)
+            # A small shop may have nothing in the nearest cells - widen the probe
+            while shop_code is not None and len(results) < k and n_probe < self.n_lists:
+                n_probe = min(n_probe * 2, self.n_lists)
+                results = self._scan(centroid_order[:n_probe], query, k, shop_code)
+            return results
+
+    def _scan(self, probe, query, k, shop_code):
+        best_scores = []
+        best_keys = []
+        for list_no in probe:
+            inverted_list = self.lists[list_no]
+            if inverted_list.size == 0:
+                continue
+            scores = inverted_list.vectors[:inverted_list.size] @ query
+            rows = np.arange(inverted_list.size)
+            if shop_code is not None:
+                rows = rows[inverted_list.shop_codes[:inverted_list.size] == shop_code]
+                scores = scores[rows]
+            if len(rows) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                rows, scores = rows[top], scores[top]
+            best_scores.append(scores)
+            best_keys.extend(inverted_list.keys[row] for row in rows)
+
+        if not best_keys:
+            return []
+        scores = np.concatenate(best_scores)
+        order = np.argsort(-scores)[:k]
+        return [(best_keys[i], float(scores[i]), self.payloads.get(best_keys[i])) for i in order]
+
+    def save(self, path):
+        """Serialize to a single .npz (no pickle) for fast reload"""
+        with self.lock:
+            keys, vectors, shop_codes, list_offsets = [], [], [], [0]
+            for inverted_list in self.lists:
+                keys.extend(inverted_list.keys)
+                vectors.append(inverted_list.vectors[:inverted_list.size])
+                shop_codes.append(inverted_list.shop_codes[:inverted_list.size])
+                list_offsets.append(list_offsets[-1] + inverted_list.size)
+            meta = {
+                "dim": self.dim,
+                "n_lists": self.n_lists,
+                "n_probe": self.n_probe,
+                "train_threshold": self.train_threshold,
+                "seed": self.seed,
+                "keys": keys,
+                "payloads": [self.payloads.get(key) for key in keys],
+                "shop_codes": self.shop_codes
+            }
+            np.savez(
+                path,
+                meta=np.array(json.dumps(meta)),
+                centroids=self.centroids if self.is_trained else np.zeros((0, self.dim), dtype=np.float32),
+                vectors=np.concatenate(vectors) if vectors else np.zeros((0, self.dim), dtype=np.float32),
+                shop_codes=np.concatenate(shop_codes) if shop_codes else np.zeros(0, dtype=np.int32),
+                list_offsets=np.array(list_offsets, dtype=np.int64)
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            index = cls(meta["dim"], meta["n_lists"], meta["n_probe"], meta["train_threshold"], meta["seed"])
+            index.shop_codes = meta["shop_codes"]
+            centroids = data["centroids"]
+            index.centroids = centroids if len(centroids) else None
+            vectors, shop_codes, offsets = data["vectors"], data["shop_codes"], data["list_offsets"]
+
+        index.lists = []
+        for list_no in range(len(offsets) - 1):
+            start, end = int(offsets[list_no]), int(offsets[list_no + 1])
+            inverted_list = _InvertedList(index.dim)
+            inverted_list.vectors = vectors[start:end].copy()
+            inverted_list.shop_codes = shop_codes[start:end].copy()
+            inverted_list.keys = meta["keys"][start:end]
+            inverted_list.size = end - start
+            index.lists.append(inverted_list)
+            for position, key in enumerate(inverted_list.keys):
+                index.locations[key] = (list_no, position)
+        index.payloads = dict(zip(meta["keys"], meta["payloads"]))
+        return index
@@ -8,12 +8,16 @@ import numpy as np
 from PIL import Image
 from io import BytesIO
 
-import tensorflow_hub as hub
+import os
 import time
 import base64
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
-from embeddings import generate_embedding
-from sklearn.metrics.pairwise import cosine_similarity
+from ann_index import IVFIndex
 
 
 # ======================================================
@@ -31,13 +35,12 @@ db = firestore.client()
 
 
 # ======================================================
-# LOAD MODEL
+# EMBEDDINGS (MODEL LOADED ON FIRST USE)
 # ======================================================
-print("[INIT] Loading TensorFlow Hub model...")
-model = hub.load(
-    "https://tfhub.dev/google/imagenet/mobilenet_v2_100_224/feature_vector/5"
-)
-print("[READY] Model loaded successfully.")
+def generate_embedding(frame):
+    # embeddings pulls in TensorFlow - import it only when a frame is embedded
+    from embeddings import generate_embedding as _generate_embedding
+    return _generate_embedding(frame)
 
 
 # ======================================================
@@ -79,10 +82,12 @@ def refresh_full_item_cache():
                 item_data = item_doc.to_dict()
 
                 embeddings = []
+                embedding_keys = []  # embeddings doc id (image_index) per vector
                 for emb_doc in item_doc.reference.collection("embeddings").stream():
                     vector = emb_doc.to_dict().get("vector")
                     if vector:
-                        embeddings.append(np.array(vector))
+                        embeddings.append(np.array(vector, dtype=np.float32))
+                        embedding_keys.append(emb_doc.id)
 
                 # ⛔ skip items with NO embeddings
                 if not embeddings:
@@ -94,7 +99,8 @@ def refresh_full_item_cache():
                     "thumbnail": item_data.get("images", [None])[0],
                     "sellPrice": item_data.get("sellPrice", 0),  # ✅ ADD THIS
                     "buyPrice": item_data.get("buyPrice", 0),   # ✅ Optional
-                    "embeddings": embeddings
+                    "embeddings": embeddings,
+                    "embedding_keys": embedding_keys
                 })
 
             # ⛔ skip empty categories
@@ -109,9 +115,239 @@ def refresh_full_item_cache():
     embedding_cache_full["total_shops"] = len(shops_result)
     embedding_cache_full["last_updated"] = time.time()
 
+    matrices = build_shop_matrices(shops_result)
+    with shop_matrices_lock:
+        shop_matrices.clear()
+        shop_matrices.update(matrices)
+
+    try:
+        sync_catalogue_index(shops_result)
+    except Exception as e:
+        print(f"⚠️ ANN index sync failed: {e}")
+
     print(f"[READY] Cached {len(shops_result)} shops in {round((time.time()-start)*1000,2)}ms")
 
 
+# ======================================================
+# PER-SHOP EMBEDDING MATRIX (VECTORIZED IMAGE MATCHING)
+# ======================================================
+# Store int8 codes + per-row scale instead of float32 (~4x less memory)
+EMBEDDING_QUANTIZE_INT8 = os.environ.get("EMBEDDING_QUANTIZE_INT8", "0") == "1"
+QUANTIZED_SCAN_BLOCK = 1024  # rows dequantized per block when scanning int8 codes
+MATCH_THRESHOLD = 0.5
+
+
+def _l2_normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class ShopEmbeddingMatrix:
+    """
+    All image embeddings of one shop as a single L2-normalized matrix.
+    Rows are keyed by (category_id, item_id, image_index) so /vectorize-item
+    can overwrite or append a single row without a rebuild.
+    """
+
+    def __init__(self, dim, quantize=False, capacity=64):
+        self.dim = dim
+        self.quantize = quantize
+        self.size = 0
+        if quantize:
+            self.codes = np.zeros((capacity, dim), dtype=np.int8)
+            self.scales = np.zeros(capacity, dtype=np.float32)
+        else:
+            self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.row_keys = []  # row -> (category_id, item_id, image_index)
+        self.row_by_key = {}
+        self.items = {}  # (category_id, item_id) -> match payload
+
+    def _grow(self):
+        """Double capacity so appends stay amortized O(d)"""
+        capacity = max(64, self.size * 2)
+        if self.quantize:
+            codes = np.zeros((capacity, self.dim), dtype=np.int8)
+            codes[:self.size] = self.codes[:self.size]
+            scales = np.zeros(capacity, dtype=np.float32)
+            scales[:self.size] = self.scales[:self.size]
+            self.codes, self.scales = codes, scales
+        else:
+            vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+            vectors[:self.size] = self.vectors[:self.size]
+            self.vectors = vectors
+
+    def _write_row(self, row, vector):
+        if self.quantize:
+            scale = float(np.abs(vector).max()) / 127.0 or 1.0
+            self.codes[row] = np.round(vector / scale).astype(np.int8)
+            self.scales[row] = scale
+        else:
+            self.vectors[row] = vector
+
+    def upsert(self, category_id, item_id, image_index, vector, item_info):
+        """Add or replace one image embedding - O(d), amortized"""
+        vector = _l2_normalize(vector)
+        key = (category_id, item_id, str(image_index))
+        row = self.row_by_key.get(key)
+        if row is None:
+            capacity = self.codes.shape[0] if self.quantize else self.vectors.shape[0]
+            if self.size == capacity:
+                self._grow()
+            row = self.size
+            self.size += 1
+            self.row_keys.append(key)
+            self.row_by_key[key] = row
+        self._write_row(row, vector)
+        self.items[(category_id, item_id)] = item_info
+
+    def scores(self, query):
+        """Cosine similarity of the query against every row - one mat-vec product"""
+        if not self.quantize:
+            return self.vectors[:self.size] @ query
+        # Dequantize in cache-sized blocks instead of materializing a float32 copy
+        scores = np.empty(self.size, dtype=np.float32)
+        for start in range(0, self.size, QUANTIZED_SCAN_BLOCK):
+            end = min(start + QUANTIZED_SCAN_BLOCK, self.size)
+            scores[start:end] = self.codes[start:end].astype(np.float32) @ query
+        return scores * self.scales[:self.size]
+
+    def top_k(self, query_vector, k=5):
+        """Best k distinct items as (item_info, score), highest first"""
+        if self.size == 0:
+            return []
+        scores = self.scores(_l2_normalize(query_vector))
+
+        # Over-fetch rows: several images can belong to the same item
+        fetch = min(self.size, k * 4)
+        rows = np.argpartition(-scores, fetch - 1)[:fetch]
+        rows = rows[np.argsort(-scores[rows])]
+
+        results = []
+        seen = set()
+        for row in rows:
+            category_id, item_id, _ = self.row_keys[row]
+            if (category_id, item_id) in seen:
+                continue
+            seen.add((category_id, item_id))
+            results.append((self.items[(category_id, item_id)], float(scores[row])))
+            if len(results) == k:
+                break
+        return results
+
+    def memory_bytes(self):
+        if self.quantize:
+            return self.codes.nbytes + self.scales.nbytes
+        return self.vectors.nbytes
+
+
+shop_matrices = {}  # shop_id -> ShopEmbeddingMatrix
+shop_matrices_lock = threading.Lock()
+
+
+def _match_payload(item, category_id):
+    return {
+        "item_id": item["item_id"],
+        "category_id": category_id,
+        "name": item["name"],
+        "thumbnail": item["thumbnail"],
+        "sellPrice": item.get("sellPrice", 0)
+    }
+
+
+def build_shop_matrices(shops):
+    """Rebuild every shop's matrix from the cache (listener refresh path)"""
+    matrices = {}
+    for shop in shops:
+        matrix = None
+        for category in shop["categories"]:
+            for item in category["items"]:
+                payload = _match_payload(item, category["category_id"])
+                for image_index, vector in enumerate(item["embeddings"]):
+                    if matrix is None:
+                        matrix = ShopEmbeddingMatrix(len(vector), quantize=EMBEDDING_QUANTIZE_INT8)
+                    matrix.upsert(category["category_id"], item["item_id"], item["embedding_keys"][image_index], vector, payload)
+        if matrix is not None:
+            matrices[shop["shop_id"]] = matrix
+    return matrices
+
+
+def upsert_shop_embedding(shop_id, category_id, item_id, image_index, vector, item_info):
+    """Incremental update from /vectorize-item - no cache rebuild needed"""
+    with shop_matrices_lock:
+        matrix = shop_matrices.get(shop_id)
+        if matrix is None or matrix.dim != len(vector):
+            matrix = ShopEmbeddingMatrix(len(vector), quantize=EMBEDDING_QUANTIZE_INT8)
+            shop_matrices[shop_id] = matrix
+        matrix.upsert(category_id, item_id, image_index, vector, item_info)
+
+
+# ======================================================
+# CROSS-CATALOGUE ANN INDEX (PRODUCT RECOGNITION)
+# ======================================================
+ANN_INDEX_PATH = os.environ.get("ANN_INDEX_PATH", "catalogue_index.npz")
+ANN_INDEX_LISTS = int(os.environ.get("ANN_INDEX_LISTS", 256))
+
+catalogue_index = {"index": None, "dirty": False}
+
+
+def _catalogue_key(shop_id, category_id, item_id, image_index):
+    return f"{shop_id}/{category_id}/{item_id}/{image_index}"
+
+
+def load_catalogue_index():
+    """Reload the serialized index so boot doesn't pay for k-means again"""
+    if os.path.exists(ANN_INDEX_PATH):
+        try:
+            catalogue_index["index"] = IVFIndex.load(ANN_INDEX_PATH)
+            print(f"[READY] ANN index loaded: {len(catalogue_index['index'])} vectors")
+        except Exception as e:
+            print(f"⚠️ Could not load ANN index ({e}) - will rebuild from cache")
+
+
+def _catalogue_payload(shop_id, payload):
+    return dict(payload, shop_id=shop_id)
+
+
+def add_to_catalogue_index(shop_id, category_id, item_id, image_index, vector, payload):
+    index = catalogue_index["index"]
+    if index is None:
+        index = IVFIndex(len(vector), n_lists=ANN_INDEX_LISTS)
+        catalogue_index["index"] = index
+    index.add(_catalogue_key(shop_id, category_id, item_id, image_index), vector, shop_id,
+              _catalogue_payload(shop_id, payload))
+    catalogue_index["dirty"] = True
+
+
+def sync_catalogue_index(shops):
+    """Apply inserts/updates/deletes so the index matches the cache, then persist if changed"""
+    live = {}
+    for shop in shops:
+        for category in shop["categories"]:
+            for item in category["items"]:
+                payload = _match_payload(item, category["category_id"])
+                for image_index, vector in zip(item["embedding_keys"], item["embeddings"]):
+                    key = _catalogue_key(shop["shop_id"], category["category_id"], item["item_id"], image_index)
+                    live[key] = (shop["shop_id"], category["category_id"], item["item_id"], image_index, vector, payload)
+
+    index = catalogue_index["index"]
+    if index is not None:
+        with index.lock:
+            stale = [key for key in index.locations if key not in live]
+        for key in stale:
+            index.remove(key)
+            catalogue_index["dirty"] = True
+    # New keys, and existing ones whose image was re-vectorized or whose name/price changed
+    for key, (shop_id, category_id, item_id, image_index, vector, payload) in live.items():
+        index = catalogue_index["index"]
+        if index is None or not index.holds(key, vector, _catalogue_payload(shop_id, payload)):
+            add_to_catalogue_index(shop_id, category_id, item_id, image_index, vector, payload)
+
+    if catalogue_index["dirty"] and catalogue_index["index"] is not None:
+        catalogue_index["index"].save(ANN_INDEX_PATH)
+        catalogue_index["dirty"] = False
+
+
 def on_full_item_snapshot(col_snapshot, changes, read_time):
     print("[LISTENER] Firestore change → refreshing FULL cache")
     refresh_full_item_cache()
@@ -133,6 +369,189 @@ def dashboard():
 # ======================================================
 # VECTORIZE ITEM (STOCK IMAGE → EMBEDDING)
 # ======================================================
+VECTORIZE_QUEUE_SIZE = int(os.environ.get("VECTORIZE_QUEUE_SIZE", 1000))
+VECTORIZE_BATCH_SIZE = int(os.environ.get("VECTORIZE_BATCH_SIZE", 16))
+VECTORIZE_BATCH_WAIT = float(os.environ.get("VECTORIZE_BATCH_WAIT_MS", 50)) / 1000
+VECTORIZE_DOWNLOAD_WORKERS = int(os.environ.get("VECTORIZE_DOWNLOAD_WORKERS", 8))
+FIRESTORE_BATCH_LIMIT = 500  # max writes per Firestore batch commit
+
+def _lookup_match_payload(shop_id, category_id, item_id):
+    """Item fields for a scan match - from the matrix/cache, else one Firestore read"""
+    matrix = shop_matrices.get(shop_id)
+    if matrix and (category_id, item_id) in matrix.items:
+        return matrix.items[(category_id, item_id)]
+
+    item_doc = db.collection("Shops").document(shop_id) \
+        .collection("categories").document(category_id) \
+        .collection("items").document(item_id).get()
+    if not item_doc.exists:
+        return None
+    item_data = item_doc.to_dict()
+    return {
+        "item_id": item_id,
+        "category_id": category_id,
+        "name": item_data.get("name", ""),
+        "thumbnail": item_data.get("images", [None])[0],
+        "sellPrice": item_data.get("sellPrice", 0)
+    }
+
+
+
+def embed_batch(images):
+    """One model forward pass for a list of RGB images, preprocessed exactly like generate_embedding"""
+    from embeddings import generate_embeddings
+    return generate_embeddings(images)
+
+
+class EmbeddingPipeline:
+    """
+    Background /vectorize-item worker: bounded job queue, concurrent image
+    downloads over a pooled HTTP session, micro-batched model inference and
+    batched Firestore writes.
+    """
+
+    def __init__(self, queue_size, batch_size, batch_wait, download_workers):
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.downloads = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="vectorize-dl")
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=download_workers, pool_maxsize=download_workers, max_retries=2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.metrics = {
+            "enqueued": 0,
+            "rejected": 0,
+            "processed": 0,
+            "failed": 0,
+            "batches": 0,
+            "last_batch_size": 0,
+            "last_batch_ms": 0
+        }
+        self._completions = deque(maxlen=1000)  # timestamps of processed images (throughput window)
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="vectorize-batcher", daemon=True)
+                self._worker.start()
+
+    def submit(self, job):
+        """Enqueue without blocking the request; False when the queue is full"""
+        self.start()
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            self.metrics["rejected"] += 1
+            return False
+        self.metrics["enqueued"] += 1
+        return True
+
+    def _next_batch(self):
+        batch = [self.jobs.get()]
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.jobs.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _download(self, job):
+        response = self.session.get(job["image_url"], timeout=10)
+        response.raise_for_status()
+        img = Image.open(BytesIO(response.content)).convert("RGB")
+        return np.array(img.resize((224, 224)))
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            started = time.time()
+            try:
+                self._process(batch)
+            except Exception as e:
+                self.metrics["failed"] += len(batch)
+                print(f"🔥 vectorize batch of {len(batch)} failed: {e}")
+            finally:
+                for _ in batch:
+                    self.jobs.task_done()
+            self.metrics["batches"] += 1
+            self.metrics["last_batch_size"] = len(batch)
+            self.metrics["last_batch_ms"] = round((time.time() - started) * 1000, 2)
+
+    def _process(self, batch):
+        # Concurrent downloads; a bad URL only drops its own job
+        futures = [self.downloads.submit(self._download, job) for job in batch]
+        jobs, images = [], []
+        for job, future in zip(batch, futures):
+            try:
+                images.append(future.result())
+                jobs.append(job)
+            except Exception as e:
+                self.metrics["failed"] += 1
+                print(f"⚠️ vectorize download failed for {job['item_id']}: {e}")
+        if not jobs:
+            return
+
+        vectors = embed_batch(images)
+
+        for chunk_start in range(0, len(jobs), FIRESTORE_BATCH_LIMIT):
+            write_batch = db.batch()
+            for job, vector in zip(jobs[chunk_start:chunk_start + FIRESTORE_BATCH_LIMIT],
+                                   vectors[chunk_start:chunk_start + FIRESTORE_BATCH_LIMIT]):
+                embedding_ref = db.collection("Shops") \
+                    .document(job["shop_id"]) \
+                    .collection("categories") \
+                    .document(job["category_id"]) \
+                    .collection("items") \
+                    .document(job["item_id"]) \
+                    .collection("embeddings") \
+                    .document(str(job["image_index"]))
+                write_batch.set(embedding_ref, {
+                    "vector": vector.tolist(),
+                    "model": "mobilenet_v2_100_224",
+                    "updatedAt": firestore.SERVER_TIMESTAMP,
+                })
+            write_batch.commit()
+
+        # Keep scan matrices and the ANN index current without waiting for a cache refresh
+        for job, vector in zip(jobs, vectors):
+            item_info = _lookup_match_payload(job["shop_id"], job["category_id"], job["item_id"])
+            if item_info:
+                upsert_shop_embedding(
+                    job["shop_id"], job["category_id"], job["item_id"],
+                    job["image_index"], vector, item_info
+                )
+                add_to_catalogue_index(
+                    job["shop_id"], job["category_id"], job["item_id"],
+                    str(job["image_index"]), vector, item_info
+                )
+
+        now = time.time()
+        self.metrics["processed"] += len(jobs)
+        self._completions.extend([now] * len(jobs))
+
+    def stats(self):
+        now = time.time()
+        recent = [t for t in self._completions if now - t <= 60]
+        return dict(
+            self.metrics,
+            queue_depth=self.jobs.qsize(),
+            queue_capacity=self.jobs.maxsize,
+            images_per_sec_1m=round(len(recent) / 60, 3)
+        )
+
+
+embedding_pipeline = EmbeddingPipeline(
+    VECTORIZE_QUEUE_SIZE, VECTORIZE_BATCH_SIZE, VECTORIZE_BATCH_WAIT, VECTORIZE_DOWNLOAD_WORKERS
+)
+
+
 @app.route("/vectorize-item", methods=["POST"])
 def vectorize_item():
     try:
@@ -152,38 +571,27 @@ def vectorize_item():
         if missing:
             return jsonify({"status": "error", "missing_fields": missing}), 400
 
-        print(f"📥 /vectorize-item → {data['item_id']} image {data['image_index']}")
+        if not embedding_pipeline.submit({k: data[k] for k in required}):
+            print(f"⛔ /vectorize-item queue full → {data['item_id']} image {data['image_index']}")
+            return jsonify({"status": "error", "message": "Vectorize queue full, retry later"}), 503
 
-        response = requests.get(data["image_url"], timeout=10)
-        img = Image.open(BytesIO(response.content)).convert("RGB")
-        img = img.resize((224, 224))
-
-        vector = generate_embedding(np.array(img))
-
-        db.collection("Shops") \
-            .document(data["shop_id"]) \
-            .collection("categories") \
-            .document(data["category_id"]) \
-            .collection("items") \
-            .document(data["item_id"]) \
-            .collection("embeddings") \
-            .document(str(data["image_index"])) \
-            .set({
-                "vector": vector.tolist(),
-                "model": "mobilenet_v2_100_224",
-                "updatedAt": firestore.SERVER_TIMESTAMP,
-            })
+        print(f"📥 /vectorize-item queued → {data['item_id']} image {data['image_index']}")
 
         return jsonify({
-            "status": "success",
-            "embedding_length": len(vector),
-        })
+            "status": "queued",
+            "queue_depth": embedding_pipeline.jobs.qsize(),
+        }), 202
 
     except Exception as e:
         print("🔥 /vectorize-item error:", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+@app.route("/vectorize-metrics", methods=["GET"])
+def vectorize_metrics():
+    return jsonify(embedding_pipeline.stats())
+
+
 # ======================================================
 # SALES SCAN (SHOP-STRICT)
 # ======================================================
@@ -206,44 +614,29 @@ def sales_scan():
 
         img = Image.open(BytesIO(base64.b64decode(frame_b64))).convert("RGB")
         frame = np.array(img)
-        query_embedding = generate_embedding(frame).reshape(1, -1)
+        query_embedding = generate_embedding(frame)
 
-        # 🔐 HARD shop isolation
-        shop = next(
-            (s for s in embedding_cache_full["shops"] if s["shop_id"] == shop_id),
-            None
-        )
+        # 🔐 HARD shop isolation - each shop has its own matrix
+        matrix = shop_matrices.get(shop_id)
 
-        if not shop:
+        if not matrix:
             print("⛔ Shop NOT found in cache")
             return jsonify({"match": None})
 
+        scan_start = time.time()
+        top = matrix.top_k(query_embedding, k=1)
+        scan_ms = (time.time() - scan_start) * 1000
+
         best_match = None
         best_score = 0.0
+        if top:
+            item_info, best_score = top[0]
+            best_match = dict(item_info, score=round(best_score, 3))
 
-        for category in shop["categories"]:
-            for item in category["items"]:
-                for vector in item["embeddings"]:
-                    score = cosine_similarity(
-                        query_embedding,
-                        vector.reshape(1, -1)
-                    )[0][0]
-
-                    if score > best_score:
-                        best_score = score
-                        best_match = {
-                            "item_id": item["item_id"],
-                            "category_id": category["category_id"],  # ✅ ADDED
-                            "name": item["name"],
-                            "thumbnail": item["thumbnail"],
-                            "sellPrice": item.get("sellPrice", 0),  # ✅ ADDED
-                            "score": round(float(score), 3)
-                        }
-
-        print("🎯 Best score:", best_score)
+        print(f"🎯 Best score: {best_score} ({matrix.size} vectors in {scan_ms:.2f}ms)")
 
         # 🔐 STRICT threshold
-        if not best_match or best_score < 0.5:
+        if not best_match or best_score < MATCH_THRESHOLD:
             print("❌ No valid match in THIS shop")
             return jsonify({"match": None})
 
@@ -255,6 +648,53 @@ def sales_scan():
         import traceback
         traceback.print_exc()
         return jsonify({"match": None}), 500
+# ======================================================
+# CATALOGUE SCAN (APPROXIMATE, ACROSS SHOPS OR FILTERED)
+# ======================================================
+@app.route("/catalogue-scan", methods=["POST"])
+def catalogue_scan():
+    """
+    Product recognition against the whole catalogue via the ANN index.
+    Optional shop_id restricts matches to one shop; k sets the number of candidates.
+    """
+    try:
+        data = request.get_json(force=True)
+        frame_b64 = data.get("frame")
+        shop_id = data.get("shop_id")
+        k = min(int(data.get("k", 5)), 50)
+
+        if not frame_b64:
+            return jsonify({"matches": [], "error": "frame is required"}), 400
+
+        index = catalogue_index["index"]
+        if index is None or len(index) == 0:
+            return jsonify({"matches": []})
+
+        if frame_b64.startswith("data:image"):
+            frame_b64 = frame_b64.split(",")[1]
+        img = Image.open(BytesIO(base64.b64decode(frame_b64))).convert("RGB")
+        query_embedding = generate_embedding(np.array(img))
+
+        start = time.time()
+        results = index.search(query_embedding, k=k, shop_id=shop_id)
+        search_ms = (time.time() - start) * 1000
+
+        return jsonify({
+            "matches": [dict(payload, score=round(score, 3)) for _, score, payload in results],
+            "meta": {
+                "indexed_vectors": len(index),
+                "trained": index.is_trained,
+                "search_time_ms": round(search_ms, 2)
+            }
+        })
+
+    except Exception as e:
+        print("🔥 /catalogue-scan error:", e)
+        import traceback
+        traceback.print_exc()
+        return jsonify({"matches": []}), 500
+
+
 # ======================================================
 # COMPLETE SALES (UPDATED WITH SELLING UNITS SUPPORT)
 # ======================================================
@@ -517,6 +957,7 @@ def debug_cache():
 # ======================================================
 if __name__ == "__main__":
     print("[INIT] Preloading FULL cache...")
+    load_catalogue_index()
     refresh_full_item_cache()
     db.collection_group("items").on_snapshot(on_full_item_snapshot)
 
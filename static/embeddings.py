@@ -0,0 +1,50 @@
+"""
+Image embeddings for catalogue photos and scan frames.
+
+Every vector - a single camera frame or a batch of catalogue images - goes
+through preprocess_frame() and one MobileNet V2 forward pass, so vectors from
+the two paths are directly comparable.
+"""
+import threading
+
+import numpy as np
+from PIL import Image
+
+MODEL_URL = "https://tfhub.dev/google/imagenet/mobilenet_v2_100_224/feature_vector/5"
+MODEL_NAME = "mobilenet_v2_100_224"
+INPUT_SIZE = (224, 224)
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Load the TF Hub model on first use instead of at import (keeps boot fast)"""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                import tensorflow_hub as hub
+                print("[INIT] Loading TensorFlow Hub model...")
+                _model = hub.load(MODEL_URL)
+                print("[READY] Model loaded successfully.")
+    return _model
+
+
+def preprocess_frame(frame):
+    """RGB image array of any size -> 224x224 float32 in [0, 1], as the model expects"""
+    image = Image.fromarray(np.asarray(frame, dtype=np.uint8)).convert("RGB")
+    if image.size != INPUT_SIZE:
+        image = image.resize(INPUT_SIZE)
+    return np.asarray(image, dtype=np.float32) / 255.0
+
+
+def generate_embeddings(frames):
+    """One model forward pass for a list of frames; returns an (n, dim) float32 array"""
+    batch = np.stack([preprocess_frame(frame) for frame in frames])
+    return np.asarray(get_model()(batch), dtype=np.float32)
+
+
+def generate_embedding(frame):
+    """Embedding of a single frame (a batch of one)"""
+    return generate_embeddings([frame])[0]
@@ -23,11 +23,17 @@ import {
     setDoc,
     serverTimestamp
 } from "https://www.gstatic.com/firebasejs/9.23.0/firebase-firestore.js";
+import { getAuth, onAuthStateChanged } from "https://www.gstatic.com/firebasejs/9.23.0/firebase-auth.js";
 
 // Store the unsubscribe functions to clean up later
 let unsubscribeFunctions = [];
 let isListening = false;
 
+// Backend index polling (replaces one listener per shop when available)
+const SUMMARY_POLL_MS = 15000;
+const SUMMARY_PAGE_SIZE = 500;
+let pollTimer = null;
+
 // Staff limits for each plan
 const STAFF_LIMITS = {
     BASIC: 5,
@@ -55,6 +61,17 @@ async function loadUpgradeSummary() {
     const container = document.getElementById('upgrade-summary');
     container.innerHTML = '<div class="loading">Loading upgrade requests... / Inapakia maombi ya kuboresha...</div>';
 
+    // Clear any existing listeners / polling
+    cleanupListeners();
+
+    if (await loadUpgradeSummaryFromBackend()) {
+        isListening = true;
+        pollTimer = setInterval(loadUpgradeSummaryFromBackend, SUMMARY_POLL_MS);
+        console.log("✅ Upgrade requests served by backend index (polling)");
+        processAndDisplayData();
+        return;
+    }
+
     try {
         console.log("📊 Loading upgrade requests from all shops...");
 
@@ -75,9 +92,6 @@ async function loadUpgradeSummary() {
 
         console.log("🏪 Shop map:", shopMap);
 
-        // Clear any existing listeners
-        cleanupListeners();
-
         // Reset the global requests array
         allRequests = [];
 
@@ -109,6 +123,66 @@ async function loadUpgradeSummary() {
     }
 }
 
+// Resolves once Firebase Auth has restored the session (null when signed out)
+function getSignedInUser() {
+    return new Promise(resolve => {
+        const unsubscribe = onAuthStateChanged(getAuth(), user => {
+            unsubscribe();
+            resolve(user);
+        });
+    });
+}
+
+/**
+ * Fetch every upgrade request from the backend index (/admin/upgrade-requests).
+ * Returns false when the index is unavailable or the user is not an admin,
+ * so the caller can fall back to Firestore listeners.
+ */
+async function loadUpgradeSummaryFromBackend() {
+    try {
+        const user = await getSignedInUser();
+        if (!user) return false;
+        const idToken = await user.getIdToken();
+
+        const records = [];
+        let cursor = 0;
+        while (cursor !== null) {
+            const res = await fetch(`/admin/upgrade-requests?limit=${SUMMARY_PAGE_SIZE}&cursor=${cursor}`, {
+                headers: { "Authorization": `Bearer ${idToken}` }
+            });
+            if (!res.ok) {
+                console.warn("⚠️ /admin/upgrade-requests unavailable (" + res.status + "), falling back to Firestore");
+                return false;
+            }
+            const data = await res.json();
+            records.push(...data.requests);
+            cursor = data.next_cursor;
+        }
+
+        allRequests = records.map(req => ({
+            id: req.id,
+            shopId: req.shopId,
+            shopName: req.shopName,
+            requestedPlan: req.requestedPlan,
+            status: req.status,
+            mpesaReference: req.mpesaReference || "N/A",
+            requestedAt: req.requestedAt,
+            verifiedAt: req.verifiedAt,
+            paymentSubmittedAt: req.paymentSubmittedAt,
+            priceKES: req.priceKES || PLAN_PRICES[req.requestedPlan] || "N/A",
+            staffLimit: req.staffLimit || STAFF_LIMITS[req.requestedPlan] || "N/A",
+            _raw: req,
+            _updatedAt: req.updatedAt ? new Date(req.updatedAt) : new Date(req.indexedAt * 1000)
+        }));
+
+        if (pollTimer) processAndDisplayData();
+        return true;
+    } catch (e) {
+        console.warn("⚠️ /admin/upgrade-requests failed, falling back to Firestore:", e);
+        return false;
+    }
+}
+
 /**
  * Set up a real-time listener for a single shop's upgrade requests
  */
@@ -636,6 +710,10 @@ function cleanupListeners() {
         }
     });
     unsubscribeFunctions = [];
+    if (pollTimer) {
+        clearInterval(pollTimer);
+        pollTimer = null;
+    }
     isListening = false;
 }
 
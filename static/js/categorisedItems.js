@@ -586,6 +586,8 @@ document.addEventListener("DOMContentLoaded", () => {
 
   async function saveItem(name, parentId, itemData = {}) {
     if (!currentShopId) return null;
+    const user = auth.currentUser;
+    if (!user) throw new Error("Not signed in");
 
     const catRef = doc(db, "Shops", currentShopId, "categories", parentId);
     const catSnap = await getDoc(catRef);
@@ -596,18 +598,29 @@ document.addEventListener("DOMContentLoaded", () => {
     ancestors.push({ id: parentId, name: cat.name });
     const fullPath = ancestors.map(a => a.name).concat(name).join(" > ");
 
-    const ref = await addDoc(collection(db, ...itemsCollectionPath(currentShopId, parentId)), {
-      name,
-      categoryId: parentId,
-      ancestors,
-      fullPath,
-      ...itemData,
-      createdAt: Date.now(),
-      createdBy: currentActor || null
+    // Created by the backend, which enforces the plan's item limit before writing
+    const idToken = await user.getIdToken();
+    const res = await fetch("/add-item", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        "Authorization": `Bearer ${idToken}`
+      },
+      body: JSON.stringify({
+        shop_id: currentShopId,
+        category_id: parentId,
+        item: { name, ancestors, fullPath, ...itemData, createdBy: currentActor || null }
+      })
     });
+    const data = await res.json().catch(() => ({}));
+    if (res.status === 403 && data.allowed === false) {
+      alert("Item limit reached for your plan. Upgrade to add more items. / Kikomo cha bidhaa kwa mpango wako kimefikiwa. Pandisha mpango ili kuongeza bidhaa zaidi.");
+      return null;
+    }
+    if (!res.ok) throw new Error(data.error || `/add-item failed (${res.status})`);
 
-    await writeAuditLog("create", "item", ref.id, { name, categoryId: parentId });
-    return ref.id;
+    await writeAuditLog("create", "item", data.item_id, { name, categoryId: parentId });
+    return data.item_id;
   }
 
   async function nameExistsInCollection(collectionPath, name) {
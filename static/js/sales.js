@@ -993,6 +993,16 @@ function createSalesOverlay() {
             searchInput.value = '';
             searchClear.style.display = 'none';
             clearSearchResults();
+        } else if (e.key === 'Enter' && isScannedCode(searchInput.value)) {
+            // Keyboard-wedge scanners type the code and press Enter
+            e.preventDefault();
+            scanCode(searchInput.value.trim()).then(added => {
+                if (added) {
+                    searchInput.value = '';
+                    searchClear.style.display = 'none';
+                    clearSearchResults();
+                }
+            });
         }
     };
 
@@ -1122,7 +1132,7 @@ async function onSearchInput(query) {
             // This ensures we get lightning-fast results from the search index
             const startTime = Date.now();
             
-            const res = await fetch(`${FLASK_BACKEND_URL}/sales`, {
+            const searchRequest = () => fetch(`${FLASK_BACKEND_URL}/sales`, {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
                 body: JSON.stringify({ 
@@ -1132,6 +1142,16 @@ async function onSearchInput(query) {
                 })
             });
 
+            let res = await searchRequest();
+
+            // Shed by the server (shop over its search rate, or busy with sales): retry once after its hint
+            if (res.status === 429 || res.status === 503) {
+                const shed = await res.json().catch(() => ({}));
+                const retryAfterMs = Math.min((shed.meta?.retry_after_s || 1) * 1000, 3000);
+                await new Promise(resolve => setTimeout(resolve, retryAfterMs));
+                res = await searchRequest();
+            }
+
             if (!res.ok) {
                 // Show helpful error but don't fall back to slow local search
                 const errorText = await res.text();
@@ -1245,6 +1265,45 @@ async function onSearchInput(query) {
     }, 300);
 }
 
+// ====================================================
+// BARCODE / SKU SCAN - exact code lookup, straight into the cart
+// ====================================================
+
+function isScannedCode(value) {
+    return /^[0-9A-Za-z-]{4,}$/.test((value || '').trim());
+}
+
+async function scanCode(code) {
+    // The scanner's keystrokes queued a name search; the exact lookup replaces it
+    clearTimeout(searchTimeout);
+    try {
+        const res = await fetch(`${FLASK_BACKEND_URL}/scan`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ code, shop_id: currentShopId, quantity: 1 })
+        });
+
+        if (res.status === 404) {
+            // Not a known code - most likely a typed name, so search for it as usual
+            if (/^\d+$/.test(code)) {
+                showNotification(`No item with code ${code} / Hakuna bidhaa yenye nambari ${code}`, 'error');
+            }
+            onSearchInput(code);
+            return false;
+        }
+        if (!res.ok) {
+            throw new Error(`Backend returned ${res.status}`);
+        }
+
+        const data = await res.json();
+        return await handleOneTap(data.item);
+    } catch (error) {
+        console.error('❌ Scan failed:', error);
+        onSearchInput(code);
+        return false;
+    }
+}
+
 // ====================================================
 // FALLBACK: Local Firestore Search - DISABLED FOR PERFORMANCE ⚡
 // ====================================================
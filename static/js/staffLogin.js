@@ -133,7 +133,7 @@ async function handleStaffLogin() {
 
     console.log("👤 User signed in:", email);
 
-    const staffData = await findStaffByEmail(email);
+    const staffData = await findStaffByEmail(email, user);
 
     if (!staffData) {
       console.log("❌ Email not found in staff database");
@@ -169,9 +169,35 @@ async function handleStaffLogin() {
 }
 
 // ============================================
-// 3) FIND STAFF MEMBER (fast: collectionGroup)
+// 3) FIND STAFF MEMBER (backend index, collectionGroup fallback)
 // ============================================
-async function findStaffByEmail(email) {
+async function findStaffByEmail(email, user) {
+  try {
+    const idToken = await user.getIdToken();
+    const res = await fetch("/staff-lookup", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        "Authorization": `Bearer ${idToken}`
+      },
+      body: JSON.stringify({ email })
+    });
+
+    if (res.status === 404) return null;
+    if (res.ok) {
+      const data = await res.json();
+      console.log("⚡ Staff resolved by backend index");
+      return data.staff;
+    }
+    console.warn("⚠️ /staff-lookup unavailable (" + res.status + "), falling back to Firestore");
+  } catch (e) {
+    console.warn("⚠️ /staff-lookup failed, falling back to Firestore:", e);
+  }
+
+  return findStaffByEmailFirestore(email);
+}
+
+async function findStaffByEmailFirestore(email) {
   console.log("🔍 Searching staff via collectionGroup for:", email);
   const q = query(collectionGroup(db, "staff"), where("email", "==", email));
   const snap = await getDocs(q);
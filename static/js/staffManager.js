@@ -5,15 +5,14 @@
 import { db } from "./firebase-config.js";
 import { 
   collection, 
+  collectionGroup,
   doc, 
   getDoc,  // ADDED: Missing import
   getDocs, 
-  setDoc, 
   deleteDoc,
   query,
   where,
   orderBy,
-  serverTimestamp,
   onSnapshot
 } from "https://www.gstatic.com/firebasejs/9.23.0/firebase-firestore.js";
 import { getAuth, onAuthStateChanged } from "https://www.gstatic.com/firebasejs/9.23.0/firebase-auth.js";
@@ -64,23 +63,12 @@ const ACCESS_LEVELS = {
 // STAFF ID GENERATION UTILITIES
 // ======================================================
 
-/**
- * Generate a unique staff ID
- * Format: staff_{shopPrefix}_{timestamp}_{random}
- * Example: staff_PEMBE_1736352000000_abc123
- */
-function generateStaffId() {
-  const timestamp = Date.now();
-  const randomStr = Math.random().toString(36).substr(2, 6);
-  
-  // Create a shop prefix from current shop ID (first 6 chars)
-  const shopPrefix = currentShopId ? currentShopId.substring(0, 6).toUpperCase() : 'SHOP';
-  
-  return `staff_${shopPrefix}_${timestamp}_${randomStr}`;
-}
-
 /**
  * Find staff member by email across all shops
+ * Resolved by the backend staff index (one request, no per-shop reads) when the
+ * email is in the owner's own shop. The backend only shows an owner their own
+ * shop's staff, so a 404 there - or an unavailable backend - falls back to a
+ * single collectionGroup query across all shops.
  * Returns: { staffUid, shopId, staffData } or null
  */
 async function findStaffByEmail(email) {
@@ -89,29 +77,43 @@ async function findStaffByEmail(email) {
     
     const normalizedEmail = email.toLowerCase().trim();
     
-    // Get all shops
-    const shopsRef = collection(db, "Shops");
-    const shopsSnapshot = await getDocs(shopsRef);
-    
-    for (const shopDoc of shopsSnapshot.docs) {
-      const shopId = shopDoc.id;
-      
-      // Check staff subcollection for this email
-      const staffRef = collection(db, "Shops", shopId, "staff");
-      const staffQuery = query(staffRef, where("email", "==", normalizedEmail));
-      const staffSnapshot = await getDocs(staffQuery);
-      
-      if (!staffSnapshot.empty) {
-        const staffDoc = staffSnapshot.docs[0];
-        return {
-          staffUid: staffDoc.id,  // This is our generated staff ID
-          shopId: shopId,
-          staffData: staffDoc.data()
-        };
+    const currentUser = getAuth().currentUser;
+    if (currentUser) {
+      try {
+        const idToken = await currentUser.getIdToken();
+        const res = await fetch("/staff-lookup", {
+          method: "POST",
+          headers: {
+            "Content-Type": "application/json",
+            "Authorization": `Bearer ${idToken}`
+          },
+          body: JSON.stringify({ email: normalizedEmail })
+        });
+        
+        if (res.ok) {
+          const { staff } = await res.json();
+          return {
+            staffUid: staff.staffId,
+            shopId: staff.shopId,
+            staffData: staff
+          };
+        }
+      } catch (e) {
+        console.warn("⚠️ /staff-lookup failed, falling back to Firestore:", e);
       }
     }
     
-    return null; // Not found in any shop
+    const staffQuery = query(collectionGroup(db, "staff"), where("email", "==", normalizedEmail));
+    const staffSnapshot = await getDocs(staffQuery);
+    
+    if (staffSnapshot.empty) return null; // Not found in any shop
+    
+    const staffDoc = staffSnapshot.docs[0];
+    return {
+      staffUid: staffDoc.id,  // This is our generated staff ID
+      shopId: staffDoc.ref.parent.parent.id,
+      staffData: staffDoc.data()
+    };
   } catch (error) {
     console.error("❌ Error finding staff by email:", error);
     return null;
@@ -819,6 +821,22 @@ async function checkPlanLimit() {
       return false;
     }
     
+    // Fast path: backend answers from its in-memory plan + staff counters
+    try {
+      const currentUser = getAuth().currentUser;
+      const idToken = currentUser ? await currentUser.getIdToken() : "";
+      const res = await fetch(`/entitlements?shop_id=${encodeURIComponent(currentShopId)}`, {
+        headers: { "Authorization": `Bearer ${idToken}` }
+      });
+      if (res.ok) {
+        const data = await res.json();
+        console.log(`📊 Plan: ${data.plan_name}, Staff: ${data.staff.used}/${data.staff.limit}`);
+        return data.can_add_staff;
+      }
+    } catch (e) {
+      console.warn("⚠️ /entitlements failed, checking Firestore directly:", e);
+    }
+    
     // Get current staff count
     const staffRef = collection(db, "Shops", currentShopId, "staff");
     const staffSnapshot = await getDocs(staffRef);
@@ -1214,9 +1232,7 @@ async function showAddStaffForm() {
       email: email,
       phone: phone,
       roleName: roleName,
-      accessLevel: accessLevel,
-      createdAt: serverTimestamp(),
-      updatedAt: serverTimestamp()
+      accessLevel: accessLevel
     };
 
     await saveStaffMember(staffData);
@@ -1225,7 +1241,7 @@ async function showAddStaffForm() {
 }
 
 // ======================================================
-// SAVE STAFF MEMBER TO FIREBASE
+// SAVE STAFF MEMBER (backend enforces the plan's seat limit)
 // ======================================================
 async function saveStaffMember(staffData) {
   try {
@@ -1233,15 +1249,31 @@ async function saveStaffMember(staffData) {
       throw new Error('No shop ID found / Hakuna ID ya duka');
     }
 
-    // Generate staff ID using our improved function
-    const staffId = generateStaffId();
-    
-    // Save to: Shops/{shopId}/staff/{staffId}
-    const staffRef = doc(db, "Shops", currentShopId, "staff", staffId);
-    
-    await setDoc(staffRef, staffData);
+    const currentUser = getAuth().currentUser;
+    if (!currentUser) {
+      throw new Error('Not signed in / Hujaingia');
+    }
+
+    // Saved to Shops/{shopId}/staff/{staffId} by the backend, which checks the seat limit first
+    const idToken = await currentUser.getIdToken();
+    const res = await fetch("/add-staff", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        "Authorization": `Bearer ${idToken}`
+      },
+      body: JSON.stringify({ shop_id: currentShopId, staff: staffData })
+    });
+    const data = await res.json().catch(() => ({}));
+    if (res.status === 403 && data.allowed === false) {
+      showToast('Staff limit reached for your plan / Kikomo cha wafanyakazi kwa mpango wako kimefikiwa', 'error');
+      return;
+    }
+    if (!res.ok) {
+      throw new Error(data.error || `/add-staff failed (${res.status})`);
+    }
 
-    console.log(`✅ Staff member added:`, staffId);
+    console.log(`✅ Staff member added:`, data.staff_id);
     
     // Show success message (bilingual)
     showToast(`${staffData.name} added as ${staffData.roleName} (Level ${staffData.accessLevel}) / ${staffData.name} ameongezwa kama ${staffData.roleName} (Kiwango ${staffData.accessLevel})`, 'success');
@@ -1448,6 +1448,29 @@ function showUpgradeConfirmation(plan, upgradeRequestId) {
   }, 300);
 }
 
+// ======================================================
+// M-PESA REFERENCE REUSE CHECK (backend index)
+// ======================================================
+async function isMpesaReferenceUsedElsewhere(mpesaRef) {
+  try {
+    const user = getAuth().currentUser;
+    if (!user) return false;
+    const idToken = await user.getIdToken();
+    const res = await fetch(`/upgrade-requests/by-reference/${encodeURIComponent(mpesaRef)}`, {
+      headers: { "Authorization": `Bearer ${idToken}` }
+    });
+    if (!res.ok) {
+      console.warn("⚠️ Reference check unavailable (" + res.status + "), skipping");
+      return false;
+    }
+    const data = await res.json();
+    return data.used_by_other_shop;
+  } catch (e) {
+    console.warn("⚠️ Reference check failed, skipping:", e);
+    return false;
+  }
+}
+
 // ======================================================
 // SUBMIT M-PESA REFERENCE
 // ======================================================
@@ -1470,6 +1493,15 @@ async function submitMpesaReference(plan, upgradeRequestId) {
   errorDiv.style.display = 'none';
   
   try {
+    // Reject a reference that another shop already submitted
+    if (await isMpesaReferenceUsedElsewhere(mpesaRef)) {
+      errorDiv.textContent = 'This M-Pesa reference has already been used. Please check the code and try again.';
+      errorDiv.style.display = 'block';
+      submitBtn.textContent = originalText;
+      submitBtn.disabled = false;
+      return;
+    }
+
     // Create payment record in Firestore
     const paymentRef = doc(collection(db, "Shops", currentShopId, "payments"));
     